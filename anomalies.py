@@ -0,0 +1,242 @@
+# SoloWealth - Personal Finance Tracker
+# anomalies.py - Unusual expense detection over the expense history
+
+import bisect
+import threading
+from collections import Counter
+from datetime import date, timedelta
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+from sqlalchemy.orm import Session
+
+import columnar
+from columnar import EPOCH
+import registry
+import trackers
+from models import Anomaly, AnomalyKind
+
+# Iglewicz-Hoaglin modified z-score cut-off, the number of expenses a
+# category needs before it has a "normal range", the window in which two
+# identical charges look like a duplicate, and the rolling window (in
+# months) that a month's total is compared against.
+OUTLIER_Z = 3.5
+MIN_SAMPLES = 8
+DUPLICATE_WINDOW_DAYS = 3
+JUMP_WINDOW_MONTHS = 6
+JUMP_Z = 3.0
+JUMP_RATIO = 1.5
+
+
+def load_columns(db: Session) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+    """Expense (id, day number, amount, category_id) columns from the column store"""
+    ids, days, amounts, cats = columnar.expenses(db)
+    return ids, days.astype(np.int64), amounts, cats.astype(np.int64)
+
+
+def group_medians(keys: np.ndarray, values: np.ndarray) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Per-key median of `values`; returns (unique keys, medians, counts)"""
+    order = np.lexsort((values, keys))
+    k, v = keys[order], values[order]
+    starts = np.flatnonzero(np.r_[True, k[1:] != k[:-1]]) if len(k) else np.zeros(0, dtype=np.intp)
+    counts = np.diff(np.r_[starts, len(k)])
+    medians = (v[starts + (counts - 1) // 2] + v[starts + counts // 2]) / 2
+    return k[starts], medians, counts
+
+
+def _months(days: np.ndarray) -> np.ndarray:
+    return days.astype("datetime64[D]").astype("datetime64[M]").astype(np.int64)
+
+
+def _day(day_number) -> date:
+    return EPOCH + timedelta(days=int(day_number))
+
+
+def scan(ids: np.ndarray, days: np.ndarray, amounts: np.ndarray, cats: np.ndarray) -> List[dict]:
+    """Flag outliers, duplicates and monthly jumps over whole expense columns"""
+    found = []
+    if not len(ids):
+        return found
+
+    # Outliers: modified z-score against the category median and MAD
+    keys, medians, counts = group_medians(cats, amounts)
+    group = np.searchsorted(keys, cats)
+    deviation = np.abs(amounts - medians[group])
+    _, mads, _ = group_medians(cats, deviation)
+    mad = mads[group]
+    with np.errstate(divide="ignore", invalid="ignore"):
+        z = 0.6745 * (amounts - medians[group]) / mad
+    mask = (counts[group] >= MIN_SAMPLES) & (mad > 0) & (np.abs(z) > OUTLIER_Z)
+    for i in np.flatnonzero(mask):
+        found.append(dict(
+            kind=AnomalyKind.OUTLIER, expense_id=int(ids[i]), category_id=int(cats[i]), date=_day(days[i]),
+            amount=float(amounts[i]), score=round(float(abs(z[i])), 2),
+            message=f"Amount is far from this category's typical {medians[group[i]]:.2f}"
+        ))
+
+    # Duplicates: same category and amount within a few days of the previous charge
+    cents = np.round(amounts * 100).astype(np.int64)
+    order = np.lexsort((ids, days, cents, cats))
+    c, a, d = cats[order], cents[order], days[order]
+    gap = d[1:] - d[:-1]
+    dup = (c[1:] == c[:-1]) & (a[1:] == a[:-1]) & (gap <= DUPLICATE_WINDOW_DAYS)
+    for j in np.flatnonzero(dup):
+        i = order[j + 1]
+        found.append(dict(
+            kind=AnomalyKind.DUPLICATE, expense_id=int(ids[i]), category_id=int(cats[i]), date=_day(days[i]),
+            amount=float(amounts[i]), score=float(gap[j]),
+            message=f"Same amount in the same category as expense #{int(ids[order[j]])}"
+        ))
+
+    # Monthly jumps: rolling z-score of a category's month total against the previous months
+    months = _months(days)
+    first = months.min()
+    n_months = int(months.max() - first) + 1
+    totals = np.bincount(group * n_months + (months - first), weights=amounts,
+                         minlength=len(keys) * n_months).reshape(len(keys), n_months)
+    padded = np.pad(totals, ((0, 0), (1, 0)))
+    csum, csq = np.cumsum(padded, axis=1), np.cumsum(padded ** 2, axis=1)
+    idx = np.arange(n_months)
+    lo = np.maximum(idx - JUMP_WINDOW_MONTHS, 0)
+    window = idx - lo
+    with np.errstate(divide="ignore", invalid="ignore"):
+        mean = (csum[:, idx] - csum[:, lo]) / window
+        std = np.sqrt(np.maximum((csq[:, idx] - csq[:, lo]) / window - mean ** 2, 0))
+        jump_z = (totals - mean) / std
+    jumps = (window >= JUMP_WINDOW_MONTHS) & (std > 0) & (jump_z > JUMP_Z) & (totals > mean * JUMP_RATIO)
+    for row, m in zip(*np.nonzero(jumps)):
+        month = np.datetime64(int(first + m), "M").astype("datetime64[D]").astype(object)
+        found.append(dict(
+            kind=AnomalyKind.MONTHLY_JUMP, category_id=int(keys[row]), date=month,
+            amount=round(float(totals[row, m]), 2), score=round(float(jump_z[row, m]), 2),
+            message=f"Month total is well above the {JUMP_WINDOW_MONTHS}-month average of {mean[row, m]:.2f}"
+        ))
+    return found
+
+
+class _CategoryStats:
+    __slots__ = ("amounts", "mad", "changes")
+
+    def __init__(self, amounts: List[float]):
+        self.amounts = amounts
+        self.mad = None
+        self.changes = 0
+
+    def median(self) -> float:
+        n = len(self.amounts)
+        return (self.amounts[(n - 1) // 2] + self.amounts[n // 2]) / 2
+
+    def spread(self) -> float:
+        # MAD is refreshed lazily once enough values changed to move it
+        if self.mad is None or self.changes > max(10, len(self.amounts) // 20):
+            values = np.asarray(self.amounts)
+            self.mad = float(np.median(np.abs(values - self.median())))
+            self.changes = 0
+        return self.mad
+
+
+class AnomalyDetector(trackers.Tracker):
+    """Per-category statistics kept current so a new expense is checked in O(1).
+
+    Holds each category's sorted amounts (median in O(1)), a cached MAD,
+    a (category, cents, day) counter for duplicate look-ups and monthly
+    totals for jump checks.
+
+    Keeping the amounts sorted costs a write O(n) in its category's size:
+    insort finds the place by bisection but shifts the list's tail to make
+    room. That tail is a memmove of pointers, about 25 us with 100k
+    expenses in one category against milliseconds for the write's commit,
+    so a plain list is kept over a balanced tree and an extra dependency.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+
+    def load(self, db: Session) -> None:
+        (ids, days, amounts, cats), self.version, self.journal_id = trackers.get("columns", db).read(db)
+        days, cats = days.astype(np.int64), cats.astype(np.int64)
+        order = np.lexsort((amounts, cats))
+        self._stats: Dict[int, _CategoryStats] = {}
+        keys, _, counts = group_medians(cats, amounts)
+        for key, chunk in zip(keys, np.split(amounts[order], np.cumsum(counts)[:-1])):
+            self._stats[int(key)] = _CategoryStats(chunk.tolist())
+        cents = np.round(amounts * 100).astype(np.int64)
+        self._charges = Counter(zip(cats.tolist(), cents.tolist(), days.tolist()))
+        months = _months(days)
+        self._monthly: Dict[Tuple[int, int], float] = {}
+        if len(ids):
+            monthly_keys, inverse = np.unique(np.stack([cats, months], axis=1), axis=0, return_inverse=True)
+            sums = np.bincount(inverse.ravel(), weights=amounts)
+            self._monthly = {(int(c), int(m)): float(s) for (c, m), s in zip(monthly_keys, sums)}
+
+    def apply(self, old, new) -> None:
+        with self._lock:
+            if old is not None:
+                self._update(old.category_id, old.date, old.amount, -1)
+            if new is not None:
+                self._update(new.category_id, new.date, new.amount, 1)
+
+    def _update(self, category_id: int, day: date, amount: float, sign: int) -> None:
+        stats = self._stats.setdefault(category_id, _CategoryStats([]))
+        if sign > 0:
+            bisect.insort(stats.amounts, amount)
+        else:
+            i = bisect.bisect_left(stats.amounts, amount)
+            if i < len(stats.amounts) and stats.amounts[i] == amount:
+                del stats.amounts[i]
+        stats.changes += 1
+        self._charges[(category_id, round(amount * 100), (day - EPOCH).days)] += sign
+        key = (category_id, day.year * 12 + day.month - 1 - 1970 * 12)
+        self._monthly[key] = self._monthly.get(key, 0.0) + sign * amount
+
+    def check(self, category_id: int, day: date, amount: float) -> List[dict]:
+        """Anomalies a new expense would raise, from the maintained statistics only"""
+        found = []
+        with self._lock:
+            stats = self._stats.get(category_id)
+            if stats is not None and len(stats.amounts) >= MIN_SAMPLES:
+                median, mad = stats.median(), stats.spread()
+                z = 0.6745 * (amount - median) / mad if mad > 0 else 0.0
+                if abs(z) > OUTLIER_Z:
+                    found.append(dict(kind=AnomalyKind.OUTLIER, score=round(abs(z), 2),
+                                      message=f"Amount is far from this category's typical {median:.2f}"))
+            number, cents = (day - EPOCH).days, round(amount * 100)
+            near = [number + offset for offset in range(-DUPLICATE_WINDOW_DAYS, DUPLICATE_WINDOW_DAYS + 1)]
+            matches = [n for n in near if self._charges.get((category_id, cents, n), 0) > 0]
+            if matches:
+                gap = min(abs(n - number) for n in matches)
+                found.append(dict(kind=AnomalyKind.DUPLICATE, score=float(gap),
+                                  message="Same amount in the same category was logged a few days apart"))
+            month = day.year * 12 + day.month - 1 - 1970 * 12
+            history = [self._monthly.get((category_id, m), 0.0) for m in range(month - JUMP_WINDOW_MONTHS, month)]
+            total = self._monthly.get((category_id, month), 0.0) + amount
+            mean = sum(history) / len(history)
+            std = (sum((h - mean) ** 2 for h in history) / len(history)) ** 0.5
+            if std > 0 and (total - mean) / std > JUMP_Z and total > mean * JUMP_RATIO:
+                found.append(dict(kind=AnomalyKind.MONTHLY_JUMP, score=round((total - mean) / std, 2),
+                                  message=f"Month total would be well above the "
+                                          f"{JUMP_WINDOW_MONTHS}-month average of {mean:.2f}"))
+        return found
+
+
+def find_anomalies(db: Session, from_date: Optional[date] = None, to_date: Optional[date] = None,
+                   limit: int = 100) -> List[Anomaly]:
+    names = registry.get(db).category_names()
+    found = [
+        f for f in scan(*load_columns(db))
+        if (from_date is None or f["date"] >= from_date) and (to_date is None or f["date"] <= to_date)
+    ]
+    found.sort(key=lambda f: (f["date"], f["score"]), reverse=True)
+    return [Anomaly(category_name=names.get(f["category_id"]), **f) for f in found[:limit]]
+
+
+def check_expense(db: Session, category_id: int, day: date, amount: float) -> List[Anomaly]:
+    name = registry.get(db).category_name(category_id)
+    detector = trackers.get("anomalies", db)
+    return [
+        Anomaly(category_id=category_id, category_name=name, date=day, amount=amount, **f)
+        for f in detector.check(category_id, day, amount)
+    ]
+
+
+trackers.register("anomalies", AnomalyDetector)
@@ -0,0 +1,217 @@
+# SoloWealth - Personal Finance Tracker
+# archive.py - Year-based archival of closed expense history
+
+import os
+from datetime import date, datetime
+from typing import Dict, List, Optional
+
+from sqlalchemy import Boolean, Column, Date, DateTime, Float, Integer, MetaData, String, Table, Text, event, func, select, text
+from sqlalchemy.engine import Engine
+from sqlalchemy.orm import Session
+
+import trackers
+from models import ArchivedYearDB, ExpenseDB
+from profiles import database_path
+
+# Closed years live in "<ledger>.archive.db", attached to every connection as
+# `archive`. The hot `expenses` table keeps recent years only, so backups,
+# VACUUM and unindexed scans of the main file stop growing with history.
+COLUMNS = "id, date, amount, category_id, is_fixed, notes, created_at, updated_at, uuid, hlc, sync_seq"
+# Added to archive files created before sync (see sync.py)
+SYNC_COLUMNS = {"uuid": "VARCHAR(32)", "hlc": "VARCHAR(64)", "sync_seq": "INTEGER"}
+
+ARCHIVE_DDL = (
+    """CREATE TABLE IF NOT EXISTS archive.expenses (
+        id INTEGER PRIMARY KEY, date DATE NOT NULL, amount FLOAT NOT NULL, category_id INTEGER NOT NULL,
+        is_fixed BOOLEAN, notes TEXT, created_at DATETIME, updated_at DATETIME,
+        uuid VARCHAR(32), hlc VARCHAR(64), sync_seq INTEGER)""",
+    "CREATE INDEX IF NOT EXISTS archive.ix_archive_expenses_date ON expenses (date)",
+    "CREATE UNIQUE INDEX IF NOT EXISTS archive.ix_archive_expenses_uuid ON expenses (uuid)",
+    "CREATE INDEX IF NOT EXISTS archive.ix_archive_expenses_sync_seq ON expenses (sync_seq)",
+    f"""CREATE TEMP VIEW IF NOT EXISTS expenses_all AS
+        SELECT {COLUMNS} FROM main.expenses UNION ALL SELECT {COLUMNS} FROM archive.expenses""",
+)
+
+# Read-only mapping of the full-history view (kept out of Base.metadata so
+# create_all never tries to create it)
+expenses_all = Table(
+    "expenses_all", MetaData(),
+    Column("id", Integer, primary_key=True),
+    Column("date", Date),
+    Column("amount", Float),
+    Column("category_id", Integer),
+    Column("is_fixed", Boolean),
+    Column("notes", Text),
+    Column("created_at", DateTime),
+    Column("updated_at", DateTime),
+    Column("uuid", String(32)),
+    Column("hlc", String(64)),
+    Column("sync_seq", Integer),
+)
+
+
+# Table a backup carries the archived expenses in (see backup.py); restore
+# moves them back into the archive file
+BACKUP_TABLE = "archive_backup_expenses"
+
+
+class ArchiveError(Exception):
+    pass
+
+
+def archive_path(engine: Engine) -> str:
+    root, _ = os.path.splitext(database_path(engine))
+    return root + ".archive.db"
+
+
+def install(engine: Engine, read_only: bool = False) -> None:
+    """Attach the archive database and create the full-history view on every new connection.
+
+    Read-only engines (opened with a file: URI) attach the archive with
+    mode=ro and only create the TEMP view; the archive file must exist.
+    """
+    path = archive_path(engine)
+    target = f"file:{path}?mode=ro" if read_only else path
+    statements = ARCHIVE_DDL[-1:] if read_only else ARCHIVE_DDL
+
+    @event.listens_for(engine, "connect")
+    def _attach(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        cursor.execute("ATTACH DATABASE ? AS archive", (target,))
+        if not read_only:
+            cursor.execute(statements[0])
+            existing = {row[1] for row in cursor.execute("PRAGMA archive.table_info(expenses)")}
+            for name, ddl in SYNC_COLUMNS.items():
+                if name not in existing:
+                    cursor.execute(f"ALTER TABLE archive.expenses ADD COLUMN {name} {ddl}")
+        for statement in statements:
+            cursor.execute(statement)
+        cursor.close()
+
+
+class ArchiveIndex(trackers.Tracker):
+    """Archived years and the highest archived expense id of a ledger"""
+
+    def __init__(self):
+        self.years: Dict[int, int] = {}
+        self.max_expense_id = 0
+
+    def load(self, db: Session) -> None:
+        self.years = dict(db.query(ArchivedYearDB.year, ArchivedYearDB.max_expense_id).all())
+        self.max_expense_id = max(self.years.values(), default=0)
+
+    def touches(self, start: Optional[date], end: Optional[date]) -> bool:
+        first = start.year if start else None
+        last = end.year if end else None
+        return any((first is None or year >= first) and (last is None or year <= last) for year in self.years)
+
+
+trackers.register("archive", ArchiveIndex)
+
+
+def expense_source(db: Session, start: Optional[date] = None, end: Optional[date] = None) -> Table:
+    """The hot table, or the full-history view when [start, end] reaches an archived year"""
+    if trackers.get("archive", db).touches(start, end):
+        return expenses_all
+    return ExpenseDB.__table__
+
+
+def is_archived_expense(db: Session, expense_id: int) -> bool:
+    return db.execute(text("SELECT 1 FROM archive.expenses WHERE id = :id"), {"id": expense_id}).first() is not None
+
+
+def archive_year(db: Session, year: int) -> ArchivedYearDB:
+    """Move every hot expense of a closed year into the archive in one transaction.
+
+    Both files are committed together; in WAL mode SQLite only guarantees
+    atomicity per file, so rows are copied before they are deleted and a
+    crash in between can at worst leave a row in both places, which the
+    next archive run of that year cleans up.
+    """
+    if year >= date.today().year:
+        raise ArchiveError("Only closed years can be archived")
+    params = {"start": date(year, 1, 1), "end": date(year, 12, 31)}
+    db.execute(text(
+        f"INSERT OR REPLACE INTO archive.expenses ({COLUMNS}) "
+        f"SELECT {COLUMNS} FROM main.expenses WHERE date >= :start AND date <= :end"
+    ), params)
+    db.execute(text("DELETE FROM main.expenses WHERE date >= :start AND date <= :end"), params)
+    rows, total, max_id = db.execute(text(
+        "SELECT COUNT(*), COALESCE(SUM(amount), 0), COALESCE(MAX(id), 0) "
+        "FROM archive.expenses WHERE date >= :start AND date <= :end"
+    ), params).one()
+    if rows == 0:
+        db.rollback()
+        raise ArchiveError(f"No expenses in {year}")
+    record = db.get(ArchivedYearDB, year) or ArchivedYearDB(year=year)
+    record.rows, record.total, record.max_expense_id = rows, total, max_id
+    record.archived_at = datetime.utcnow()
+    db.add(record)
+    db.commit()
+    trackers.get("archive", db).load(db)
+    return record
+
+
+def unarchive_year(db: Session, year: int) -> int:
+    """Move an archived year back into the hot table; returns the number of rows moved"""
+    record = db.get(ArchivedYearDB, year)
+    if record is None:
+        raise ArchiveError(f"{year} is not archived")
+    params = {"start": date(year, 1, 1), "end": date(year, 12, 31)}
+    moved = db.execute(text(
+        f"INSERT OR REPLACE INTO main.expenses ({COLUMNS}) "
+        f"SELECT {COLUMNS} FROM archive.expenses WHERE date >= :start AND date <= :end"
+    ), params).rowcount
+    db.execute(text("DELETE FROM archive.expenses WHERE date >= :start AND date <= :end"), params)
+    db.delete(record)
+    db.commit()
+    trackers.get("archive", db).load(db)
+    return moved
+
+
+def reconcile(db: Session) -> None:
+    """Fit the archive to a main file that was just restored from a backup.
+
+    The archive file is not replaced along with the main file, so the rows
+    the backup carried take its place first (backups from before archives
+    were carried leave it as it is). Then the restored `archived_years`
+    decide where each expense belongs: rows of other years are dropped
+    from the archive (the main file has them, as of the backup), and rows
+    of archived years still in the main file are moved over.
+    """
+    carried = {row[1] for row in db.execute(text(f"PRAGMA main.table_info({BACKUP_TABLE})"))}
+    if carried:
+        columns = ", ".join(c for c in COLUMNS.split(", ") if c in carried)
+        db.execute(text("DELETE FROM archive.expenses"))
+        db.execute(text(f"INSERT INTO archive.expenses ({columns}) SELECT {columns} FROM main.{BACKUP_TABLE}"))
+        db.execute(text(f"DROP TABLE main.{BACKUP_TABLE}"))
+    years = [year for (year,) in db.query(ArchivedYearDB.year).all()]
+    archived = f"CAST(substr(date, 1, 4) AS INTEGER) IN ({', '.join(map(str, years)) or 'NULL'})"
+    db.execute(text(f"DELETE FROM archive.expenses WHERE NOT ({archived})"))
+    db.execute(text(f"INSERT OR IGNORE INTO archive.expenses ({COLUMNS}) "
+                    f"SELECT {COLUMNS} FROM main.expenses WHERE {archived}"))
+    db.execute(text(f"DELETE FROM main.expenses WHERE {archived}"))
+    db.commit()
+    trackers.get("archive", db).load(db)
+
+
+def list_archived(db: Session) -> List[ArchivedYearDB]:
+    return db.query(ArchivedYearDB).order_by(ArchivedYearDB.year).all()
+
+
+# SQLite hands out max(rowid) + 1 of the hot table, which can collide with an
+# archived id once the newest rows were archived or deleted; new expenses
+# then get ids above the archive's high-water mark explicitly.
+@event.listens_for(Session, "before_flush")
+def _assign_expense_ids(session, flush_context, instances):
+    new = [obj for obj in session.new if isinstance(obj, ExpenseDB) and obj.id is None]
+    if not new:
+        return
+    floor = trackers.get("archive", session).max_expense_id
+    if not floor:
+        return
+    hot_max = session.execute(select(func.max(ExpenseDB.id))).scalar() or 0
+    if hot_max >= floor:
+        return
+    for offset, obj in enumerate(new, 1):
+        obj.id = floor + offset
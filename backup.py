@@ -0,0 +1,250 @@
+# SoloWealth - Personal Finance Tracker
+# backup.py - Online backups, rotation and restore via the SQLite backup API
+
+import gzip
+import os
+import shutil
+import sqlite3
+import threading
+import time
+from datetime import datetime
+from typing import Callable, Dict, List, Optional
+
+from sqlalchemy.engine import Engine
+
+import archive
+import writer
+from models import BackupInfo
+from profiles import database_path
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# The copy runs PAGES_PER_STEP pages at a time and sleeps STEP_SLEEP seconds
+# between steps, so writers only ever wait for one step (~4 MB with the
+# default 4 KB page size) instead of the whole file.
+PAGES_PER_STEP = 1024
+STEP_SLEEP = 0.01
+# Copies retaken when a year is archived or unarchived while one runs
+COPY_ATTEMPTS = 3
+BACKUP_KEEP = int(os.environ.get("SOLOWEALTH_BACKUP_KEEP", "7"))
+BACKUP_INTERVAL_HOURS = float(os.environ.get("SOLOWEALTH_BACKUP_INTERVAL_HOURS", "24"))
+
+EXTENSIONS = {".db": None, ".db.gz": "gzip", ".db.zst": "zstd"}
+
+_lock = threading.Lock()
+
+
+class BackupError(Exception):
+    pass
+
+
+def backup_dir(engine: Engine) -> str:
+    path = os.environ.get("SOLOWEALTH_BACKUP_DIR") or os.path.join(os.path.dirname(database_path(engine)), "backups")
+    os.makedirs(path, exist_ok=True)
+    return path
+
+
+def _stem(engine: Engine) -> str:
+    return os.path.splitext(os.path.basename(database_path(engine)))[0]
+
+
+def _compression(name: str) -> Optional[str]:
+    for ext, compression in EXTENSIONS.items():
+        if name.endswith(ext):
+            return compression
+    raise BackupError(f"Unrecognized backup file '{name}'")
+
+
+def _info(path: str) -> BackupInfo:
+    stat = os.stat(path)
+    name = os.path.basename(path)
+    return BackupInfo(name=name, size=stat.st_size, created_at=datetime.fromtimestamp(stat.st_mtime),
+                      compression=_compression(name))
+
+
+def _verify(path: str) -> None:
+    conn = sqlite3.connect(path)
+    try:
+        result = conn.execute("PRAGMA integrity_check").fetchone()[0]
+    finally:
+        conn.close()
+    if result != "ok":
+        raise BackupError(f"Integrity check failed: {result}")
+
+
+def _archived_years(path: str) -> set:
+    conn = sqlite3.connect(path)
+    try:
+        return {year for (year,) in conn.execute("SELECT year FROM archived_years")}
+    except sqlite3.OperationalError:
+        return set()  # a ledger that was never migrated
+    finally:
+        conn.close()
+
+
+def _copy(engine: Engine, target: str) -> None:
+    """Copy the ledger into `target`, with its archived expenses as archive.BACKUP_TABLE.
+
+    The main file is copied page by page while writers carry on; the
+    archive is then copied under the write gate, which archiving takes
+    too, so both agree on which years are archived. A copy that saw a
+    year archived or unarchived meanwhile is retaken.
+    """
+    archive_file = archive.archive_path(engine)
+    for attempt in range(COPY_ATTEMPTS):
+        src, dst = sqlite3.connect(database_path(engine)), sqlite3.connect(target)
+        try:
+            src.backup(dst, pages=PAGES_PER_STEP, sleep=STEP_SLEEP)
+        finally:
+            dst.close()
+            src.close()
+        if not os.path.exists(archive_file):
+            return
+        with writer.gate(engine).held():
+            if _archived_years(target) != _archived_years(database_path(engine)) and attempt < COPY_ATTEMPTS - 1:
+                continue
+            conn = sqlite3.connect(target)
+            try:
+                conn.execute("ATTACH DATABASE ? AS live", (archive_file,))
+                conn.execute(f"CREATE TABLE {archive.BACKUP_TABLE} AS SELECT * FROM live.expenses")
+                conn.commit()
+            finally:
+                conn.close()
+            return
+
+
+def list_backups(engine: Engine) -> List[BackupInfo]:
+    directory, prefix = backup_dir(engine), _stem(engine) + "-"
+    names = [n for n in os.listdir(directory)
+             if n.startswith(prefix) and any(n.endswith(ext) for ext in EXTENSIONS)]
+    return sorted((_info(os.path.join(directory, n)) for n in names), key=lambda b: b.created_at, reverse=True)
+
+
+def _rotate(engine: Engine, keep: int) -> None:
+    for old in list_backups(engine)[keep:]:
+        os.remove(os.path.join(backup_dir(engine), old.name))
+
+
+def create_backup(engine: Engine, compression: Optional[str] = "gzip", keep: int = BACKUP_KEEP) -> BackupInfo:
+    """Copy the live database page by page, verify the copy, then compress and rotate"""
+    if compression not in EXTENSIONS.values():
+        raise BackupError(f"Unknown compression '{compression}'")
+    if compression == "zstd" and zstandard is None:
+        raise BackupError("zstd compression requires the 'zstandard' package")
+    if not _lock.acquire(blocking=False):
+        raise BackupError("Another backup or restore is in progress")
+    try:
+        directory = backup_dir(engine)
+        name = base = f"{_stem(engine)}-{datetime.now():%Y%m%d-%H%M%S}"
+        suffix = 1
+        while any(os.path.exists(os.path.join(directory, name + ext)) for ext in EXTENSIONS):
+            name, suffix = f"{base}-{suffix}", suffix + 1
+        partial = os.path.join(directory, name + ".partial")
+        try:
+            _copy(engine, partial)
+            _verify(partial)
+            ext = next(ext for ext, c in EXTENSIONS.items() if c == compression)
+            target = os.path.join(directory, name + ext)
+            if compression is None:
+                os.replace(partial, target)
+            else:
+                opener = gzip.open if compression == "gzip" else zstandard.open
+                with open(partial, "rb") as f_in, opener(target + ".partial", "wb") as f_out:
+                    shutil.copyfileobj(f_in, f_out, 1024 * 1024)
+                os.replace(target + ".partial", target)
+        finally:
+            for leftover in (partial, os.path.join(directory, name + ".db.gz.partial"),
+                             os.path.join(directory, name + ".db.zst.partial")):
+                if os.path.exists(leftover):
+                    os.remove(leftover)
+        _rotate(engine, keep)
+        return _info(target)
+    finally:
+        _lock.release()
+
+
+def restore_backup(engine: Engine, name: str) -> BackupInfo:
+    """Replace the live database with a verified backup; returns the safety backup taken first"""
+    if name != os.path.basename(name) or name not in {b.name for b in list_backups(engine)}:
+        raise BackupError(f"Backup '{name}' not found")
+    source = os.path.join(backup_dir(engine), name)
+    compression = _compression(name)
+    safety = create_backup(engine, keep=BACKUP_KEEP + 1)
+    if not _lock.acquire(blocking=False):
+        raise BackupError("Another backup or restore is in progress")
+    staged = os.path.join(backup_dir(engine), name + ".restore")
+    try:
+        if compression is None:
+            shutil.copyfile(source, staged)
+        else:
+            opener = gzip.open if compression == "gzip" else zstandard.open
+            with opener(source, "rb") as f_in, open(staged, "wb") as f_out:
+                shutil.copyfileobj(f_in, f_out, 1024 * 1024)
+        _verify(staged)
+        # A single-step backup into the live file swaps the content atomically
+        # for every other connection; the gate keeps writers of every server
+        # process out meanwhile
+        with writer.gate(engine).held():
+            src, dst = sqlite3.connect(staged), sqlite3.connect(database_path(engine))
+            try:
+                src.backup(dst)
+            finally:
+                dst.close()
+                src.close()
+        engine.dispose()
+        return safety
+    finally:
+        if os.path.exists(staged):
+            os.remove(staged)
+        _lock.release()
+
+
+class BackupScheduler:
+    """Background thread backing up each ledger `engines()` returns whose newest backup is older than the interval"""
+
+    def __init__(self, engines: Callable[[], List[Engine]], interval_hours: float = BACKUP_INTERVAL_HOURS):
+        self.engines = engines
+        self.interval = interval_hours * 3600
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="backup-scheduler", daemon=True)
+        self._locks: Dict[str, writer.FileLock] = {}
+
+    def start(self) -> None:
+        if self.interval > 0:
+            self._thread.start()
+
+    def stop(self) -> None:
+        self._stop.set()
+
+    def _due_in(self, engine: Engine) -> float:
+        backups = list_backups(engine)
+        if not backups:
+            return 0
+        age = time.time() - backups[0].created_at.timestamp()
+        return max(self.interval - age, 0)
+
+    def _run(self) -> None:
+        # Give startup a head start before the first check
+        if self._stop.wait(60):
+            return
+        while not self._stop.is_set():
+            delay = self.interval
+            for engine in self.engines():
+                try:
+                    # Every server process runs a scheduler; whichever holds the
+                    # ledger's backup lock checks, so a due backup is taken once
+                    path = writer.lock_path(engine, "backup")
+                    lock = self._locks.setdefault(path, writer.FileLock(path))
+                    if lock.acquire(timeout=0):
+                        try:
+                            if self._due_in(engine) == 0:
+                                create_backup(engine)
+                        finally:
+                            lock.release()
+                    delay = min(delay, self._due_in(engine))
+                except Exception:
+                    delay = min(delay, 3600)
+            self._stop.wait(max(delay, 60))
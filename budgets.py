@@ -0,0 +1,111 @@
+# SoloWealth - Personal Finance Tracker
+# budgets.py - Running per-category totals for budget periods
+
+import calendar
+import threading
+from datetime import date, timedelta
+from typing import Dict, List, Optional, Tuple
+
+from sqlalchemy import func, literal, select
+from sqlalchemy.orm import Session
+
+import archive
+import registry
+import trackers
+from models import BudgetDB, BudgetPeriod, BudgetStatus, DataVersionDB
+
+
+def period_bounds(period: BudgetPeriod, day: date) -> Tuple[date, date]:
+    """First and last day of the budget period containing `day`"""
+    if period == BudgetPeriod.WEEKLY:
+        start = day - timedelta(days=day.weekday())
+        return start, start + timedelta(days=6)
+    if period == BudgetPeriod.YEARLY:
+        return date(day.year, 1, 1), date(day.year, 12, 31)
+    return day.replace(day=1), day.replace(day=calendar.monthrange(day.year, day.month)[1])
+
+
+class BudgetTracker(trackers.Tracker):
+    """Spent-so-far counters keyed by (period, period start, category).
+
+    A period is aggregated from the database once, the first time its
+    status is asked for; after that every expense write adjusts the
+    counters of the periods it falls in, so status reads never scan
+    expenses. Each period remembers the expenses version its aggregate
+    was read at, and changes up to that version (a commit that landed
+    before the read but is dispatched after it) are not added again.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._totals: Dict[Tuple[BudgetPeriod, date], Dict[int, float]] = {}
+        self._filled_at: Dict[Tuple[BudgetPeriod, date], int] = {}
+
+    def apply(self, old, new) -> None:
+        with self._lock:
+            if old is not None:
+                self._add(old.category_id, old.date, -old.amount)
+            if new is not None:
+                self._add(new.category_id, new.date, new.amount)
+
+    def _add(self, category_id: int, day: date, amount: float) -> None:
+        for period in BudgetPeriod:
+            key = (period, period_bounds(period, day)[0])
+            totals = self._totals.get(key)
+            if totals is not None and (self.version is None or self.version > self._filled_at[key]):
+                totals[category_id] = totals.get(category_id, 0.0) + amount
+
+    def spent(self, db: Session, period: BudgetPeriod, day: date) -> Dict[int, float]:
+        start, end = period_bounds(period, day)
+        with self._lock:
+            totals = self._totals.get((period, start))
+            if totals is None:
+                source = archive.expense_source(db, start, end)
+                # One statement, so the sums and the version come from the same snapshot
+                version = select(literal(None), DataVersionDB.version).where(DataVersionDB.name == "expenses")
+                rows = db.execute(
+                    select(source.c.category_id, func.sum(source.c.amount))
+                    .where(source.c.date >= start, source.c.date <= end).group_by(source.c.category_id)
+                    .union_all(version)
+                ).all()
+                totals = self._totals[(period, start)] = {}
+                self._filled_at[(period, start)] = 0
+                for category_id, total in rows:
+                    if category_id is None:
+                        self._filled_at[(period, start)] = int(total)
+                    else:
+                        totals[category_id] = total
+                # Periods that have ended are never asked for again
+                for key in [k for k in self._totals if k[0] == period and k[1] < start]:
+                    del self._totals[key]
+                    del self._filled_at[key]
+            return dict(totals)
+
+    def status(self, db: Session, period: Optional[BudgetPeriod] = None) -> List[BudgetStatus]:
+        today = date.today()
+        budgets: Dict[int, List[BudgetDB]] = {}
+        for budget in db.query(BudgetDB).all():
+            budgets.setdefault(budget.category_id, []).append(budget)
+        spent_by_period: Dict[BudgetPeriod, Dict[int, float]] = {}
+        result = []
+        for category in registry.get(db).categories.values():
+            entries = [(BudgetPeriod(b.period), b.limit_amount) for b in budgets.get(category.id, [])]
+            if not entries:
+                entries = [(BudgetPeriod.MONTHLY, None)]
+            for budget_period, limit in entries:
+                if period is not None and budget_period != period:
+                    continue
+                start, end = period_bounds(budget_period, today)
+                if budget_period not in spent_by_period:
+                    spent_by_period[budget_period] = self.spent(db, budget_period, today)
+                spent = round(spent_by_period[budget_period].get(category.id, 0.0), 2)
+                result.append(BudgetStatus(
+                    category_id=category.id, category_name=category.name, period=budget_period,
+                    period_start=start, period_end=end, limit_amount=limit, spent=spent,
+                    remaining=round(limit - spent, 2) if limit is not None else None,
+                    percent_used=round(spent / limit * 100, 2) if limit else None
+                ))
+        return result
+
+
+trackers.register("budgets", BudgetTracker)
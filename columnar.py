@@ -0,0 +1,328 @@
+# SoloWealth - Personal Finance Tracker
+# columnar.py - Memory-mapped column snapshot of expense history
+
+import json
+import os
+import threading
+import uuid
+from contextlib import nullcontext
+from itertools import chain
+from datetime import date
+from typing import Dict, NamedTuple, Optional, Tuple
+
+import numpy as np
+from sqlalchemy import func, select
+from sqlalchemy.engine import Engine
+from sqlalchemy.orm import Session
+
+import archive
+import trackers
+from profiles import database_path
+
+EPOCH = date(1970, 1, 1)
+# Pending changes are merged into a new on-disk generation past this size
+COMPACT_ROWS = 50_000
+# Rebuilds retried when the database moves on in a way the journal cannot
+# replay; the last attempt holds trackers.lock throughout
+REBUILD_ATTEMPTS = 3
+
+
+class ExpenseColumns(NamedTuple):
+    ids: np.ndarray           # int64
+    days: np.ndarray          # int32, days since 1970-01-01, ascending
+    amounts: np.ndarray       # float64
+    category_ids: np.ndarray  # int32
+
+
+LAYOUTS = {"expenses": ExpenseColumns}
+
+
+def day_number(day: date) -> int:
+    return (day - EPOCH).days
+
+
+def cache_dir(engine: Engine) -> str:
+    root, _ = os.path.splitext(database_path(engine))
+    return root + ".columns"
+
+
+def _slice(days: np.ndarray, start: Optional[date], end: Optional[date]) -> slice:
+    lo = 0 if start is None else int(np.searchsorted(days, day_number(start), side="left"))
+    hi = len(days) if end is None else int(np.searchsorted(days, day_number(end), side="right"))
+    return slice(lo, hi)
+
+
+def sql_expenses(db: Session, start: Optional[date] = None, end: Optional[date] = None) -> ExpenseColumns:
+    """Expense columns with start <= date <= end straight from SQLite, sorted by date.
+
+    What the store's generations are built from; also read directly by
+    processes that must not touch the column cache (background jobs).
+    """
+    source = archive.expense_source(db, start, end)
+    query = select(source.c.id, func.julianday(source.c.date) - 2440587.5, source.c.amount, source.c.category_id)
+    if start:
+        query = query.where(source.c.date >= start)
+    if end:
+        query = query.where(source.c.date <= end)
+    rows = db.execute(query.order_by(source.c.date, source.c.id))
+    # fromiter over the flattened rows; np.array() on Row objects probes each one as a sequence
+    data = np.fromiter(chain.from_iterable(rows), dtype=float).reshape(-1, 4)
+    return ExpenseColumns(data[:, 0].astype(np.int64), data[:, 1].astype(np.int32),
+                          data[:, 2].copy(), data[:, 3].astype(np.int32))
+
+
+class ColumnStore(trackers.Tracker):
+    """Date-sorted expense columns, memory-mapped from .npy files.
+
+    The on-disk generation is immutable. Expense writes land in a small
+    in-memory delta (new row versions by id, plus tombstoned ids that hide
+    base rows) which is merged into a new generation once it grows past
+    COMPACT_ROWS or at shutdown. The files are stamped with the
+    data_versions counters they reflect. Commits of other server processes
+    are replayed from the change journal; any other mismatch (an archive
+    move, a restore) triggers a rebuild from SQLite. A rebuild scans the
+    whole history, so it runs without trackers.lock and is checked against
+    the database again when it is put in place.
+    """
+
+    def __init__(self):
+        # Reentrant: a journal catch-up inside _sync goes through apply()
+        self._lock = threading.RLock()
+        # One rebuild at a time; readers wait here, commit dispatch does not
+        self._build_lock = threading.Lock()
+
+    # Loading and persistence
+    def load(self, db: Session) -> None:
+        self._dir = cache_dir(db.get_bind())
+        os.makedirs(self._dir, exist_ok=True)
+        versions = trackers.snapshot(db)
+        meta = self._read_meta()
+        self._epoch = versions["epoch"]
+        self._delta: Dict[int, Tuple[int, float, int]] = {}
+        self._tombstones = set()
+        self._delta_cache = None
+        self._expenses = None
+        if meta.get("epoch") == self._epoch and meta.get("expenses", {}).get("version") == versions["expenses"]:
+            self._expenses = self._open("expenses", meta["expenses"]["generation"], ExpenseColumns)
+            self.version, self.journal_id = versions["expenses"], versions["journal"]
+        if self._expenses is None:
+            self._build_expenses(db, versions)
+        else:
+            self._sweep(meta)
+
+    def _sync(self, db: Session) -> bool:
+        """Catch up with what the journal can replay; returns whether a
+        rebuild is needed instead. Caller holds the locks.
+        """
+        versions = trackers.snapshot(db)
+        if versions["epoch"] != self._epoch:
+            # Restored or replaced ledger: nothing cached can be trusted
+            return True
+        if versions["expenses"] > self.version and not trackers.catch_up(db, self, versions):
+            # Written around the ORM (bulk SQL, archive moves); a commit whose
+            # dispatch is still pending or one by another server process is
+            # replayed from the journal instead, making its dispatch a no-op
+            return True
+        if len(self._delta) + len(self._tombstones) > COMPACT_ROWS:
+            self._compact()
+        return False
+
+    def _refresh(self, db: Session) -> None:
+        """Bring the store up to date with the database before a read.
+
+        Should the database move on in a way the journal cannot replay
+        while a rebuild runs, the rebuild is redone; the last attempt holds
+        trackers.lock throughout, so it cannot fall behind.
+        """
+        with self._build_lock:
+            for attempt in range(REBUILD_ATTEMPTS):
+                with trackers.lock if attempt == REBUILD_ATTEMPTS - 1 else nullcontext():
+                    with trackers.lock, self._lock:
+                        if not self._sync(db):
+                            return
+                        self.rebuilding = True
+                    try:
+                        versions = trackers.snapshot(db)
+                        generation = self._write("expenses", self._read_expenses(db), versions["epoch"])
+                        with trackers.lock, self._lock:
+                            self._install(db, versions, generation)
+                    finally:
+                        self.rebuilding = False
+
+    def _install(self, db: Session, versions: Dict[str, int], generation: str) -> None:
+        """Put a rebuilt generation in place, if the database has not been
+        replaced since; then replay the commits made meanwhile. Caller holds
+        the locks.
+        """
+        current = trackers.snapshot(db)
+        if current["epoch"] != versions["epoch"]:
+            self._discard("expenses", generation)
+            return
+        self._epoch = versions["epoch"]
+        self._expenses = self._publish("expenses", generation, versions["expenses"])
+        self.version, self.journal_id = versions["expenses"], versions["journal"]
+        self._delta, self._tombstones, self._delta_cache = {}, set(), None
+        if current["expenses"] > self.version:
+            # Replays idempotently: the build may already hold some of these
+            trackers.catch_up(db, self, current)
+
+    def _read_meta(self) -> dict:
+        try:
+            with open(os.path.join(self._dir, "meta.json"), "r", encoding="utf-8") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def _write_meta(self, table: str, generation: str, version: int) -> None:
+        meta = self._read_meta()
+        replaced = meta.get("epoch") != self._epoch
+        if replaced:
+            meta = {"epoch": self._epoch}
+        previous = meta.get(table, {}).get("generation")
+        meta[table] = {"generation": generation, "version": version}
+        partial = os.path.join(self._dir, "meta.json.partial")
+        with open(partial, "w", encoding="utf-8") as f:
+            json.dump(meta, f)
+        os.replace(partial, os.path.join(self._dir, "meta.json"))
+        if replaced:
+            self._sweep(meta)
+        elif previous and previous != generation:
+            self._discard(table, previous)
+
+    def _sweep(self, meta: dict) -> None:
+        """Delete the generations of earlier epochs (and of tables no longer
+        kept) that `meta` does not name.
+
+        Generations of the current epoch are left alone even when unnamed:
+        another server process may have written one and not published it yet.
+        """
+        named = {f"{table}-{meta[table]['generation']}" for table in LAYOUTS if table in meta}
+        for name in os.listdir(self._dir):
+            stem = name.split(".", 1)[0]
+            if not name.endswith(".npy") or stem in named or stem.partition("-")[2].startswith(f"{self._epoch}-"):
+                continue
+            try:
+                os.remove(os.path.join(self._dir, name))
+            except OSError:
+                pass  # still mapped (Windows); retried when the store next loads
+
+    def _open(self, table: str, generation: str, columns):
+        try:
+            return columns(*(
+                np.load(os.path.join(self._dir, f"{table}-{generation}.{field}.npy"), mmap_mode="r")
+                for field in columns._fields
+            ))
+        except (OSError, ValueError):
+            # Replaced by another server process between reading meta.json and opening
+            return None
+
+    def _write(self, table: str, data, epoch: int) -> str:
+        """Write a new generation of a table's columns for `epoch`; returns its name"""
+        generation = f"{epoch}-{uuid.uuid4().hex[:12]}"
+        for field, values in zip(data._fields, data):
+            np.save(os.path.join(self._dir, f"{table}-{generation}.{field}.npy"), values)
+        return generation
+
+    def _publish(self, table: str, generation: str, version: int):
+        # Mapped before meta.json names it, when another process may replace and delete it
+        columns = self._open(table, generation, LAYOUTS[table])
+        self._write_meta(table, generation, version)
+        return columns
+
+    def _discard(self, table: str, generation: str) -> None:
+        for name in os.listdir(self._dir):
+            if name.startswith(f"{table}-{generation}."):
+                try:
+                    os.remove(os.path.join(self._dir, name))
+                except OSError:
+                    pass  # still mapped (Windows); swept once the epoch moves on
+
+    def _save(self, table: str, data, version: int):
+        return self._publish(table, self._write(table, data, self._epoch), version)
+
+    def _read_expenses(self, db: Session) -> ExpenseColumns:
+        return sql_expenses(db)
+
+    def _build_expenses(self, db: Session, versions: Dict[str, int]) -> None:
+        self._expenses = self._save("expenses", self._read_expenses(db), versions["expenses"])
+        self.version, self.journal_id = versions["expenses"], versions["journal"]
+        self._delta, self._tombstones, self._delta_cache = {}, set(), None
+
+    def _compact(self) -> None:
+        ids, days, amounts, cats = self._expenses
+        keep = ~np.isin(ids, self._tombstone_array()) if self._tombstones else slice(None)
+        extra = self._delta_arrays()
+        merged = [np.concatenate([np.asarray(base[keep]), add]) for base, add in zip(self._expenses, extra)]
+        order = np.lexsort((merged[0], merged[1]))
+        columns = ExpenseColumns(*(column[order] for column in merged))
+        self._expenses = self._save("expenses", columns, self.version)
+        self._delta, self._tombstones, self._delta_cache = {}, set(), None
+
+    def flush(self) -> None:
+        with self._lock:
+            if self._delta or self._tombstones:
+                self._compact()
+
+    # Incremental maintenance
+    def apply(self, old, new) -> None:
+        with self._lock:
+            # Tombstone both ids: the delta copy of a row always wins over the base copy
+            if old is not None:
+                self._delta.pop(old.id, None)
+                self._tombstones.add(old.id)
+            if new is not None:
+                self._delta[new.id] = (day_number(new.date), new.amount, new.category_id)
+                self._tombstones.add(new.id)
+            self._delta_cache = None
+
+    def _tombstone_array(self) -> np.ndarray:
+        return np.fromiter(self._tombstones, dtype=np.int64, count=len(self._tombstones))
+
+    def _delta_arrays(self) -> ExpenseColumns:
+        if self._delta_cache is None:
+            items = sorted(self._delta.items(), key=lambda item: (item[1][0], item[0]))
+            self._delta_cache = ExpenseColumns(
+                np.fromiter((i for i, _ in items), dtype=np.int64, count=len(items)),
+                np.fromiter((v[0] for _, v in items), dtype=np.int32, count=len(items)),
+                np.fromiter((v[1] for _, v in items), dtype=float, count=len(items)),
+                np.fromiter((v[2] for _, v in items), dtype=np.int32, count=len(items)),
+            )
+        return self._delta_cache
+
+    # Reads
+    def expenses(self, db: Session, start: Optional[date] = None, end: Optional[date] = None) -> ExpenseColumns:
+        """Expense columns with start <= date <= end, sorted by date.
+
+        Without pending changes the result is a zero-copy view into the
+        memory-mapped files, located by binary search on the date column.
+        """
+        return self.read(db, start, end)[0]
+
+    def read(self, db: Session, start: Optional[date] = None,
+             end: Optional[date] = None) -> Tuple[ExpenseColumns, int, Optional[int]]:
+        """`expenses()` plus the expenses version and journal id the columns reflect"""
+        self._refresh(db)
+        with self._lock:
+            version, journal_id = self.version, self.journal_id
+            base = self._expenses
+            window = _slice(base.days, start, end)
+            parts = ExpenseColumns(*(column[window] for column in base))
+            if not self._delta and not self._tombstones:
+                return parts, version, journal_id
+            if self._tombstones:
+                keep = ~np.isin(parts.ids, self._tombstone_array())
+                parts = ExpenseColumns(*(column[keep] for column in parts))
+            delta = self._delta_arrays()
+            extra = ExpenseColumns(*(column[_slice(delta.days, start, end)] for column in delta))
+        if not len(extra.ids):
+            return parts, version, journal_id
+        merged = [np.concatenate([a, b]) for a, b in zip(parts, extra)]
+        order = np.argsort(merged[1], kind="stable")
+        return ExpenseColumns(*(column[order] for column in merged)), version, journal_id
+
+
+trackers.register("columns", ColumnStore)
+
+
+def expenses(db: Session, start: Optional[date] = None, end: Optional[date] = None) -> ExpenseColumns:
+    return trackers.get("columns", db).expenses(db, start, end)
@@ -0,0 +1,184 @@
+# SoloWealth - Personal Finance Tracker
+# forecast.py - Per-category spending forecasts from daily expense history
+
+import calendar
+import threading
+from datetime import date, timedelta
+from typing import Dict, List
+
+import numpy as np
+from sqlalchemy.orm import Session
+
+import columnar
+import registry
+import trackers
+from models import CategoryForecast, ForecastResponse, status_for_savings_rate
+
+# Smoothing factor for the monthly level, and the history needed before
+# month-of-year seasonality is trusted (two observations of every month).
+ALPHA = 0.3
+SEASONAL_MIN_MONTHS = 24
+
+
+def _month_start(day: date) -> date:
+    return day.replace(day=1)
+
+
+def _month_end(day: date) -> date:
+    return day.replace(day=calendar.monthrange(day.year, day.month)[1])
+
+
+def fit(daily: np.ndarray, start: date, months_completed: int) -> tuple:
+    """Fit level, seasonal index and intra-month profile for each row of `daily`.
+
+    `daily` is a (categories x days) matrix starting at `start` (first day of
+    a month) whose first `months_completed` months are closed. Every step is
+    vectorized across categories, so refitting one row or all rows is the
+    same code path.
+    """
+    days = np.datetime64(start, "D") + np.arange(daily.shape[1])
+    months = days.astype("datetime64[M]")
+    month_starts = np.flatnonzero(np.r_[True, months[1:] != months[:-1]])
+    monthly = np.add.reduceat(daily, month_starts, axis=1)[:, :months_completed]
+
+    n = daily.shape[0]
+    seasonal = np.ones((n, 12))
+    profile = np.full((n, 31), np.nan)
+    if months_completed == 0:
+        return np.zeros(n), seasonal, profile
+
+    # Month-of-year seasonal index: mean of each calendar month over the overall mean
+    moy = months[month_starts[:months_completed]].astype(int) % 12
+    if months_completed >= SEASONAL_MIN_MONTHS:
+        onehot = np.eye(12)[moy]
+        counts = onehot.sum(axis=0)
+        overall = monthly.mean(axis=1, keepdims=True)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            index = (monthly @ onehot) / counts / overall
+        seasonal = np.where(np.isfinite(index) & (counts > 0), index, 1.0)
+
+    # Exponentially smoothed level of the deseasonalized monthly totals
+    factors = seasonal[:, moy]
+    deseasonalized = np.divide(monthly, factors, out=np.zeros_like(monthly), where=factors > 0)
+    weights = ALPHA * (1 - ALPHA) ** np.arange(months_completed - 2, -1, -1)
+    level = deseasonalized[:, 1:] @ weights + deseasonalized[:, 0] * (1 - ALPHA) ** (months_completed - 1)
+
+    # Cumulative share of a month's spending by day-of-month (rent on the 1st,
+    # groceries spread out), averaged over closed months that had spending
+    closed_days = month_starts[months_completed] if months_completed < len(month_starts) else daily.shape[1]
+    day_month = np.repeat(np.arange(months_completed), np.diff(np.r_[month_starts[:months_completed], closed_days]))
+    per_day_total = monthly[:, day_month]
+    share = np.divide(daily[:, :closed_days], per_day_total,
+                      out=np.zeros_like(per_day_total), where=per_day_total > 0)
+    dom = (days[:closed_days] - months[:closed_days].astype("datetime64[D]")).astype(int)
+    active = (monthly > 0).sum(axis=1)
+    cumulative = np.cumsum(share @ np.eye(31)[dom], axis=1)
+    profile = np.where(active[:, None] > 0, cumulative / np.maximum(active, 1)[:, None], np.nan)
+    return level, seasonal, profile
+
+
+class SpendingForecaster(trackers.Tracker):
+    """Daily per-category spending matrix with a cached model per category.
+
+    New expenses only touch one cell of the matrix and mark the category
+    for refitting; the model is refit for dirty categories on the next
+    forecast, and for everything when the month rolls over.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+
+    def load(self, db: Session) -> None:
+        today = date.today()
+        end = _month_end(today)
+        (_, days, amounts, cats), self.version, self.journal_id = trackers.get("columns", db).read(db, None, end)
+        first = columnar.EPOCH + timedelta(days=int(days[0])) if len(days) else today
+        self._start = _month_start(first)
+        self._end = end
+        self._month = (today.year, today.month)
+        keys, rows = np.unique(cats, return_inverse=True)
+        self._rows: Dict[int, int] = {int(category_id): i for i, category_id in enumerate(keys)}
+        self._daily = np.zeros((len(self._rows), (end - self._start).days + 1))
+        np.add.at(self._daily, (rows, days - columnar.day_number(self._start)), amounts)
+        self._months_completed = (today.year - self._start.year) * 12 + today.month - self._start.month
+        self._level, self._seasonal, self._profile = fit(self._daily, self._start, self._months_completed)
+        self._dirty = set()
+
+    def apply(self, old, new) -> None:
+        with self._lock:
+            if old is not None:
+                self._add(old.category_id, old.date, -old.amount)
+            if new is not None:
+                self._add(new.category_id, new.date, new.amount)
+
+    def _add(self, category_id: int, day: date, amount: float) -> None:
+        if self.stale or day > self._end:
+            return
+        if day < self._start:
+            self.stale = True  # before the matrix starts; the next get() reloads
+            return
+        row = self._rows.get(category_id)
+        if row is None:
+            row = self._rows[category_id] = len(self._rows)
+            self._daily = np.vstack([self._daily, np.zeros((1, self._daily.shape[1]))])
+            self._level = np.append(self._level, 0.0)
+            self._seasonal = np.vstack([self._seasonal, np.ones((1, 12))])
+            self._profile = np.vstack([self._profile, np.full((1, 31), np.nan)])
+        self._daily[row, (day - self._start).days] += amount
+        if day < _month_start(self._end):
+            self._dirty.add(row)
+
+    def forecast(self, db: Session) -> ForecastResponse:
+        today = date.today()
+        if self.stale or self._month != (today.year, today.month):
+            # Reloaded by get(), outside trackers.lock
+            trackers.invalidate("forecast", db)
+            return trackers.get("forecast", db).forecast(db)
+        with self._lock:
+            if self._dirty:
+                rows = sorted(self._dirty)
+                level, seasonal, profile = fit(self._daily[rows], self._start, self._months_completed)
+                self._level[rows], self._seasonal[rows], self._profile[rows] = level, seasonal, profile
+                self._dirty.clear()
+
+            month_start = _month_start(today)
+            cur = (month_start - self._start).days
+            year_start = max((date(today.year, 1, 1) - self._start).days, 0)
+            spent = self._daily[:, cur:].sum(axis=1)
+            spent_ytd = self._daily[:, year_start:cur].sum(axis=1)
+            days_in_month = calendar.monthrange(today.year, today.month)[1]
+            elapsed = self._profile[:, today.day - 1]
+            elapsed = np.where(np.isnan(elapsed), today.day / days_in_month, np.minimum(elapsed, 1.0))
+
+            expected = self._level[:, None] * self._seasonal
+            month_end = spent + expected[:, today.month - 1] * (1 - elapsed)
+            year_end = spent_ytd + month_end + expected[:, today.month:].sum(axis=1)
+            rows = list(self._rows.items())
+
+        lookup = registry.get(db)
+        names = lookup.category_names()
+        monthly_salary = lookup.salary_for(today.year, today.month)
+        categories: List[CategoryForecast] = [
+            CategoryForecast(
+                category_id=category_id, category_name=names.get(category_id),
+                spent_to_date=round(float(spent[row]), 2),
+                projected_month_end=round(float(month_end[row]), 2),
+                projected_year_end=round(float(year_end[row]), 2)
+            )
+            for category_id, row in rows if category_id in names
+        ]
+        total_month = float(sum(c.projected_month_end for c in categories))
+        savings_rate = (monthly_salary - total_month) / monthly_salary * 100 if monthly_salary > 0 else 0
+        return ForecastResponse(
+            as_of=today, month=f"{calendar.month_name[today.month]} {today.year}",
+            monthly_salary=monthly_salary,
+            spent_to_date=round(sum(c.spent_to_date for c in categories), 2),
+            projected_month_end=round(total_month, 2),
+            projected_year_end=round(sum(c.projected_year_end for c in categories), 2),
+            predicted_savings_rate=round(savings_rate, 2),
+            predicted_status=status_for_savings_rate(savings_rate),
+            categories=categories
+        )
+
+
+trackers.register("forecast", SpendingForecaster)
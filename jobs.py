@@ -0,0 +1,313 @@
+# SoloWealth - Personal Finance Tracker
+# jobs.py - Long-running reports and exports in a process pool
+
+import json
+import multiprocessing
+import os
+import re
+import threading
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from datetime import date, datetime
+from typing import Dict, Optional
+
+from sqlalchemy.engine import Engine
+from sqlalchemy.orm import Session
+
+import archive
+import columnar
+import reports
+import trackers
+from models import JobCreate, JobKind, JobResponse, JobStatus, SessionLocal, data_versions
+from profiles import create_read_only_engine, database_path
+from trackers import SHARED
+
+MAX_WORKERS = int(os.environ.get("SOLOWEALTH_JOB_WORKERS", "2"))
+# Finished jobs (and their results) kept for polling and reuse
+MAX_JOBS = 100
+
+# data_versions counters each kind reads; a finished job is handed out
+# again instead of recomputing while none of them has moved
+DEPENDS_ON = {
+    JobKind.MONTHLY_REPORTS: ("epoch", "expenses", "categories", "config", "config_history"),
+    JobKind.EXPORT: ("epoch", "expenses", "categories"),
+}
+
+
+class JobError(Exception):
+    pass
+
+
+class JobNotFound(JobError):
+    pass
+
+
+class JobCancelled(Exception):
+    pass
+
+
+JOB_ID = re.compile(r"^[0-9a-f]{32}$")
+
+
+def _folder(path: str) -> str:
+    folder = os.path.splitext(path)[0] + ".jobs"
+    os.makedirs(folder, exist_ok=True)
+    return folder
+
+
+class CancelToken:
+    """Cancellation flag handed to a job: set here through a manager event,
+    or by another server process through a marker file"""
+
+    def __init__(self, event, marker: str):
+        self.event = event
+        self.marker = marker
+
+    def set(self) -> None:
+        self.event.set()
+
+    def is_set(self) -> bool:
+        return self.event.is_set() or os.path.exists(self.marker)
+
+
+# Worker side: runs in the pool processes against read-only connections
+_engines: Dict[str, Engine] = {}
+
+
+def _session(path: str) -> Session:
+    engine = _engines.get(path)
+    if engine is None:
+        engine = _engines[path] = create_read_only_engine(path)
+        archive.install(engine, read_only=True)
+    db = SessionLocal(bind=engine)
+    # Nothing is dispatched to trackers in a worker, so start every job fresh
+    trackers.reset(db)
+    return db
+
+
+def _monthly_reports(path: str, from_year: int, to_year: int, cancel) -> list:
+    db = _session(path)
+    try:
+        result = []
+        for year in range(from_year, to_year + 1):
+            if cancel.is_set():
+                raise JobCancelled()
+            result.extend(r.dict() for r in reports.monthly_reports(db, year, load=columnar.sql_expenses))
+        return result
+    finally:
+        db.close()
+
+
+def _export(path: str, output: str, cancel) -> dict:
+    db = _session(path)
+    try:
+        rows = reports.write_export(db, output, cancelled=cancel.is_set)
+    finally:
+        db.close()
+    if cancel.is_set():
+        os.remove(output)
+        raise JobCancelled()
+    return {"rows": rows, "path": output}
+
+
+# Server side
+class Job:
+    def __init__(self, kind: JobKind, path: str, key: tuple):
+        self.id = uuid.uuid4().hex
+        self.kind = kind
+        self.path = path
+        self.key = key
+        self.created_at = datetime.utcnow()
+        self.finished_at: Optional[datetime] = None
+        self.future = None
+        self.cancel: Optional[CancelToken] = None
+        self.output: Optional[str] = None
+
+    def state_path(self) -> str:
+        return os.path.join(_folder(self.path), f"{self.id}.json")
+
+    def status(self) -> JobStatus:
+        # A job that finished keeps its outcome, whatever was asked of it later
+        if self.future.cancelled():
+            return JobStatus.CANCELLED
+        if self.future.done():
+            error = self.future.exception()
+            if isinstance(error, JobCancelled):
+                return JobStatus.CANCELLED
+            return JobStatus.FAILED if error else JobStatus.DONE
+        if self.cancel.is_set():
+            return JobStatus.CANCELLED
+        return JobStatus.RUNNING if self.future.running() else JobStatus.PENDING
+
+    def info(self, cached: bool = False) -> JobResponse:
+        status = self.status()
+        error = None
+        if status == JobStatus.FAILED:
+            exception = self.future.exception()
+            error = str(exception) or type(exception).__name__
+        return JobResponse(id=self.id, kind=self.kind, status=status, cached=cached,
+                           created_at=self.created_at, finished_at=self.finished_at, error=error)
+
+    def result(self):
+        return self.future.result()
+
+    def stop(self) -> None:
+        if self.future.done():
+            return
+        if not self.future.cancel():
+            self.cancel.set()
+
+    def publish(self) -> None:
+        """Write the job's state (and result) where the other server processes can read it"""
+        info = self.info()
+        state = dict(info.dict(exclude={"cached"}), path=self.path)
+        state.update(created_at=info.created_at.isoformat(),
+                     finished_at=info.finished_at.isoformat() if info.finished_at else None)
+        if info.status == JobStatus.DONE:
+            state["result"] = self.result()
+        partial = self.state_path() + ".partial"
+        with open(partial, "w", encoding="utf-8") as f:
+            json.dump(state, f, default=str)
+        os.replace(partial, self.state_path())
+
+
+class PublishedJob:
+    """A job run by another server process, as it last published itself"""
+
+    def __init__(self, state: dict, marker: str):
+        self.state = state
+        self.path = state["path"]
+        self.marker = marker
+
+    def status(self) -> JobStatus:
+        status = JobStatus(self.state["status"])
+        if status in (JobStatus.PENDING, JobStatus.RUNNING) and os.path.exists(self.marker):
+            return JobStatus.CANCELLED
+        return status
+
+    def info(self, cached: bool = False) -> JobResponse:
+        return JobResponse(**dict(self.state, status=self.status(), cached=cached))
+
+    def result(self):
+        return self.state["result"]
+
+    def stop(self) -> None:
+        if self.status() in (JobStatus.PENDING, JobStatus.RUNNING):
+            open(self.marker, "a").close()
+
+    @classmethod
+    def find(cls, path: str, job_id: str) -> Optional["PublishedJob"]:
+        folder = _folder(path)
+        try:
+            with open(os.path.join(folder, f"{job_id}.json"), "r", encoding="utf-8") as f:
+                state = json.load(f)
+        except (OSError, ValueError):
+            return None
+        return cls(state, os.path.join(folder, f"{job_id}.cancel"))
+
+
+class JobManager:
+    """Runs jobs in a lazily started process pool and keeps their results.
+
+    Workers use the spawn start method on every platform (the frozen
+    Windows build has no fork), so anything they run must be importable
+    and picklable. Cancellation stops a pending job outright and asks a
+    running one to stop at its next checkpoint.
+
+    With several server processes a poll may land on a process that did
+    not submit the job, so each job then publishes its state and result
+    to `<ledger>.jobs/<id>.json`, and is cancelled there by a marker file.
+    """
+
+    def __init__(self, max_workers: int = MAX_WORKERS):
+        self.max_workers = max_workers
+        self._executor: Optional[ProcessPoolExecutor] = None
+        self._manager = None
+        self._jobs: "OrderedDict[str, Job]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _pool(self) -> ProcessPoolExecutor:
+        if self._executor is None:
+            context = multiprocessing.get_context("spawn")
+            self._manager = context.Manager()
+            self._executor = ProcessPoolExecutor(self.max_workers, mp_context=context)
+        return self._executor
+
+    def submit(self, db: Session, request: JobCreate) -> JobResponse:
+        path = database_path(db.get_bind())
+        params = ()
+        if request.kind == JobKind.MONTHLY_REPORTS:
+            to_year = request.to_year or date.today().year
+            from_year = request.from_year or to_year
+            if from_year > to_year:
+                raise JobError("from_year must not be after to_year")
+            params = (from_year, to_year)
+        versions = data_versions(db, *DEPENDS_ON[request.kind])
+        key = (request.kind, params, tuple(sorted(versions.items())))
+        with self._lock:
+            for job in self._jobs.values():
+                if job.path == path and job.key == key and job.status() not in (JobStatus.FAILED, JobStatus.CANCELLED):
+                    return job.info(cached=True)
+            job = Job(request.kind, path, key)
+            pool = self._pool()
+            job.cancel = CancelToken(self._manager.Event(), os.path.join(_folder(path), f"{job.id}.cancel"))
+            if request.kind == JobKind.MONTHLY_REPORTS:
+                job.future = pool.submit(_monthly_reports, path, *params, job.cancel)
+            else:
+                job.output = os.path.join(_folder(path), f"{job.id}.csv")
+                job.future = pool.submit(_export, path, job.output, job.cancel)
+            job.future.add_done_callback(lambda _, job=job: self._finished(job))
+            self._jobs[job.id] = job
+            if SHARED:
+                job.publish()
+            self._evict()
+            return job.info()
+
+    def _finished(self, job: Job) -> None:
+        job.finished_at = datetime.utcnow()
+        if SHARED:
+            job.publish()
+
+    def get(self, db: Session, job_id: str):
+        path = database_path(db.get_bind())
+        with self._lock:
+            job = self._jobs.get(job_id)
+        if job is None and SHARED and JOB_ID.match(job_id):
+            job = PublishedJob.find(path, job_id)
+        if job is None or job.path != path:
+            raise JobNotFound("Job not found")
+        return job
+
+    def result(self, db: Session, job_id: str):
+        job = self.get(db, job_id)
+        status = job.status()
+        if status != JobStatus.DONE:
+            raise JobError(f"Job is {status.value}")
+        return job.result()
+
+    def cancel(self, db: Session, job_id: str) -> JobResponse:
+        job = self.get(db, job_id)
+        job.stop()
+        return job.info()
+
+    def _evict(self) -> None:
+        finished = [job for job in self._jobs.values() if job.future.done()]
+        for job in finished[:max(0, len(self._jobs) - MAX_JOBS)]:
+            del self._jobs[job.id]
+            for leftover in (job.output, job.state_path(), job.cancel.marker):
+                if leftover and os.path.exists(leftover):
+                    os.remove(leftover)
+
+    def shutdown(self) -> None:
+        with self._lock:
+            if self._executor is None:
+                return
+            for job in self._jobs.values():
+                job.cancel.set()
+            self._executor.shutdown(wait=True, cancel_futures=True)
+            self._manager.shutdown()
+            self._executor = self._manager = None
+
+
+job_manager = JobManager()
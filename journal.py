@@ -0,0 +1,236 @@
+# SoloWealth - Personal Finance Tracker
+# journal.py - Change journal of every write, with undo and point-in-time reads
+
+import json
+import os
+import uuid
+from datetime import date, datetime, timedelta, timezone
+from typing import Dict, List, Optional
+
+from sqlalchemy import Date, DateTime, delete, event, insert, inspect, select
+from sqlalchemy.orm import Session
+
+import archive
+import trackers
+from models import (
+    BudgetDB, CategoryDB, CategoryRuleDB, ChangeJournalDB, ConfigDB, ConfigHistoryDB, DebtDB, ExpenseDB, InvestmentDB,
+    JournalEntry
+)
+
+# Oldest entries are compacted away past either bound
+KEEP_DAYS = int(os.environ.get("SOLOWEALTH_JOURNAL_DAYS", "90"))
+MAX_ROWS = int(os.environ.get("SOLOWEALTH_JOURNAL_MAX_ROWS", "100000"))
+COMPACT_EVERY = 500  # journaled flushes between automatic compactions, per process
+
+MODELS = {model.__tablename__: model for model in (
+    ExpenseDB, InvestmentDB, DebtDB, CategoryDB, ConfigDB, ConfigHistoryDB, BudgetDB, CategoryRuleDB
+)}
+J = ChangeJournalDB
+# Replication stamps, rewritten by every write including an undo, so they
+# say nothing about whether a row was changed by the user since
+SYNC_COLUMNS = ("hlc", "sync_seq")
+
+
+class JournalError(Exception):
+    pass
+
+
+def encode(value):
+    return value.isoformat() if isinstance(value, (date, datetime)) else value
+
+
+def decode(model, image: dict) -> dict:
+    values = {}
+    for attr in inspect(model).column_attrs:
+        if attr.key not in image:
+            continue
+        value, column_type = image[attr.key], attr.columns[0].type
+        if value is not None and isinstance(column_type, DateTime):
+            value = datetime.fromisoformat(value)
+        elif value is not None and isinstance(column_type, Date):
+            value = date.fromisoformat(value)
+        values[attr.key] = value
+    return values
+
+
+def image(obj, old: bool = False) -> dict:
+    """Column values of an ORM object as JSON-ready data, before the pending flush when `old`"""
+    state = inspect(obj)
+    values = {}
+    for attr in state.mapper.column_attrs:
+        if old:
+            history = state.attrs[attr.key].history
+            value = history.deleted[0] if history.deleted else (
+                history.unchanged[0] if history.unchanged else getattr(obj, attr.key))
+        else:
+            value = getattr(obj, attr.key)
+        values[attr.key] = encode(value)
+    return values
+
+
+def _row_image(row) -> dict:
+    return {key: encode(value) for key, value in row._mapping.items()}
+
+
+# Capture: one batched INSERT per flush, in the flushing transaction
+@event.listens_for(Session, "after_flush")
+def _record(session, flush_context):
+    entries = []
+    txn = session.info.setdefault("journal_txn", uuid.uuid4().hex)
+    undo_of = session.info.get("journal_undo_of")
+    now = datetime.utcnow()
+
+    def add(obj, op, before, after):
+        entries.append(dict(txn=txn, undo_of=undo_of, table_name=obj.__tablename__, row_id=obj.id, op=op,
+                            before=json.dumps(before) if before else None,
+                            after=json.dumps(after) if after else None, created_at=now))
+
+    for obj in session.new:
+        if obj.__tablename__ in MODELS:
+            add(obj, "insert", None, image(obj))
+    for obj in session.dirty:
+        if obj.__tablename__ in MODELS and session.is_modified(obj):
+            add(obj, "update", image(obj, old=True), image(obj))
+    for obj in session.deleted:
+        if obj.__tablename__ in MODELS:
+            add(obj, "delete", image(obj, old=True), None)
+    if entries:
+        # Core insert: the ORM bulk path costs more than the statement itself
+        ids = session.execute(insert(J.__table__).returning(J.__table__.c.id), entries).scalars().all()
+        if any(entry["table_name"] == "expenses" for entry in entries):
+            # Lets trackers replay later journal entries from exactly here
+            session.info["journal_id"] = max(ids)
+        global _flushes
+        _flushes += 1
+        if _flushes % COMPACT_EVERY == 0:
+            _compact(session, KEEP_DAYS, MAX_ROWS)
+
+
+@event.listens_for(Session, "after_commit")
+def _end_transaction(session):
+    session.info.pop("journal_txn", None)
+    session.info.pop("journal_undo_of", None)
+
+
+@event.listens_for(Session, "after_soft_rollback")
+def _discard(session, previous_transaction):
+    session.info.pop("journal_txn", None)
+    session.info.pop("journal_undo_of", None)
+
+
+_flushes = 0
+
+
+def _compact(db: Session, keep_days: int, max_rows: int) -> int:
+    cutoff = datetime.utcnow() - timedelta(days=keep_days)
+    overflow = db.execute(select(J.created_at).order_by(J.id.desc()).offset(max_rows).limit(1)).scalar()
+    if overflow is not None:
+        cutoff = max(cutoff, overflow)
+    old = select(J.txn).where(J.created_at <= cutoff, J.op != "compacted")
+    removed = db.execute(delete(J).where(J.txn.in_(old))).rowcount
+    if removed:
+        db.execute(delete(J).where(J.op == "compacted"))
+        db.execute(insert(J).values(txn="", table_name="", row_id=0, op="compacted", created_at=cutoff))
+    return removed
+
+
+def compact(db: Session, keep_days: int = KEEP_DAYS, max_rows: int = MAX_ROWS) -> int:
+    """Drop whole transactions older than `keep_days` or beyond the newest `max_rows` entries.
+
+    Also runs every COMPACT_EVERY journaled flushes. A 'compacted' marker
+    records the horizon so as-of reads before it are refused.
+    """
+    removed = _compact(db, keep_days, max_rows)
+    db.commit()
+    return removed
+
+
+def horizon(db: Session) -> Optional[datetime]:
+    return db.execute(select(J.created_at).where(J.op == "compacted")).scalar()
+
+
+def recent(db: Session, limit: int = 50) -> List[JournalEntry]:
+    rows = db.query(J).filter(J.op != "compacted").order_by(J.id.desc()).limit(limit).all()
+    return [JournalEntry(
+        id=r.id, txn=r.txn, undo_of=r.undo_of, table_name=r.table_name, row_id=r.row_id, op=r.op,
+        before=json.loads(r.before) if r.before else None, after=json.loads(r.after) if r.after else None,
+        created_at=r.created_at
+    ) for r in rows]
+
+
+def undo(db: Session) -> tuple:
+    """Revert the newest transaction that is neither an undo nor undone already.
+
+    Changes are replayed backwards through the ORM, so trackers, rollups
+    and the registry follow, and the undo is itself journaled.
+    """
+    undone = select(J.undo_of).where(J.undo_of.is_not(None))
+    txn = db.execute(
+        select(J.txn).where(J.undo_of.is_(None), J.op != "compacted", J.txn.not_in(undone))
+        .order_by(J.id.desc()).limit(1)
+    ).scalar()
+    if txn is None:
+        raise JournalError("Nothing to undo")
+    entries = db.query(J).filter(J.txn == txn).order_by(J.id.desc()).all()
+    archived = trackers.get("archive", db).years
+    db.info["journal_undo_of"] = txn
+    try:
+        _revert(db, entries, archived)
+    except JournalError:
+        db.rollback()
+        raise
+    db.commit()
+    return txn, len(entries)
+
+
+def _revert(db: Session, entries: List[ChangeJournalDB], archived: Dict[int, int]) -> None:
+    for entry in entries:
+        model = MODELS[entry.table_name]
+        obj = db.get(model, entry.row_id)
+        if entry.op == "insert":
+            if obj is None:
+                raise JournalError(f"{entry.table_name} #{entry.row_id} no longer exists")
+            db.delete(obj)
+            continue
+        before = json.loads(entry.before)
+        if entry.op == "update":
+            if obj is None or _content(image(obj)) != _content(json.loads(entry.after)):
+                raise JournalError(f"{entry.table_name} #{entry.row_id} changed since")
+            for key, value in decode(model, before).items():
+                setattr(obj, key, value)
+        else:
+            if obj is not None:
+                raise JournalError(f"{entry.table_name} #{entry.row_id} already exists")
+            values = decode(model, before)
+            if model is ExpenseDB and values["date"].year in archived:
+                raise JournalError(f"Expense #{entry.row_id} belongs to an archived year")
+            db.add(model(**values))
+        db.flush()
+
+
+def _content(values: dict) -> dict:
+    return {key: value for key, value in values.items() if key not in SYNC_COLUMNS}
+
+
+def as_of(db: Session, table_name: str, at: datetime) -> List[dict]:
+    """Rows of a table as they were at `at` (UTC), rebuilt from today's rows and the journal"""
+    if at.tzinfo is not None:
+        at = at.astimezone(timezone.utc).replace(tzinfo=None)
+    model = MODELS.get(table_name)
+    if model is None:
+        raise JournalError(f"Table '{table_name}' is not journaled")
+    cutoff = horizon(db)
+    if cutoff is not None and at < cutoff:
+        raise JournalError(f"The journal only reaches back to {cutoff.isoformat()}")
+    source = archive.expense_source(db) if model is ExpenseDB else model.__table__
+    rows: Dict[int, dict] = {row.id: _row_image(row) for row in db.execute(select(source))}
+    later = db.execute(
+        select(J.row_id, J.op, J.before).where(J.table_name == table_name, J.created_at > at).order_by(J.id.desc())
+    )
+    for row_id, op, before in later:
+        if op == "insert":
+            rows.pop(row_id, None)
+        else:
+            rows[row_id] = json.loads(before)
+    return [rows[key] for key in sorted(rows)]
+
@@ -0,0 +1,260 @@
+# SoloWealth - Personal Finance Tracker
+# loadtest.py - Concurrency and load test harness for the local backend
+#
+#   python loadtest.py                       # every scenario, 16 clients, 10 s each
+#   python loadtest.py --scenario import --clients 32 --duration 30
+#   python loadtest.py --db copy-of-finance.db --json results.json
+#
+# The app runs in-process under uvicorn on a free port against a temporary
+# database (or a copy of the one given with --db), so it is safe to run
+# next to a live install and needs no network access.
+
+import argparse
+import http.client
+import json
+import os
+import random
+import shutil
+import socket
+import sys
+import tempfile
+import threading
+import time
+from collections import defaultdict
+from datetime import date, timedelta
+
+SCENARIOS = {
+    # UI refresh storm: every client reloads the dashboard views at once
+    "refresh": [
+        (5, "GET", "/api/dashboard"), (5, "GET", "/api/expenses"), (3, "GET", "/api/categories"),
+        (2, "GET", "/api/reports/monthly"), (2, "GET", "/api/budgets/status"), (1, "GET", "/api/forecast"),
+        (1, "GET", "/api/analytics/breakdown?group=week"),
+    ],
+    # Bulk import: many concurrent single-row writes
+    "import": [
+        (8, "POST", "/api/expenses"), (1, "PUT", "/api/expenses/{id}"), (1, "GET", "/api/dashboard"),
+    ],
+    # Exports running while the UI keeps writing
+    "export": [
+        (2, "GET", "/api/export"), (4, "POST", "/api/expenses"), (4, "GET", "/api/expenses"),
+    ],
+    "mixed": [
+        (6, "GET", "/api/dashboard"), (6, "GET", "/api/expenses"), (2, "GET", "/api/reports/monthly"),
+        (5, "POST", "/api/expenses"), (1, "PUT", "/api/expenses/{id}"), (1, "DELETE", "/api/expenses/{id}"),
+        (1, "GET", "/api/export"), (1, "GET", "/api/insights/anomalies"),
+    ],
+}
+# Statuses that do not count as errors. A PUT or DELETE may pick an expense
+# another client has just deleted, and the 404 it gets is the right answer.
+EXPECTED = {"PUT": (200, 404), "DELETE": (200, 404)}
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def percentile(values, p):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(p / 100 * (len(ordered) - 1))))]
+
+
+class Stats:
+    def __init__(self):
+        self.latencies = defaultdict(list)
+        self.errors = defaultdict(int)
+        self.statuses = defaultdict(int)
+        self.lock = threading.Lock()
+
+    def record(self, name, seconds, status, expected=(200,)):
+        with self.lock:
+            self.latencies[name].append(seconds * 1000)
+            self.statuses[status] += 1
+            if status not in expected:
+                self.errors[name] += 1
+
+
+class Client:
+    """One keep-alive HTTP connection, like a browser tab or script"""
+
+    def __init__(self, port, rng, category_ids, expense_ids):
+        self.port = port
+        self.rng = rng
+        self.category_ids = category_ids
+        self.expense_ids = expense_ids
+        self.conn = http.client.HTTPConnection("127.0.0.1", port, timeout=60)
+
+    def request(self, method, path):
+        body, headers = None, {}
+        if "{id}" in path:
+            # With every expense deleted, ask for one that does not exist
+            expense_id = self.rng.choice(self.expense_ids) if self.expense_ids else 0
+            path = path.replace("{id}", str(expense_id))
+            if method == "DELETE":
+                try:
+                    self.expense_ids.remove(expense_id)
+                except ValueError:
+                    pass
+        if method in ("POST", "PUT"):
+            payload = {"amount": round(self.rng.uniform(1, 500), 2)}
+            if method == "POST":
+                payload.update(date=(date.today() - timedelta(days=self.rng.randint(0, 730))).isoformat(),
+                               category_id=self.rng.choice(self.category_ids), notes="loadtest")
+            body, headers = json.dumps(payload), {"Content-Type": "application/json"}
+        try:
+            self.conn.request(method, path, body=body, headers=headers)
+            response = self.conn.getresponse()
+            data = response.read()
+        except (OSError, http.client.HTTPException):
+            self.conn.close()
+            self.conn = http.client.HTTPConnection("127.0.0.1", self.port, timeout=60)
+            return None
+        if method == "POST" and response.status == 200:
+            self.expense_ids.append(json.loads(data)["id"])
+        return response.status
+
+
+def run_scenario(name, port, clients, duration, category_ids, expense_ids, lock_errors):
+    mix = SCENARIOS[name]
+    weights = [w for w, _, _ in mix]
+    stats = Stats()
+    deadline = time.perf_counter() + duration
+    locks_before = lock_errors["count"]
+
+    def worker(seed):
+        rng = random.Random(seed)
+        client = Client(port, rng, category_ids, expense_ids)
+        while time.perf_counter() < deadline:
+            _, method, path = rng.choices(mix, weights)[0]
+            start = time.perf_counter()
+            status = client.request(method, path)
+            stats.record(f"{method} {path.split('?')[0]}", time.perf_counter() - start, status,
+                         EXPECTED.get(method, (200,)))
+        client.conn.close()
+
+    started = time.perf_counter()
+    threads = [threading.Thread(target=worker, args=(i,)) for i in range(clients)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.perf_counter() - started
+
+    endpoints = {}
+    for endpoint, values in sorted(stats.latencies.items()):
+        endpoints[endpoint] = {
+            "requests": len(values), "errors": stats.errors[endpoint],
+            "p50_ms": round(percentile(values, 50), 1), "p95_ms": round(percentile(values, 95), 1),
+            "p99_ms": round(percentile(values, 99), 1), "max_ms": round(max(values), 1),
+        }
+    everything = [v for values in stats.latencies.values() for v in values]
+    total = len(everything)
+    errors = sum(stats.errors.values())
+    return {
+        "scenario": name, "clients": clients, "seconds": round(elapsed, 2), "requests": total,
+        "throughput_rps": round(total / elapsed, 1) if elapsed else 0.0,
+        "error_rate": round(errors / total, 4) if total else 0.0,
+        "lock_errors": lock_errors["count"] - locks_before,
+        "statuses": {str(k): v for k, v in sorted(stats.statuses.items(), key=lambda kv: str(kv[0]))},
+        "p50_ms": round(percentile(everything, 50), 1), "p95_ms": round(percentile(everything, 95), 1),
+        "p99_ms": round(percentile(everything, 99), 1),
+        "endpoints": endpoints,
+    }
+
+
+def print_report(result):
+    print(f"\n== {result['scenario']}: {result['clients']} clients, {result['seconds']} s ==")
+    print(f"requests {result['requests']}  throughput {result['throughput_rps']} req/s  "
+          f"error rate {result['error_rate'] * 100:.2f}%  'database is locked' {result['lock_errors']}")
+    print(f"latency p50 {result['p50_ms']} ms  p95 {result['p95_ms']} ms  p99 {result['p99_ms']} ms  "
+          f"statuses {result['statuses']}")
+    print(f"{'endpoint':<40}{'reqs':>7}{'errs':>6}{'p50':>9}{'p95':>9}{'p99':>9}{'max':>9}")
+    for endpoint, s in result["endpoints"].items():
+        print(f"{endpoint:<40}{s['requests']:>7}{s['errors']:>6}{s['p50_ms']:>9}{s['p95_ms']:>9}"
+              f"{s['p99_ms']:>9}{s['max_ms']:>9}")
+
+
+def seed(db_module, engine, rows):
+    from models import CategoryDB, ExpenseDB
+    db = db_module.Session(engine)
+    try:
+        category_ids = [c.id for c in db.query(CategoryDB).all()]
+        existing = db.query(ExpenseDB).count()
+        rng = random.Random(42)
+        today = date.today()
+        for start in range(existing, rows, 5000):
+            db.add_all(ExpenseDB(date=today - timedelta(days=rng.randint(0, 365 * 3)),
+                                 amount=round(rng.uniform(1, 500), 2), category_id=rng.choice(category_ids),
+                                 notes="seed") for _ in range(min(5000, rows - start)))
+            db.commit()
+        expense_ids = [row[0] for row in db.query(ExpenseDB.id).all()]
+    finally:
+        db.close()
+    return category_ids, expense_ids
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test the SoloWealth backend in-process")
+    parser.add_argument("--scenario", choices=sorted(SCENARIOS) + ["all"], default="all")
+    parser.add_argument("--clients", type=int, default=16)
+    parser.add_argument("--duration", type=float, default=10.0, help="seconds per scenario")
+    parser.add_argument("--seed-rows", type=int, default=5000, help="expenses in the test database")
+    parser.add_argument("--db", help="copy this database instead of starting empty")
+    parser.add_argument("--json", help="also write the results to this file")
+    args = parser.parse_args()
+    output = os.path.abspath(args.json) if args.json else None
+
+    workdir = tempfile.mkdtemp(prefix="solowealth-loadtest-")
+    db_path = os.path.join(workdir, "finance.db")
+    if args.db:
+        shutil.copy2(args.db, db_path)
+    # Must be set before main/profiles are imported
+    os.environ["SOLOWEALTH_DB"] = db_path
+    os.environ["SOLOWEALTH_CONFIG"] = os.path.join(workdir, "solowealth.json")
+    os.environ["SOLOWEALTH_BACKUP_INTERVAL_HOURS"] = "0"
+    os.environ.pop("SOLOWEALTH_PROFILES", None)
+    os.chdir(workdir)
+
+    import uvicorn
+    from sqlalchemy import event
+    import main as app_module
+
+    port = free_port()
+    server = uvicorn.Server(uvicorn.Config(app_module.app, host="127.0.0.1", port=port, log_level="warning"))
+    thread = threading.Thread(target=server.run, daemon=True)
+    thread.start()
+    while not server.started:
+        time.sleep(0.05)
+
+    engine = app_module.engine_pool.engine()
+    lock_errors = {"count": 0}
+
+    @event.listens_for(engine, "handle_error")
+    def _count_locks(context):
+        if "database is locked" in str(context.original_exception):
+            lock_errors["count"] += 1
+
+    print(f"Seeding {args.seed_rows} expenses in {db_path} ...")
+    category_ids, expense_ids = seed(app_module, engine, args.seed_rows)
+
+    results = []
+    try:
+        for name in (sorted(SCENARIOS) if args.scenario == "all" else [args.scenario]):
+            result = run_scenario(name, port, args.clients, args.duration, category_ids, expense_ids, lock_errors)
+            print_report(result)
+            results.append(result)
+    finally:
+        server.should_exit = True
+        thread.join(timeout=30)
+    if output:
+        with open(output, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2)
+    shutil.rmtree(workdir, ignore_errors=True)
+    return 1 if any(r["lock_errors"] or r["error_rate"] for r in results) else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -11,34 +11,65 @@ if sys.stdout is None:
 if sys.stderr is None:
     sys.stderr = io.StringIO()
 
-import csv
+# Spawned server workers run this file as __mp_main__ and then import main:app;
+# make both the same module so the app is only set up once per process
+if __name__ == "__mp_main__":
+    sys.modules.setdefault("main", sys.modules[__name__])
+
+import multiprocessing
 import os
-from datetime import date, datetime
+import tempfile
+from datetime import date, datetime, timedelta
 from typing import List, Optional
-from calendar import month_name
+from calendar import month_name, monthrange
 
-from fastapi import FastAPI, Depends, HTTPException
-from fastapi.responses import HTMLResponse, FileResponse
+from fastapi import FastAPI, Body, Depends, HTTPException, Query, Request
+from fastapi.responses import HTMLResponse, FileResponse, Response
 from sqlalchemy.orm import Session
-from sqlalchemy import extract
+from sqlalchemy import extract, select
+from starlette.background import BackgroundTask
 
 from models import (
-    ConfigDB, CategoryDB, ExpenseDB, InvestmentDB, DebtDB,
-    ConfigUpdate, ConfigResponse, CategoryCreate, CategoryResponse,
-    ExpenseCreate, ExpenseUpdate, ExpenseResponse,
+    ConfigDB, ConfigHistoryDB, CategoryDB, ExpenseDB, InvestmentDB, DebtDB, BudgetDB, CategoryRuleDB,
+    ConfigUpdate, ConfigResponse, ConfigHistoryResponse, CategoryCreate, CategoryResponse, ArchivedYearResponse,
+    ExpenseCreate, ExpenseUpdate, ExpenseResponse, RecategorizeRequest, RecategorizeResult,
+    CategoryRuleCreate, CategoryRuleResponse, ClassifyResult,
     InvestmentCreate, InvestmentResponse,
     DebtCreate, DebtUpdate, DebtResponse,
-    DashboardStats, FixedExpenseSuggestion, MonthlyReport, StatusEnum,
-    init_db, get_db, engine
+    BudgetCreate, BudgetUpdate, BudgetResponse, BudgetStatus, BudgetPeriod,
+    BackupRequest, BackupInfo, RestoreRequest, ProfileInfo, JobCreate, JobResponse,
+    DashboardStats, FixedExpenseSuggestion, MonthlyReport, ForecastResponse, Anomaly,
+    BreakdownEntry, BreakdownGroup, JournalEntry, UndoResponse,
+    SyncPeerRequest, SyncStatus, SyncResult, SyncExchange,
+    status_for_savings_rate,
+    CONFIG_EPOCH, new_epoch, get_db
 )
+from profiles import engine_pool, ProfileMiddleware, WORKERS
+import trackers
+import registry
+import rules
+import reports
+import rollup
+import migrations
+import sync
+import journal
+import jobs
+import forecast  # noqa: F401  # registers trackers
+import budgets  # noqa: F401  # registers trackers
+import anomalies
+import backup
+import archive
+import writer
+import wire
 
 app = FastAPI(
     title="SoloWealth",
     description="Local-only Personal Finance Tracker",
     version="1.0.0"
 )
+app.add_middleware(ProfileMiddleware)
 
-def seed_database():
+def seed_database(engine):
     db = Session(engine)
     try:
         if db.query(ConfigDB).first() is not None:
@@ -49,6 +80,7 @@ def seed_database():
             ConfigDB(key="base_investments", value=200000.0, description="Initial investments"),
         ]
         db.add_all(configs)
+        db.add_all(ConfigHistoryDB(key=c.key, value=c.value, effective_from=CONFIG_EPOCH) for c in configs)
         categories = [
             CategoryDB(name="Rent", icon="home", is_fixed=False, default_amount=0.0),
             CategoryDB(name="Utilities", icon="zap", is_fixed=False, default_amount=0.0),
@@ -70,10 +102,67 @@ def seed_database():
     finally:
         db.close()
 
+def initialize_database(engine):
+    # A current schema costs one pragma read. Otherwise server workers may be
+    # opening the ledger at the same time; the first one to get the lock
+    # migrates (and for a new file seeds) it, the others then find it ready
+    if migrations.schema_version(engine) == migrations.latest():
+        return
+    with writer.FileLock(writer.lock_path(engine, "init")):
+        if migrations.upgrade(engine) == 0:
+            seed_database(engine)
+
+engine_pool.on_create.extend([writer.install, archive.install, initialize_database])
+engine_pool.on_dispose.append(writer.stop)
+# Only ledgers in use: opening the others would create, migrate and seed them, and evict live engines
+backup_scheduler = backup.BackupScheduler(engine_pool.open_engines)
+
 @app.on_event("startup")
 def startup_event():
-    init_db()
-    seed_database()
+    engine_pool.engine()
+    backup_scheduler.start()
+
+@app.on_event("shutdown")
+def shutdown_event():
+    backup_scheduler.stop()
+    writer.stop_all()
+    jobs.job_manager.shutdown()
+    trackers.flush_all()
+    engine_pool.dispose()
+
+def wire_format(request: Request) -> Optional[str]:
+    """Compact encoding the client asked for in Accept (see wire.py), None for plain JSON"""
+    try:
+        return wire.negotiate(request.headers.get("accept"))
+    except wire.WireError as e:
+        raise HTTPException(status_code=406, detail=str(e))
+
+def listing(request: Request, rows, model, categories=None):
+    """A list response: `rows` as they are for plain JSON, else encoded column by column.
+
+    Given `categories` ({id: name}), plain JSON rows get their category_name from it.
+    """
+    media_type = wire_format(request)
+    if media_type:
+        return wire.encode(media_type, wire.columns(rows, model, categories))
+    if categories is not None:
+        return [model(**row, category_name=categories.get(row["category_id"])) for row in rows]
+    return rows
+
+def month_span(day: date):
+    """First day of `day`'s month and of the month after, for `date >= start AND date < end`"""
+    start = day.replace(day=1)
+    return start, (start + timedelta(days=32)).replace(day=1)
+
+# Profile Endpoints
+@app.get("/api/profiles", response_model=List[ProfileInfo])
+def get_profiles():
+    open_engines = {str(e.url) for e in engine_pool.open_engines()}
+    return [
+        ProfileInfo(name=name, database=path, is_default=name == engine_pool.default,
+                    is_open=f"sqlite:///{path}" in open_engines)
+        for name, path in engine_pool.profiles.items()
+    ]
 
 # Config Endpoints
 @app.get("/api/config", response_model=List[ConfigResponse])
@@ -92,12 +181,29 @@ def update_config(key: str, config_update: ConfigUpdate, db: Session = Depends(g
     config = db.query(ConfigDB).filter(ConfigDB.key == key).first()
     if not config:
         raise HTTPException(status_code=404, detail=f"Config '{key}' not found")
-    config.value = config_update.value
+    effective_from = config_update.effective_from or date.today().replace(day=1)
+    entry = db.query(ConfigHistoryDB).filter(
+        ConfigHistoryDB.key == key, ConfigHistoryDB.effective_from == effective_from
+    ).first() or ConfigHistoryDB(key=key, effective_from=effective_from)
+    entry.value = config_update.value
+    db.add(entry)
+    db.flush()
+    # The config row keeps the value in force today; future-dated changes wait in the history
+    current = db.query(ConfigHistoryDB.value).filter(
+        ConfigHistoryDB.key == key, ConfigHistoryDB.effective_from <= date.today()
+    ).order_by(ConfigHistoryDB.effective_from.desc()).first()
+    config.value = current.value if current else config_update.value
     config.updated_at = datetime.utcnow()
     db.commit()
-    db.refresh(config)
     return config
 
+@app.get("/api/config/{key}/history", response_model=List[ConfigHistoryResponse])
+def get_config_history(key: str, db: Session = Depends(get_db)):
+    history = db.query(ConfigHistoryDB).filter(ConfigHistoryDB.key == key).order_by(ConfigHistoryDB.effective_from).all()
+    if not history:
+        raise HTTPException(status_code=404, detail=f"Config '{key}' not found")
+    return history
+
 # Category Endpoints
 @app.get("/api/categories", response_model=List[CategoryResponse])
 def get_categories(db: Session = Depends(get_db)):
@@ -105,56 +211,68 @@ def get_categories(db: Session = Depends(get_db)):
 
 @app.post("/api/categories", response_model=CategoryResponse)
 def create_category(category: CategoryCreate, db: Session = Depends(get_db)):
-    existing = db.query(CategoryDB).filter(CategoryDB.name == category.name).first()
-    if existing:
+    if registry.get(db).category_ids.get(category.name) is not None:
         raise HTTPException(status_code=400, detail="Category already exists")
     db_category = CategoryDB(**category.dict())
     db.add(db_category)
     db.commit()
-    db.refresh(db_category)
     return db_category
 
 @app.delete("/api/categories/{category_id}")
 def delete_category(category_id: int, db: Session = Depends(get_db)):
-    category = db.query(CategoryDB).filter(CategoryDB.id == category_id).first()
-    if not category:
+    if not registry.get(db).category(category_id):
         raise HTTPException(status_code=404, detail="Category not found")
-    if db.query(ExpenseDB).filter(ExpenseDB.category_id == category_id).first():
+    history = archive.expense_source(db)
+    if db.execute(select(history.c.id).where(history.c.category_id == category_id).limit(1)).first():
         raise HTTPException(status_code=400, detail="Cannot delete category with expenses")
-    db.delete(category)
+    for model in (BudgetDB, CategoryRuleDB):
+        for dependent in db.query(model).filter(model.category_id == category_id).all():
+            db.delete(dependent)
+    db.delete(db.get(CategoryDB, category_id))
     db.commit()
     return {"message": "Category deleted"}
 
 # Expense Endpoints
 @app.get("/api/expenses", response_model=List[ExpenseResponse])
-def get_expenses(month: Optional[int] = None, year: Optional[int] = None, 
+def get_expenses(request: Request, month: Optional[int] = Query(None, ge=1, le=12),
+                 year: Optional[int] = Query(None, ge=1, le=9999),
                  category_id: Optional[int] = None, db: Session = Depends(get_db)):
-    query = db.query(ExpenseDB)
-    if month:
-        query = query.filter(extract('month', ExpenseDB.date) == month)
+    start = end = None
     if year:
-        query = query.filter(extract('year', ExpenseDB.date) == year)
+        start, end = (date(year, month, 1), date(year, month, monthrange(year, month)[1])) if month \
+            else (date(year, 1, 1), date(year, 12, 31))
+    source = archive.expense_source(db, start, end)
+    query = select(source)
+    if start:
+        query = query.where(source.c.date >= start, source.c.date <= end)
+    elif month:
+        query = query.where(extract('month', source.c.date) == month)
     if category_id:
-        query = query.filter(ExpenseDB.category_id == category_id)
-    expenses = query.order_by(ExpenseDB.date.desc()).all()
-    result = []
-    for exp in expenses:
-        result.append(ExpenseResponse(
-            id=exp.id, date=exp.date, amount=exp.amount, category_id=exp.category_id,
-            is_fixed=exp.is_fixed, notes=exp.notes, created_at=exp.created_at,
-            updated_at=exp.updated_at, category_name=exp.category_rel.name if exp.category_rel else None
-        ))
-    return result
+        query = query.where(source.c.category_id == category_id)
+    rows = db.execute(query.order_by(source.c.date.desc())).mappings().all()
+    return listing(request, rows, ExpenseResponse, registry.get(db).category_names())
+
+def category_for(db: Session, expense: ExpenseCreate):
+    """Category of a new expense: the one given, else the best matching category rule"""
+    category_id = expense.category_id
+    if category_id is None:
+        category_id = rules.get(db).classify(expense.notes, expense.amount)
+        if category_id is None:
+            raise HTTPException(status_code=400, detail="No category given and no category rule matches")
+    category = registry.get(db).category(category_id)
+    if not category:
+        raise HTTPException(status_code=404, detail="Category not found")
+    return category
 
 @app.post("/api/expenses", response_model=ExpenseResponse)
 def create_expense(expense: ExpenseCreate, db: Session = Depends(get_db)):
-    category = db.query(CategoryDB).filter(CategoryDB.id == expense.category_id).first()
-    if not category:
-        raise HTTPException(status_code=404, detail="Category not found")
-    db_expense = ExpenseDB(**expense.dict())
-    db.add(db_expense)
-    db.commit()
-    db.refresh(db_expense)
+    category = category_for(db, expense)
+    def work(session):
+        db_expense = ExpenseDB(**dict(expense.dict(), category_id=category.id))
+        session.add(db_expense)
+        return db_expense
+
+    db_expense = writer.commit(db, work)
     return ExpenseResponse(
         id=db_expense.id, date=db_expense.date, amount=db_expense.amount,
         category_id=db_expense.category_id, is_fixed=db_expense.is_fixed,
@@ -162,83 +280,170 @@ def create_expense(expense: ExpenseCreate, db: Session = Depends(get_db)):
         updated_at=db_expense.updated_at, category_name=category.name
     )
 
+@app.post("/api/expenses/bulk", response_model=List[ExpenseResponse])
+def import_expenses(expenses: List[ExpenseCreate], db: Session = Depends(get_db)):
+    """Add many expenses in one transaction (one undo step); rows without a category go through the rules"""
+    categories = []
+    for position, expense in enumerate(expenses):
+        try:
+            categories.append(category_for(db, expense))
+        except HTTPException as e:
+            raise HTTPException(status_code=e.status_code, detail=f"Expense {position}: {e.detail}")
+    def work(session):
+        db_expenses = [ExpenseDB(**dict(expense.dict(), category_id=category.id))
+                       for expense, category in zip(expenses, categories)]
+        session.add_all(db_expenses)
+        return db_expenses
+
+    db_expenses = writer.commit(db, work)
+    return [
+        ExpenseResponse(
+            id=e.id, date=e.date, amount=e.amount, category_id=e.category_id, is_fixed=e.is_fixed,
+            notes=e.notes, created_at=e.created_at, updated_at=e.updated_at, category_name=category.name
+        )
+        for e, category in zip(db_expenses, categories)
+    ]
+
 @app.put("/api/expenses/{expense_id}", response_model=ExpenseResponse)
 def update_expense(expense_id: int, expense: ExpenseUpdate, db: Session = Depends(get_db)):
-    db_expense = db.query(ExpenseDB).filter(ExpenseDB.id == expense_id).first()
-    if not db_expense:
-        raise HTTPException(status_code=404, detail="Expense not found")
-    for key, value in expense.dict(exclude_unset=True).items():
-        setattr(db_expense, key, value)
-    db_expense.updated_at = datetime.utcnow()
-    db.commit()
-    db.refresh(db_expense)
+    lookup = registry.get(db)
+
+    def work(session):
+        db_expense = session.get(ExpenseDB, expense_id)
+        if not db_expense:
+            if archive.is_archived_expense(session, expense_id):
+                raise HTTPException(status_code=400, detail="Expense is archived and read-only")
+            raise HTTPException(status_code=404, detail="Expense not found")
+        if expense.category_id is not None and not lookup.category(expense.category_id):
+            raise HTTPException(status_code=404, detail="Category not found")
+        for key, value in expense.dict(exclude_unset=True).items():
+            setattr(db_expense, key, value)
+        db_expense.updated_at = datetime.utcnow()
+        return db_expense
+
+    db_expense = writer.commit(db, work)
     return ExpenseResponse(
         id=db_expense.id, date=db_expense.date, amount=db_expense.amount,
         category_id=db_expense.category_id, is_fixed=db_expense.is_fixed,
         notes=db_expense.notes, created_at=db_expense.created_at,
-        updated_at=db_expense.updated_at, 
-        category_name=db_expense.category_rel.name if db_expense.category_rel else None
+        updated_at=db_expense.updated_at,
+        category_name=lookup.category_name(db_expense.category_id)
     )
 
 @app.delete("/api/expenses/{expense_id}")
 def delete_expense(expense_id: int, db: Session = Depends(get_db)):
-    expense = db.query(ExpenseDB).filter(ExpenseDB.id == expense_id).first()
-    if not expense:
-        raise HTTPException(status_code=404, detail="Expense not found")
-    db.delete(expense)
-    db.commit()
+    def work(session):
+        expense = session.get(ExpenseDB, expense_id)
+        if not expense:
+            if archive.is_archived_expense(session, expense_id):
+                raise HTTPException(status_code=400, detail="Expense is archived and read-only")
+            raise HTTPException(status_code=404, detail="Expense not found")
+        session.delete(expense)
+
+    writer.commit(db, work)
     return {"message": "Expense deleted"}
 
+# Category Rule Endpoints
+def rule_response(db: Session, rule: CategoryRuleDB) -> CategoryRuleResponse:
+    return CategoryRuleResponse(
+        id=rule.id, category_id=rule.category_id, match_type=rule.match_type, pattern=rule.pattern,
+        min_amount=rule.min_amount, max_amount=rule.max_amount, priority=rule.priority,
+        created_at=rule.created_at, category_name=registry.get(db).category_name(rule.category_id)
+    )
+
+@app.get("/api/rules", response_model=List[CategoryRuleResponse])
+def get_rules(db: Session = Depends(get_db)):
+    rows = db.query(CategoryRuleDB).order_by(CategoryRuleDB.priority.desc(), CategoryRuleDB.id).all()
+    return [rule_response(db, row) for row in rows]
+
+@app.post("/api/rules", response_model=CategoryRuleResponse)
+def create_rule(rule: CategoryRuleCreate, db: Session = Depends(get_db)):
+    if not registry.get(db).category(rule.category_id):
+        raise HTTPException(status_code=404, detail="Category not found")
+    try:
+        rules.validate(rule.match_type, rule.pattern, rule.min_amount, rule.max_amount)
+    except rules.RuleError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    db_rule = CategoryRuleDB(**dict(rule.dict(), match_type=rule.match_type.value))
+    db.add(db_rule)
+    db.commit()
+    return rule_response(db, db_rule)
+
+@app.delete("/api/rules/{rule_id}")
+def delete_rule(rule_id: int, db: Session = Depends(get_db)):
+    rule = db.get(CategoryRuleDB, rule_id)
+    if not rule:
+        raise HTTPException(status_code=404, detail="Rule not found")
+    db.delete(rule)
+    db.commit()
+    return {"message": "Rule deleted"}
+
+@app.get("/api/rules/classify", response_model=ClassifyResult)
+def classify_expense(amount: float, notes: Optional[str] = None, db: Session = Depends(get_db)):
+    rule = rules.get(db).match(notes, amount)
+    if not rule:
+        return ClassifyResult()
+    return ClassifyResult(category_id=rule.category_id, rule_id=rule.id,
+                          category_name=registry.get(db).category_name(rule.category_id))
+
+@app.post("/api/recategorize", response_model=RecategorizeResult)
+def recategorize_expenses(request: RecategorizeRequest, db: Session = Depends(get_db)):
+    return rules.recategorize(db, request.from_date, request.to_date, request.dry_run)
+
 # Investment Endpoints
 @app.get("/api/investments", response_model=List[InvestmentResponse])
-def get_investments(year: Optional[int] = None, type: Optional[str] = None, db: Session = Depends(get_db)):
+def get_investments(request: Request, year: Optional[int] = None, type: Optional[str] = None,
+                    db: Session = Depends(get_db)):
     query = db.query(InvestmentDB)
     if year:
-        query = query.filter(extract('year', InvestmentDB.date) == year)
+        query = query.filter(InvestmentDB.date >= date(year, 1, 1), InvestmentDB.date < date(year + 1, 1, 1))
     if type:
         query = query.filter(InvestmentDB.type == type)
-    return query.order_by(InvestmentDB.date.desc()).all()
+    return listing(request, query.order_by(InvestmentDB.date.desc()).all(), InvestmentResponse)
 
 @app.post("/api/investments", response_model=InvestmentResponse)
 def create_investment(investment: InvestmentCreate, db: Session = Depends(get_db)):
-    db_investment = InvestmentDB(**investment.dict())
-    db.add(db_investment)
-    db.commit()
-    db.refresh(db_investment)
-    return db_investment
+    def work(session):
+        db_investment = InvestmentDB(**investment.dict())
+        session.add(db_investment)
+        return db_investment
+
+    return writer.commit(db, work)
 
 @app.put("/api/investments/{investment_id}", response_model=InvestmentResponse)
 def update_investment(investment_id: int, investment: InvestmentCreate, db: Session = Depends(get_db)):
-    db_investment = db.query(InvestmentDB).filter(InvestmentDB.id == investment_id).first()
-    if not db_investment:
-        raise HTTPException(status_code=404, detail="Investment not found")
-    for key, value in investment.dict(exclude_unset=True).items():
-        setattr(db_investment, key, value)
-    db_investment.updated_at = datetime.utcnow()
-    db.commit()
-    db.refresh(db_investment)
-    return db_investment
+    def work(session):
+        db_investment = session.get(InvestmentDB, investment_id)
+        if not db_investment:
+            raise HTTPException(status_code=404, detail="Investment not found")
+        for key, value in investment.dict(exclude_unset=True).items():
+            setattr(db_investment, key, value)
+        db_investment.updated_at = datetime.utcnow()
+        return db_investment
+
+    return writer.commit(db, work)
 
 @app.delete("/api/investments/{investment_id}")
 def delete_investment(investment_id: int, db: Session = Depends(get_db)):
-    investment = db.query(InvestmentDB).filter(InvestmentDB.id == investment_id).first()
-    if not investment:
-        raise HTTPException(status_code=404, detail="Investment not found")
-    db.delete(investment)
-    db.commit()
+    def work(session):
+        investment = session.get(InvestmentDB, investment_id)
+        if not investment:
+            raise HTTPException(status_code=404, detail="Investment not found")
+        session.delete(investment)
+
+    writer.commit(db, work)
     return {"message": "Investment deleted"}
 
 # Debt Endpoints
 @app.get("/api/debts", response_model=List[DebtResponse])
-def get_debts(db: Session = Depends(get_db)):
-    return db.query(DebtDB).all()
+def get_debts(request: Request, db: Session = Depends(get_db)):
+    return listing(request, db.query(DebtDB).all(), DebtResponse)
 
 @app.post("/api/debts", response_model=DebtResponse)
 def create_debt(debt: DebtCreate, db: Session = Depends(get_db)):
     db_debt = DebtDB(**debt.dict())
     db.add(db_debt)
     db.commit()
-    db.refresh(db_debt)
     return db_debt
 
 @app.put("/api/debts/{debt_id}", response_model=DebtResponse)
@@ -250,7 +455,6 @@ def update_debt(debt_id: int, debt: DebtUpdate, db: Session = Depends(get_db)):
         setattr(db_debt, key, value)
     db_debt.updated_at = datetime.utcnow()
     db.commit()
-    db.refresh(db_debt)
     return db_debt
 
 @app.delete("/api/debts/{debt_id}")
@@ -262,18 +466,59 @@ def delete_debt(debt_id: int, db: Session = Depends(get_db)):
     db.commit()
     return {"message": "Debt deleted"}
 
+# Budget Endpoints
+@app.get("/api/budgets", response_model=List[BudgetResponse])
+def get_budgets(db: Session = Depends(get_db)):
+    return db.query(BudgetDB).all()
+
+@app.get("/api/budgets/status", response_model=List[BudgetStatus])
+def get_budget_status(request: Request, period: Optional[BudgetPeriod] = None, db: Session = Depends(get_db)):
+    return listing(request, trackers.get("budgets", db).status(db, period), BudgetStatus)
+
+@app.post("/api/budgets", response_model=BudgetResponse)
+def create_budget(budget: BudgetCreate, db: Session = Depends(get_db)):
+    if not registry.get(db).category(budget.category_id):
+        raise HTTPException(status_code=404, detail="Category not found")
+    existing = db.query(BudgetDB).filter(
+        BudgetDB.category_id == budget.category_id, BudgetDB.period == budget.period.value
+    ).first()
+    if existing:
+        raise HTTPException(status_code=400, detail="Budget already exists for this category and period")
+    db_budget = BudgetDB(category_id=budget.category_id, period=budget.period.value, limit_amount=budget.limit_amount)
+    db.add(db_budget)
+    db.commit()
+    return db_budget
+
+@app.put("/api/budgets/{budget_id}", response_model=BudgetResponse)
+def update_budget(budget_id: int, budget: BudgetUpdate, db: Session = Depends(get_db)):
+    db_budget = db.query(BudgetDB).filter(BudgetDB.id == budget_id).first()
+    if not db_budget:
+        raise HTTPException(status_code=404, detail="Budget not found")
+    db_budget.limit_amount = budget.limit_amount
+    db_budget.updated_at = datetime.utcnow()
+    db.commit()
+    return db_budget
+
+@app.delete("/api/budgets/{budget_id}")
+def delete_budget(budget_id: int, db: Session = Depends(get_db)):
+    budget = db.query(BudgetDB).filter(BudgetDB.id == budget_id).first()
+    if not budget:
+        raise HTTPException(status_code=404, detail="Budget not found")
+    db.delete(budget)
+    db.commit()
+    return {"message": "Budget deleted"}
+
 # Dashboard
 @app.get("/api/dashboard", response_model=DashboardStats)
 def get_dashboard(db: Session = Depends(get_db)):
     today = date.today()
-    salary_config = db.query(ConfigDB).filter(ConfigDB.key == "monthly_salary").first()
-    base_inv_config = db.query(ConfigDB).filter(ConfigDB.key == "base_investments").first()
-    monthly_salary = salary_config.value if salary_config else 100000.0
-    base_investments = base_inv_config.value if base_inv_config else 200000.0
+    lookup = registry.get(db)
+    monthly_salary = lookup.salary_for(today.year, today.month)
+    base_investments = lookup.value("base_investments")
     
+    month_start, month_end = month_span(today)
     month_expenses = db.query(ExpenseDB).filter(
-        extract('month', ExpenseDB.date) == today.month,
-        extract('year', ExpenseDB.date) == today.year
+        ExpenseDB.date >= month_start, ExpenseDB.date < month_end
     ).all()
     
     total_expenses = sum(e.amount for e in month_expenses)
@@ -281,7 +526,7 @@ def get_dashboard(db: Session = Depends(get_db)):
     remaining_balance = monthly_salary - total_expenses
     savings_rate = (remaining_balance / monthly_salary) * 100 if monthly_salary > 0 else 0
     
-    status = StatusEnum.RICH if savings_rate > 40 else (StatusEnum.NEUTRAL if savings_rate >= 15 else StatusEnum.POOR)
+    status = status_for_savings_rate(savings_rate)
     
     investments = db.query(InvestmentDB).all()
     deposits = sum(i.amount for i in investments if i.type == 'deposit')
@@ -304,13 +549,13 @@ def get_dashboard(db: Session = Depends(get_db)):
 @app.get("/api/fixed-expense-suggestions", response_model=List[FixedExpenseSuggestion])
 def get_fixed_expense_suggestions(db: Session = Depends(get_db)):
     today = date.today()
-    fixed_cats = db.query(CategoryDB).filter(CategoryDB.is_fixed == True, CategoryDB.default_amount > 0).all()
+    month_start, month_end = month_span(today)
+    fixed_cats = registry.get(db).fixed_categories()
     suggestions = []
     for cat in fixed_cats:
         existing = db.query(ExpenseDB).filter(
             ExpenseDB.category_id == cat.id, ExpenseDB.is_fixed == True,
-            extract('month', ExpenseDB.date) == today.month,
-            extract('year', ExpenseDB.date) == today.year
+            ExpenseDB.date >= month_start, ExpenseDB.date < month_end
         ).first()
         suggestions.append(FixedExpenseSuggestion(
             category_id=cat.id, category_name=cat.name,
@@ -321,13 +566,13 @@ def get_fixed_expense_suggestions(db: Session = Depends(get_db)):
 @app.post("/api/apply-fixed-expenses")
 def apply_fixed_expenses(db: Session = Depends(get_db)):
     today = date.today()
-    fixed_cats = db.query(CategoryDB).filter(CategoryDB.is_fixed == True, CategoryDB.default_amount > 0).all()
+    month_start, month_end = month_span(today)
+    fixed_cats = registry.get(db).fixed_categories()
     applied, skipped = [], []
     for cat in fixed_cats:
         existing = db.query(ExpenseDB).filter(
             ExpenseDB.category_id == cat.id, ExpenseDB.is_fixed == True,
-            extract('month', ExpenseDB.date) == today.month,
-            extract('year', ExpenseDB.date) == today.year
+            ExpenseDB.date >= month_start, ExpenseDB.date < month_end
         ).first()
         if existing:
             skipped.append(cat.name)
@@ -342,45 +587,186 @@ def apply_fixed_expenses(db: Session = Depends(get_db)):
     return {"message": f"Applied {len(applied)} fixed expenses", "applied": applied, "skipped": skipped}
 
 @app.get("/api/reports/monthly", response_model=List[MonthlyReport])
-def get_monthly_reports(year: Optional[int] = None, db: Session = Depends(get_db)):
-    query_year = year or date.today().year
-    salary_config = db.query(ConfigDB).filter(ConfigDB.key == "monthly_salary").first()
-    monthly_salary = salary_config.value if salary_config else 100000.0
-    reports = []
-    for month in range(1, 13):
-        expenses = db.query(ExpenseDB).filter(
-            extract('month', ExpenseDB.date) == month,
-            extract('year', ExpenseDB.date) == query_year
-        ).all()
-        if not expenses:
-            continue
-        total = sum(e.amount for e in expenses)
-        savings = monthly_salary - total
-        savings_rate = (savings / monthly_salary) * 100 if monthly_salary > 0 else 0
-        status = StatusEnum.RICH if savings_rate > 40 else (StatusEnum.NEUTRAL if savings_rate >= 15 else StatusEnum.POOR)
-        expenses_by_cat = {}
-        for exp in expenses:
-            cat_name = exp.category_rel.name if exp.category_rel else "Unknown"
-            expenses_by_cat[cat_name] = expenses_by_cat.get(cat_name, 0) + exp.amount
-        reports.append(MonthlyReport(
-            year=query_year, month=month, month_name=month_name[month],
-            salary=monthly_salary, total_expenses=total, savings=savings,
-            savings_rate=round(savings_rate, 2), status=status, expenses_by_category=expenses_by_cat
-        ))
-    return reports
+def get_monthly_reports(request: Request, year: Optional[int] = None, db: Session = Depends(get_db)):
+    return listing(request, reports.monthly_reports(db, year or date.today().year), MonthlyReport)
+
+@app.get("/api/forecast", response_model=ForecastResponse)
+def get_forecast(db: Session = Depends(get_db)):
+    return trackers.get("forecast", db).forecast(db)
+
+# Analytics
+@app.get("/api/analytics/breakdown", response_model=List[BreakdownEntry])
+def get_breakdown(request: Request,
+                  from_date: Optional[date] = Query(None, alias="from"), to_date: Optional[date] = Query(None, alias="to"),
+                  group: BreakdownGroup = BreakdownGroup.DAY, category_id: Optional[int] = None,
+                  db: Session = Depends(get_db)):
+    if from_date and to_date and from_date > to_date:
+        raise HTTPException(status_code=400, detail="'from' must not be after 'to'")
+    return listing(request, rollup.breakdown(db, from_date, to_date, group, category_id), BreakdownEntry)
+
+# Insights
+@app.get("/api/insights/anomalies", response_model=List[Anomaly])
+def get_anomalies(request: Request, from_date: Optional[date] = None, to_date: Optional[date] = None,
+                  limit: int = 100, db: Session = Depends(get_db)):
+    return listing(request, anomalies.find_anomalies(db, from_date, to_date, limit), Anomaly)
+
+@app.post("/api/insights/anomalies/check", response_model=List[Anomaly])
+def check_expense_anomalies(expense: ExpenseCreate, db: Session = Depends(get_db)):
+    return anomalies.check_expense(db, category_for(db, expense).id, expense.date, expense.amount)
 
 @app.get("/api/export")
 def export_data(db: Session = Depends(get_db)):
-    export_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "finance_export.csv")
-    expenses = db.query(ExpenseDB).all()
-    with open(export_path, 'w', newline='', encoding='utf-8') as f:
-        writer = csv.writer(f)
-        writer.writerow(['ID', 'Date', 'Amount', 'Category', 'Is Fixed', 'Notes', 'Created At'])
-        for exp in expenses:
-            writer.writerow([exp.id, exp.date.isoformat(), exp.amount,
-                exp.category_rel.name if exp.category_rel else "Unknown",
-                exp.is_fixed, exp.notes or "", exp.created_at.isoformat()])
-    return FileResponse(path=export_path, filename="finance_export.csv", media_type="text/csv")
+    # One file per request, so concurrent exports never stream each other's output
+    fd, export_path = tempfile.mkstemp(prefix="finance_export-", suffix=".csv")
+    os.close(fd)
+    try:
+        reports.write_export(db, export_path)
+    except Exception:
+        os.remove(export_path)
+        raise
+    return FileResponse(path=export_path, filename="finance_export.csv", media_type="text/csv",
+                        background=BackgroundTask(os.remove, export_path))
+
+# Journal Endpoints
+@app.get("/api/journal", response_model=List[JournalEntry])
+def get_journal(limit: int = 50, db: Session = Depends(get_db)):
+    return journal.recent(db, limit)
+
+@app.post("/api/undo", response_model=UndoResponse)
+def undo_last_change(db: Session = Depends(get_db)):
+    try:
+        txn, changes = journal.undo(db)
+    except journal.JournalError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return UndoResponse(message=f"Undid {changes} change(s)", txn=txn, changes=changes)
+
+@app.get("/api/as-of/{table}")
+def get_as_of(table: str, at: datetime, db: Session = Depends(get_db)):
+    try:
+        return journal.as_of(db, table, at)
+    except journal.JournalError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+@app.post("/api/journal/compact")
+def compact_journal(db: Session = Depends(get_db)):
+    return {"removed": journal.compact(db)}
+
+# Job Endpoints
+@app.post("/api/jobs", response_model=JobResponse)
+def create_job(request: JobCreate, db: Session = Depends(get_db)):
+    try:
+        return jobs.job_manager.submit(db, request)
+    except jobs.JobError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+@app.get("/api/jobs/{job_id}", response_model=JobResponse)
+def get_job(job_id: str, db: Session = Depends(get_db)):
+    try:
+        return jobs.job_manager.get(db, job_id).info()
+    except jobs.JobNotFound as e:
+        raise HTTPException(status_code=404, detail=str(e))
+
+@app.get("/api/jobs/{job_id}/result")
+def get_job_result(job_id: str, db: Session = Depends(get_db)):
+    try:
+        result = jobs.job_manager.result(db, job_id)
+    except jobs.JobNotFound as e:
+        raise HTTPException(status_code=404, detail=str(e))
+    except jobs.JobError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    if isinstance(result, dict) and "path" in result:
+        return FileResponse(path=result["path"], filename="finance_export.csv", media_type="text/csv")
+    return result
+
+@app.delete("/api/jobs/{job_id}", response_model=JobResponse)
+def cancel_job(job_id: str, db: Session = Depends(get_db)):
+    try:
+        return jobs.job_manager.cancel(db, job_id)
+    except jobs.JobNotFound as e:
+        raise HTTPException(status_code=404, detail=str(e))
+
+# Archive Endpoints
+@app.get("/api/archive", response_model=List[ArchivedYearResponse])
+def get_archived_years(db: Session = Depends(get_db)):
+    return archive.list_archived(db)
+
+@app.post("/api/archive/{year}", response_model=ArchivedYearResponse)
+def archive_year(year: int, db: Session = Depends(get_db)):
+    try:
+        return archive.archive_year(db, year)
+    except archive.ArchiveError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+@app.delete("/api/archive/{year}")
+def unarchive_year(year: int, db: Session = Depends(get_db)):
+    try:
+        moved = archive.unarchive_year(db, year)
+    except archive.ArchiveError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+    return {"message": f"Restored {moved} expenses from {year}"}
+
+# Backup Endpoints
+@app.get("/api/backups", response_model=List[BackupInfo])
+def get_backups(db: Session = Depends(get_db)):
+    return backup.list_backups(db.get_bind())
+
+@app.post("/api/backup", response_model=BackupInfo)
+def backup_database(request: Optional[BackupRequest] = None, db: Session = Depends(get_db)):
+    request = request or BackupRequest()
+    try:
+        return backup.create_backup(db.get_bind(), request.compression)
+    except backup.BackupError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+@app.post("/api/restore")
+def restore_database(request: RestoreRequest, db: Session = Depends(get_db)):
+    try:
+        safety = backup.restore_backup(db.get_bind(), request.name)
+    except backup.BackupError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    # The backup may predate schema changes made since; another process may be upgrading it too
+    try:
+        with writer.FileLock(writer.lock_path(db.get_bind(), "init")):
+            migrations.upgrade(db.get_bind())
+    except migrations.MigrationError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    archive.reconcile(db)
+    new_epoch(db.get_bind())
+    trackers.reset(db)
+    # Peers' watermarks refer to the sequence numbers of the replaced file
+    sync.new_identity(db)
+    return {"message": f"Restored {request.name}", "safety_backup": safety.name}
+
+# Sync Endpoints
+@app.get("/api/sync/status", response_model=SyncStatus)
+def get_sync_status(db: Session = Depends(get_db)):
+    return sync.status(db)
+
+@app.get("/api/sync/changes")
+def get_sync_changes(since: Optional[int] = None, peer: Optional[str] = None, db: Session = Depends(get_db)):
+    data, until = sync.changes(db, since, peer)
+    filename = f"solowealth-changes-{until}.swsync"
+    return Response(content=data, media_type="application/gzip",
+                    headers={"Content-Disposition": f'attachment; filename="{filename}"'})
+
+@app.post("/api/sync/changes", response_model=SyncResult)
+def apply_sync_changes(data: bytes = Body(..., media_type="application/gzip"), db: Session = Depends(get_db)):
+    try:
+        return sync.apply(db, data)
+    except sync.SyncError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+@app.post("/api/sync/peer", response_model=SyncExchange)
+def sync_with_peer(request: SyncPeerRequest, db: Session = Depends(get_db)):
+    try:
+        pulled, pushed = sync.exchange(db, request.url, request.profile)
+    except sync.SyncError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return SyncExchange(pulled=pulled, pushed=pushed)
+
+@app.post("/api/sync/identity")
+def renew_sync_identity(db: Session = Depends(get_db)):
+    return {"node_id": sync.new_identity(db)}
 
 @app.get("/", response_class=HTMLResponse)
 def serve_frontend():
@@ -389,5 +775,13 @@ def serve_frontend():
         return HTMLResponse(content=f.read())
 
 if __name__ == "__main__":
+    # Job workers are spawned processes; a frozen executable must hand them off here
+    multiprocessing.freeze_support()
     import uvicorn
-    uvicorn.run(app, host="127.0.0.1", port=8000)
+    host = os.environ.get("SOLOWEALTH_HOST", "127.0.0.1")
+    port = int(os.environ.get("SOLOWEALTH_PORT", "8000"))
+    if WORKERS > 1:
+        # Each worker process imports the app itself
+        uvicorn.run("main:app", host=host, port=port, workers=WORKERS)
+    else:
+        uvicorn.run(app, host=host, port=port)
@@ -0,0 +1,262 @@
+# SoloWealth - Personal Finance Tracker
+# migrations.py - Versioned schema changes keyed on PRAGMA user_version
+
+import os
+import random
+import time
+from typing import Callable, List, NamedTuple
+
+from sqlalchemy import text
+from sqlalchemy.engine import Connection, Engine
+
+import sync
+from models import CONFIG_EPOCH
+from profiles import database_path
+
+# Seconds between "still running" lines while a single statement (an index
+# build or backfill over a large table) keeps the migration busy
+PROGRESS_SECONDS = 5.0
+# SQLite VM instructions between progress checks
+PROGRESS_STEPS = 1_000_000
+
+
+class Migration(NamedTuple):
+    version: int
+    description: str
+    apply: Callable[[Connection], None]
+
+
+class MigrationError(Exception):
+    pass
+
+
+MIGRATIONS: List[Migration] = []
+
+
+def migration(version: int, description: str):
+    """Register the decorated function as the step that brings a database to `version`"""
+    def register(apply: Callable[[Connection], None]):
+        assert version == len(MIGRATIONS) + 1, "migrations must be numbered in order"
+        MIGRATIONS.append(Migration(version, description, apply))
+        return apply
+    return register
+
+
+def latest() -> int:
+    return len(MIGRATIONS)
+
+
+def schema_version(engine: Engine) -> int:
+    with engine.connect() as conn:
+        return conn.exec_driver_sql("PRAGMA user_version").scalar()
+
+
+def add_column(conn: Connection, table: str, column: str, ddl: str) -> None:
+    """ALTER TABLE ... ADD COLUMN unless the table already has it (created by the baseline)"""
+    columns = {row[1] for row in conn.exec_driver_sql(f"PRAGMA table_info({table})")}
+    if column not in columns:
+        conn.exec_driver_sql(f"ALTER TABLE {table} ADD COLUMN {column} {ddl}")
+
+
+def upgrade(engine: Engine, report: Callable[[str], None] = print) -> int:
+    """Apply the migrations a database is missing; returns the version it was at.
+
+    Each migration runs in its own transaction together with the bump of
+    user_version, so an interrupted upgrade resumes at the failed step.
+    A current database costs one pragma read. Callers serialize upgrades
+    of a ledger across processes (see main.initialize_database).
+    """
+    start = schema_version(engine)
+    if start > latest():
+        raise MigrationError(f"{os.path.basename(database_path(engine))} has schema version {start}, "
+                             f"newer than this version of SoloWealth supports ({latest()})")
+    if start == latest():
+        return start
+    name = os.path.basename(database_path(engine))
+    report(f"Upgrading {name} from schema version {start} to {latest()}")
+    for step in MIGRATIONS[start:]:
+        began = time.monotonic()
+        report(f"  {step.version}: {step.description}")
+        with engine.connect() as conn:
+            dbapi_connection = conn.connection.dbapi_connection
+            next_report = [began + PROGRESS_SECONDS]
+
+            def progress():
+                now = time.monotonic()
+                if now >= next_report[0]:
+                    report(f"     still running, {now - began:.0f} s")
+                    next_report[0] = now + PROGRESS_SECONDS
+                return 0
+
+            dbapi_connection.set_progress_handler(progress, PROGRESS_STEPS)
+            # pysqlite does not open a transaction for DDL by itself
+            conn.exec_driver_sql("BEGIN IMMEDIATE")
+            try:
+                step.apply(conn)
+                conn.exec_driver_sql(f"PRAGMA user_version = {step.version}")
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                raise
+            finally:
+                dbapi_connection.set_progress_handler(None, 0)
+        report(f"     done in {time.monotonic() - began:.1f} s")
+    return start
+
+
+def _version_triggers(table: str) -> List[str]:
+    bump = f"UPDATE data_versions SET version = version + 1 WHERE name = '{table}';"
+    return [
+        f"CREATE TRIGGER IF NOT EXISTS trg_{table}_version_{op.lower()} AFTER {op} ON {table} BEGIN {bump} END"
+        for op in ("INSERT", "UPDATE", "DELETE")
+    ]
+
+
+# The schema as it stood at version 1, spelled out rather than taken from
+# models.py: columns and tables added to the models since then belong to the
+# later migrations, which would otherwise find them already in place.
+BASELINE_DDL = (
+    """CREATE TABLE IF NOT EXISTS archived_years (
+        year INTEGER NOT NULL, rows INTEGER NOT NULL, total FLOAT NOT NULL, max_expense_id INTEGER NOT NULL,
+        archived_at DATETIME, PRIMARY KEY (year))""",
+    """CREATE TABLE IF NOT EXISTS categories (
+        id INTEGER NOT NULL, name VARCHAR(100) NOT NULL, icon VARCHAR(50), is_fixed BOOLEAN,
+        default_amount FLOAT, created_at DATETIME, PRIMARY KEY (id), UNIQUE (name))""",
+    "CREATE INDEX IF NOT EXISTS ix_categories_id ON categories (id)",
+    """CREATE TABLE IF NOT EXISTS change_journal (
+        id INTEGER NOT NULL, txn VARCHAR(32) NOT NULL, undo_of VARCHAR(32), table_name VARCHAR(50) NOT NULL,
+        row_id INTEGER NOT NULL, op VARCHAR(10) NOT NULL, "before" TEXT, "after" TEXT, created_at DATETIME,
+        PRIMARY KEY (id))""",
+    "CREATE INDEX IF NOT EXISTS ix_change_journal_created_at ON change_journal (created_at)",
+    "CREATE INDEX IF NOT EXISTS ix_change_journal_txn ON change_journal (txn)",
+    "CREATE INDEX IF NOT EXISTS ix_change_journal_undo_of ON change_journal (undo_of)",
+    """CREATE TABLE IF NOT EXISTS config (
+        id INTEGER NOT NULL, "key" VARCHAR(100) NOT NULL, value FLOAT NOT NULL, description VARCHAR(255),
+        updated_at DATETIME, PRIMARY KEY (id), UNIQUE ("key"))""",
+    "CREATE INDEX IF NOT EXISTS ix_config_id ON config (id)",
+    """CREATE TABLE IF NOT EXISTS config_history (
+        id INTEGER NOT NULL, "key" VARCHAR(100) NOT NULL, value FLOAT NOT NULL, effective_from DATE NOT NULL,
+        created_at DATETIME, PRIMARY KEY (id), UNIQUE ("key", effective_from))""",
+    "CREATE INDEX IF NOT EXISTS ix_config_history_id ON config_history (id)",
+    """CREATE TABLE IF NOT EXISTS data_versions (
+        name VARCHAR(50) NOT NULL, version INTEGER NOT NULL, PRIMARY KEY (name))""",
+    """CREATE TABLE IF NOT EXISTS debts (
+        id INTEGER NOT NULL, name VARCHAR(100) NOT NULL, principal FLOAT NOT NULL, remaining FLOAT NOT NULL,
+        interest_rate FLOAT, monthly_payment FLOAT, created_at DATETIME, updated_at DATETIME, PRIMARY KEY (id))""",
+    "CREATE INDEX IF NOT EXISTS ix_debts_id ON debts (id)",
+    """CREATE TABLE IF NOT EXISTS expense_daily_rollup (
+        date DATE NOT NULL, category_id INTEGER NOT NULL, total FLOAT NOT NULL, count INTEGER NOT NULL,
+        PRIMARY KEY (date, category_id))""",
+    """CREATE TABLE IF NOT EXISTS investments (
+        id INTEGER NOT NULL, date DATE NOT NULL, amount FLOAT NOT NULL, type VARCHAR(50) NOT NULL,
+        description TEXT, created_at DATETIME, updated_at DATETIME, PRIMARY KEY (id))""",
+    "CREATE INDEX IF NOT EXISTS ix_investments_id ON investments (id)",
+    """CREATE TABLE IF NOT EXISTS monthly_snapshots (
+        id INTEGER NOT NULL, year INTEGER NOT NULL, month INTEGER NOT NULL, salary FLOAT NOT NULL,
+        total_expenses FLOAT NOT NULL, total_savings FLOAT NOT NULL, savings_rate FLOAT NOT NULL,
+        net_worth FLOAT NOT NULL, created_at DATETIME, PRIMARY KEY (id))""",
+    "CREATE INDEX IF NOT EXISTS ix_monthly_snapshots_id ON monthly_snapshots (id)",
+    """CREATE TABLE IF NOT EXISTS budgets (
+        id INTEGER NOT NULL, category_id INTEGER NOT NULL, period VARCHAR(20) NOT NULL,
+        limit_amount FLOAT NOT NULL, created_at DATETIME, updated_at DATETIME, PRIMARY KEY (id),
+        UNIQUE (category_id, period), FOREIGN KEY(category_id) REFERENCES categories (id))""",
+    "CREATE INDEX IF NOT EXISTS ix_budgets_id ON budgets (id)",
+    """CREATE TABLE IF NOT EXISTS expenses (
+        id INTEGER NOT NULL, date DATE NOT NULL, amount FLOAT NOT NULL, category_id INTEGER NOT NULL,
+        is_fixed BOOLEAN, notes TEXT, created_at DATETIME, updated_at DATETIME, PRIMARY KEY (id),
+        FOREIGN KEY(category_id) REFERENCES categories (id))""",
+    "CREATE INDEX IF NOT EXISTS ix_expenses_id ON expenses (id)",
+)
+# The tables counted in data_versions at version 1 (see models.VERSIONED_TABLES)
+VERSIONED_AT_1 = ("expenses", "investments", "debts", "categories", "config", "config_history", "budgets")
+
+
+# Databases from before versioning are at user_version 0 with any subset of
+# this already in place, so every step of the baseline is idempotent.
+@migration(1, "tables, change counters and config history")
+def _baseline(conn: Connection) -> None:
+    for statement in BASELINE_DDL:
+        conn.exec_driver_sql(statement)
+    conn.execute(text("INSERT OR IGNORE INTO data_versions (name, version) VALUES ('epoch', :epoch)"),
+                 {"epoch": random.getrandbits(31)})
+    for table in VERSIONED_AT_1:
+        conn.execute(text("INSERT OR IGNORE INTO data_versions (name, version) VALUES (:name, 0)"), {"name": table})
+        for trigger in _version_triggers(table):
+            conn.execute(text(trigger))
+    # Values set before config was effective-dated have been in force all along
+    conn.execute(text(
+        "INSERT INTO config_history (key, value, effective_from, created_at) "
+        "SELECT key, value, :epoch, CURRENT_TIMESTAMP FROM config "
+        "WHERE key NOT IN (SELECT key FROM config_history)"
+    ), {"epoch": CONFIG_EPOCH.isoformat()})
+
+
+@migration(2, "daily expense rollup")
+def _rollup(conn: Connection) -> None:
+    if conn.execute(text("SELECT 1 FROM expense_daily_rollup LIMIT 1")).first():
+        return
+    conn.execute(text(
+        "INSERT INTO expense_daily_rollup (date, category_id, total, count) "
+        "SELECT date, category_id, SUM(amount), COUNT(*) FROM ("
+        "SELECT date, category_id, amount FROM main.expenses "
+        "UNION ALL SELECT date, category_id, amount FROM archive.expenses) GROUP BY date, category_id"
+    ))
+
+
+@migration(3, "indexes for date-range, per-category and journal queries")
+def _query_indexes(conn: Connection) -> None:
+    for statement in (
+        "CREATE INDEX IF NOT EXISTS ix_expenses_date ON expenses (date)",
+        "CREATE INDEX IF NOT EXISTS ix_expenses_category_date ON expenses (category_id, date)",
+        "CREATE INDEX IF NOT EXISTS ix_investments_date ON investments (date)",
+        "CREATE INDEX IF NOT EXISTS ix_change_journal_table_id ON change_journal (table_name, id)",
+    ):
+        conn.exec_driver_sql(statement)
+    conn.exec_driver_sql("ANALYZE main")
+
+
+SYNC_DDL = (
+    """CREATE TABLE IF NOT EXISTS sync_state (
+        id INTEGER NOT NULL, node_id VARCHAR(32) NOT NULL, clock VARCHAR(64) NOT NULL, seq INTEGER NOT NULL,
+        PRIMARY KEY (id))""",
+    """CREATE TABLE IF NOT EXISTS sync_tombstones (
+        uuid VARCHAR(32) NOT NULL, table_name VARCHAR(50) NOT NULL, hlc VARCHAR(64) NOT NULL,
+        sync_seq INTEGER NOT NULL, PRIMARY KEY (uuid))""",
+    "CREATE INDEX IF NOT EXISTS ix_sync_tombstones_sync_seq ON sync_tombstones (sync_seq)",
+    """CREATE TABLE IF NOT EXISTS sync_peers (
+        node_id VARCHAR(32) NOT NULL, url VARCHAR(255), received INTEGER NOT NULL, acked INTEGER NOT NULL,
+        last_sync_at DATETIME, PRIMARY KEY (node_id))""",
+)
+# The tables synced at version 4; later ones are created with their sync columns
+SYNCED_AT_4 = ("categories", "config", "config_history", "budgets", "debts", "investments", "expenses")
+
+
+@migration(4, "sync ids, clocks and tombstones")
+def _sync(conn: Connection) -> None:
+    for statement in SYNC_DDL:
+        conn.exec_driver_sql(statement)
+    for table in SYNCED_AT_4:
+        add_column(conn, table, "uuid", "VARCHAR(32)")
+        add_column(conn, table, "hlc", "VARCHAR(64)")
+        add_column(conn, table, "sync_seq", "INTEGER")
+        conn.exec_driver_sql(f"CREATE UNIQUE INDEX IF NOT EXISTS ix_{table}_uuid ON {table} (uuid)")
+        conn.exec_driver_sql(f"CREATE INDEX IF NOT EXISTS ix_{table}_sync_seq ON {table} (sync_seq)")
+    sync.initialize(conn, SYNCED_AT_4)
+
+
+@migration(5, "category rules")
+def _category_rules(conn: Connection) -> None:
+    for statement in (
+        """CREATE TABLE IF NOT EXISTS category_rules (
+            id INTEGER NOT NULL, category_id INTEGER NOT NULL, match_type VARCHAR(20) NOT NULL,
+            pattern VARCHAR(500) NOT NULL, min_amount FLOAT, max_amount FLOAT, priority INTEGER NOT NULL,
+            created_at DATETIME, uuid VARCHAR(32), hlc VARCHAR(64), sync_seq INTEGER, PRIMARY KEY (id),
+            FOREIGN KEY(category_id) REFERENCES categories (id))""",
+        "CREATE INDEX IF NOT EXISTS ix_category_rules_id ON category_rules (id)",
+        "CREATE UNIQUE INDEX IF NOT EXISTS ix_category_rules_uuid ON category_rules (uuid)",
+        "CREATE INDEX IF NOT EXISTS ix_category_rules_sync_seq ON category_rules (sync_seq)",
+    ):
+        conn.exec_driver_sql(statement)
+    conn.execute(text("INSERT OR IGNORE INTO data_versions (name, version) VALUES ('category_rules', 0)"))
+    for trigger in _version_triggers("category_rules"):
+        conn.execute(text(trigger))
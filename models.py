@@ -1,26 +1,40 @@
 # SoloWealth - Personal Finance Tracker
 # models.py - SQLAlchemy ORM and Pydantic Models
 
+import random
 from datetime import date, datetime
 from typing import Optional, List
 from enum import Enum
 
-from sqlalchemy import create_engine, Column, Integer, String, Float, Boolean, Date, DateTime, ForeignKey, Text
+from fastapi import HTTPException, Request
+from sqlalchemy import Column, Integer, String, Float, Boolean, Date, DateTime, ForeignKey, Text, UniqueConstraint, text
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker, relationship
-from pydantic import BaseModel, Field
+from pydantic import BaseModel
+
+from profiles import engine_pool, ProfileNotFound
 
 # Database Setup
-DATABASE_URL = "sqlite:///./finance.db"
-engine = create_engine(DATABASE_URL, connect_args={"check_same_thread": False})
-SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+# Each profile has its own engine (see profiles.py); sessions are bound per request
+# Objects keep their loaded values after commit: every default is set
+# client-side, so there is nothing to re-read (no refresh() round trip)
+SessionLocal = sessionmaker(autocommit=False, autoflush=False, expire_on_commit=False)
 Base = declarative_base()
 
 # ============================================
 # SQLAlchemy ORM Models
 # ============================================
 
-class ConfigDB(Base):
+class SyncedMixin:
+    """Replication columns of the tables sync.py exchanges between installs:
+    a stable id across installs, the hybrid logical clock of the last
+    change and the local change sequence it was written under"""
+    uuid = Column(String(32), unique=True, index=True)
+    hlc = Column(String(64))
+    sync_seq = Column(Integer, index=True)
+
+
+class ConfigDB(SyncedMixin, Base):
     """Configuration table for app settings"""
     __tablename__ = "config"
     
@@ -31,7 +45,20 @@ class ConfigDB(Base):
     updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
 
 
-class CategoryDB(Base):
+class ConfigHistoryDB(SyncedMixin, Base):
+    """Effective-dated config values; the row with the latest effective_from
+    on or before a day is the value in force that day"""
+    __tablename__ = "config_history"
+    __table_args__ = (UniqueConstraint("key", "effective_from"),)
+    
+    id = Column(Integer, primary_key=True, index=True)
+    key = Column(String(100), nullable=False)
+    value = Column(Float, nullable=False)
+    effective_from = Column(Date, nullable=False)
+    created_at = Column(DateTime, default=datetime.utcnow)
+
+
+class CategoryDB(SyncedMixin, Base):
     """Expense categories"""
     __tablename__ = "categories"
     
@@ -45,7 +72,7 @@ class CategoryDB(Base):
     expenses = relationship("ExpenseDB", back_populates="category_rel")
 
 
-class ExpenseDB(Base):
+class ExpenseDB(SyncedMixin, Base):
     """Expense records"""
     __tablename__ = "expenses"
     
@@ -61,7 +88,7 @@ class ExpenseDB(Base):
     category_rel = relationship("CategoryDB", back_populates="expenses")
 
 
-class InvestmentDB(Base):
+class InvestmentDB(SyncedMixin, Base):
     """Investment/Savings records"""
     __tablename__ = "investments"
     
@@ -74,7 +101,7 @@ class InvestmentDB(Base):
     updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
 
 
-class DebtDB(Base):
+class DebtDB(SyncedMixin, Base):
     """Debt/Loan tracking"""
     __tablename__ = "debts"
     
@@ -88,6 +115,108 @@ class DebtDB(Base):
     updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
 
 
+class BudgetDB(SyncedMixin, Base):
+    """Spending limits per category and period"""
+    __tablename__ = "budgets"
+    __table_args__ = (UniqueConstraint("category_id", "period"),)
+    
+    id = Column(Integer, primary_key=True, index=True)
+    category_id = Column(Integer, ForeignKey("categories.id"), nullable=False)
+    period = Column(String(20), nullable=False)  # 'weekly', 'monthly', 'yearly'
+    limit_amount = Column(Float, nullable=False)
+    created_at = Column(DateTime, default=datetime.utcnow)
+    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+
+class CategoryRuleDB(SyncedMixin, Base):
+    """Rules that pick the category of an expense from its notes and amount"""
+    __tablename__ = "category_rules"
+    
+    id = Column(Integer, primary_key=True, index=True)
+    category_id = Column(Integer, ForeignKey("categories.id"), nullable=False)
+    match_type = Column(String(20), nullable=False, default="contains")  # 'contains', 'regex'
+    pattern = Column(String(500), nullable=False, default="")  # empty matches any notes
+    min_amount = Column(Float, nullable=True)
+    max_amount = Column(Float, nullable=True)
+    priority = Column(Integer, nullable=False, default=0)  # highest wins, then oldest
+    created_at = Column(DateTime, default=datetime.utcnow)
+
+
+class ArchivedYearDB(Base):
+    """Closed years whose expenses were moved to the archive database"""
+    __tablename__ = "archived_years"
+    
+    year = Column(Integer, primary_key=True)
+    rows = Column(Integer, nullable=False)
+    total = Column(Float, nullable=False)
+    max_expense_id = Column(Integer, nullable=False, default=0)
+    archived_at = Column(DateTime, default=datetime.utcnow)
+
+
+class ExpenseDailyRollupDB(Base):
+    """Per-day, per-category expense totals, kept in step with expense writes"""
+    __tablename__ = "expense_daily_rollup"
+    
+    date = Column(Date, primary_key=True)
+    category_id = Column(Integer, primary_key=True)
+    total = Column(Float, nullable=False, default=0.0)
+    count = Column(Integer, nullable=False, default=0)
+
+
+class ChangeJournalDB(Base):
+    """Append-only before/after images of every ORM write, grouped by transaction"""
+    __tablename__ = "change_journal"
+    
+    id = Column(Integer, primary_key=True)
+    txn = Column(String(32), nullable=False, index=True)
+    undo_of = Column(String(32), nullable=True, index=True)
+    table_name = Column(String(50), nullable=False)
+    row_id = Column(Integer, nullable=False)
+    op = Column(String(10), nullable=False)  # 'insert', 'update', 'delete', or 'compacted' (horizon marker)
+    before = Column(Text, nullable=True)
+    after = Column(Text, nullable=True)
+    created_at = Column(DateTime, default=datetime.utcnow, index=True)
+
+
+class DataVersionDB(Base):
+    """Per-table change counters, bumped by triggers on every row write"""
+    __tablename__ = "data_versions"
+    
+    name = Column(String(50), primary_key=True)
+    version = Column(Integer, nullable=False, default=0)
+
+
+class SyncStateDB(Base):
+    """This install's sync identity, clock and change sequence (a single row)"""
+    __tablename__ = "sync_state"
+    
+    id = Column(Integer, primary_key=True)
+    node_id = Column(String(32), nullable=False)
+    clock = Column(String(64), nullable=False)
+    seq = Column(Integer, nullable=False, default=0)
+
+
+class SyncTombstoneDB(Base):
+    """Deleted synced rows, so deletions replicate like any other change"""
+    __tablename__ = "sync_tombstones"
+    
+    uuid = Column(String(32), primary_key=True)
+    table_name = Column(String(50), nullable=False)
+    hlc = Column(String(64), nullable=False)
+    sync_seq = Column(Integer, nullable=False, index=True)
+
+
+class SyncPeerDB(Base):
+    """Other installs this one has exchanged changes with, and how far"""
+    __tablename__ = "sync_peers"
+    
+    node_id = Column(String(32), primary_key=True)
+    url = Column(String(255), nullable=True)
+    received = Column(Integer, nullable=False, default=0)  # their sequence we have applied
+    acked = Column(Integer, nullable=False, default=0)  # our sequence they have applied
+    last_sync_at = Column(DateTime, nullable=True)
+
+
 class MonthlySnapshotDB(Base):
     """Monthly financial snapshots for reports"""
     __tablename__ = "monthly_snapshots"
@@ -113,6 +242,10 @@ class StatusEnum(str, Enum):
     POOR = "Poor"
 
 
+def status_for_savings_rate(savings_rate: float) -> StatusEnum:
+    return StatusEnum.RICH if savings_rate > 40 else (StatusEnum.NEUTRAL if savings_rate >= 15 else StatusEnum.POOR)
+
+
 # Config Schemas
 class ConfigBase(BaseModel):
     key: str
@@ -126,6 +259,7 @@ class ConfigCreate(ConfigBase):
 
 class ConfigUpdate(BaseModel):
     value: float
+    effective_from: Optional[date] = None  # defaults to the first day of the current month
 
 
 class ConfigResponse(ConfigBase):
@@ -136,6 +270,16 @@ class ConfigResponse(ConfigBase):
         from_attributes = True
 
 
+class ConfigHistoryResponse(BaseModel):
+    key: str
+    value: float
+    effective_from: date
+    created_at: datetime
+    
+    class Config:
+        from_attributes = True
+
+
 # Category Schemas
 class CategoryBase(BaseModel):
     name: str
@@ -166,7 +310,7 @@ class ExpenseBase(BaseModel):
 
 
 class ExpenseCreate(ExpenseBase):
-    pass
+    category_id: Optional[int] = None  # picked by the category rules when left out
 
 
 class ExpenseUpdate(BaseModel):
@@ -187,6 +331,53 @@ class ExpenseResponse(ExpenseBase):
         from_attributes = True
 
 
+class RecategorizeRequest(BaseModel):
+    from_date: Optional[date] = None
+    to_date: Optional[date] = None
+    dry_run: bool = False
+
+
+class RecategorizeResult(BaseModel):
+    scanned: int
+    matched: int
+    changed: int
+    chunks: int
+
+
+# Category Rule Schemas
+class RuleMatch(str, Enum):
+    CONTAINS = "contains"
+    REGEX = "regex"
+
+
+class CategoryRuleBase(BaseModel):
+    category_id: int
+    match_type: RuleMatch = RuleMatch.CONTAINS
+    pattern: str = ""
+    min_amount: Optional[float] = None
+    max_amount: Optional[float] = None
+    priority: int = 0
+
+
+class CategoryRuleCreate(CategoryRuleBase):
+    pass
+
+
+class CategoryRuleResponse(CategoryRuleBase):
+    id: int
+    created_at: datetime
+    category_name: Optional[str] = None
+    
+    class Config:
+        from_attributes = True
+
+
+class ClassifyResult(BaseModel):
+    category_id: Optional[int] = None
+    category_name: Optional[str] = None
+    rule_id: Optional[int] = None
+
+
 # Investment Schemas
 class InvestmentBase(BaseModel):
     date: date
@@ -234,6 +425,201 @@ class DebtResponse(DebtBase):
         from_attributes = True
 
 
+# Budget Schemas
+class BudgetPeriod(str, Enum):
+    WEEKLY = "weekly"
+    MONTHLY = "monthly"
+    YEARLY = "yearly"
+
+
+class BudgetBase(BaseModel):
+    category_id: int
+    period: BudgetPeriod = BudgetPeriod.MONTHLY
+    limit_amount: float
+
+
+class BudgetCreate(BudgetBase):
+    pass
+
+
+class BudgetUpdate(BaseModel):
+    limit_amount: float
+
+
+class BudgetResponse(BudgetBase):
+    id: int
+    created_at: datetime
+    updated_at: datetime
+    
+    class Config:
+        from_attributes = True
+
+
+class BudgetStatus(BaseModel):
+    category_id: int
+    category_name: str
+    period: BudgetPeriod
+    period_start: date
+    period_end: date
+    limit_amount: Optional[float] = None
+    spent: float
+    remaining: Optional[float] = None
+    percent_used: Optional[float] = None
+
+
+# Insight Schemas
+class AnomalyKind(str, Enum):
+    OUTLIER = "outlier"
+    DUPLICATE = "duplicate"
+    MONTHLY_JUMP = "monthly_jump"
+
+
+class Anomaly(BaseModel):
+    kind: AnomalyKind
+    expense_id: Optional[int] = None
+    category_id: int
+    category_name: Optional[str] = None
+    date: date
+    amount: float
+    score: float
+    message: str
+
+
+# Analytics Schemas
+class BreakdownGroup(str, Enum):
+    DAY = "day"
+    WEEK = "week"
+    MONTH = "month"
+    CATEGORY = "category"
+
+
+class BreakdownEntry(BaseModel):
+    period: Optional[date] = None  # first day of the day/week/month; None when grouped by category
+    category_id: int
+    category_name: Optional[str] = None
+    total: float
+    count: int
+
+
+# Journal Schemas
+class JournalEntry(BaseModel):
+    id: int
+    txn: str
+    undo_of: Optional[str] = None
+    table_name: str
+    row_id: int
+    op: str
+    before: Optional[dict] = None
+    after: Optional[dict] = None
+    created_at: datetime
+
+
+class UndoResponse(BaseModel):
+    message: str
+    txn: str
+    changes: int
+
+
+# Backup Schemas
+class BackupRequest(BaseModel):
+    compression: Optional[str] = "gzip"  # 'gzip', 'zstd' or None
+
+
+class BackupInfo(BaseModel):
+    name: str
+    size: int
+    created_at: datetime
+    compression: Optional[str] = None
+
+
+class RestoreRequest(BaseModel):
+    name: str
+
+
+# Sync Schemas
+class SyncPeerRequest(BaseModel):
+    url: str  # e.g. http://192.168.1.20:8000
+    profile: Optional[str] = None
+
+
+class SyncPeerInfo(BaseModel):
+    node_id: str
+    url: Optional[str] = None
+    received: int
+    acked: int
+    last_sync_at: Optional[datetime] = None
+    
+    class Config:
+        from_attributes = True
+
+
+class SyncStatus(BaseModel):
+    node_id: str
+    seq: int
+    peers: List[SyncPeerInfo]
+
+
+class SyncResult(BaseModel):
+    peer: str
+    applied: int
+    skipped: int
+    conflicts: List[str] = []
+
+
+class SyncExchange(BaseModel):
+    pulled: SyncResult
+    pushed: SyncResult
+
+
+# Archive Schemas
+class ArchivedYearResponse(BaseModel):
+    year: int
+    rows: int
+    total: float
+    archived_at: datetime
+    
+    class Config:
+        from_attributes = True
+
+
+# Profile Schemas
+class ProfileInfo(BaseModel):
+    name: str
+    database: str
+    is_default: bool
+    is_open: bool
+
+
+# Job Schemas
+class JobKind(str, Enum):
+    MONTHLY_REPORTS = "monthly_reports"
+    EXPORT = "export"
+
+
+class JobStatus(str, Enum):
+    PENDING = "pending"
+    RUNNING = "running"
+    DONE = "done"
+    FAILED = "failed"
+    CANCELLED = "cancelled"
+
+
+class JobCreate(BaseModel):
+    kind: JobKind
+    from_year: Optional[int] = None  # monthly_reports only, defaults to the current year
+    to_year: Optional[int] = None
+
+
+class JobResponse(BaseModel):
+    id: str
+    kind: JobKind
+    status: JobStatus
+    cached: bool = False
+    created_at: datetime
+    finished_at: Optional[datetime] = None
+    error: Optional[str] = None
+
+
 # Dashboard Schemas
 class DashboardStats(BaseModel):
     monthly_salary: float
@@ -268,14 +654,56 @@ class MonthlyReport(BaseModel):
     expenses_by_category: dict
 
 
-# Create all tables
-def init_db():
-    Base.metadata.create_all(bind=engine)
+# Forecast Schemas
+class CategoryForecast(BaseModel):
+    category_id: int
+    category_name: Optional[str] = None
+    spent_to_date: float
+    projected_month_end: float
+    projected_year_end: float
+
+
+class ForecastResponse(BaseModel):
+    as_of: date
+    month: str
+    monthly_salary: float
+    spent_to_date: float
+    projected_month_end: float
+    projected_year_end: float
+    predicted_savings_rate: float
+    predicted_status: StatusEnum
+    categories: List[CategoryForecast]
+
+
+# effective_from of config values that predate the history
+CONFIG_EPOCH = date(1970, 1, 1)
+
+# Tables whose writes are counted in data_versions
+VERSIONED_TABLES = ("expenses", "investments", "debts", "categories", "config", "config_history", "budgets",
+                    "category_rules")
+
+
+def new_epoch(engine):
+    """Mark the database content as replaced wholesale (e.g. restored), invalidating every cache"""
+    with engine.begin() as conn:
+        conn.execute(text("UPDATE data_versions SET version = :epoch WHERE name = 'epoch'"),
+                     {"epoch": random.getrandbits(31)})
+
+
+def data_versions(db, *names: str) -> dict:
+    """Current change counters, plus the 'epoch' that changes when the file is replaced"""
+    rows = db.execute(text("SELECT name, version FROM data_versions")).all()
+    versions = dict(rows)
+    return {name: versions.get(name, 0) for name in names} if names else versions
 
 
 # Database dependency
-def get_db():
-    db = SessionLocal()
+def get_db(request: Request):
+    try:
+        engine = engine_pool.engine(getattr(request.state, "profile", None))
+    except ProfileNotFound as e:
+        raise HTTPException(status_code=404, detail=str(e))
+    db = SessionLocal(bind=engine)
     try:
         yield db
     finally:
@@ -0,0 +1,238 @@
+# SoloWealth - Personal Finance Tracker
+# profiles.py - Database locations, named profiles and the per-profile engine pool
+
+import json
+import os
+import re
+import sys
+import threading
+import time
+from collections import OrderedDict
+from typing import Callable, Dict, List
+
+from sqlalchemy import create_engine, event
+from sqlalchemy.engine import Engine
+
+# Relative database paths resolve against the application folder (next to
+# the .exe when frozen), not the process working directory.
+APP_DIR = os.path.dirname(sys.executable) if getattr(sys, "frozen", False) else os.path.dirname(os.path.abspath(__file__))
+CONFIG_FILE = os.environ.get("SOLOWEALTH_CONFIG") or os.path.join(APP_DIR, "solowealth.json")
+PROFILE_HEADER = "X-SoloWealth-Profile"
+PROFILE_PREFIX = re.compile(r"^/p/([A-Za-z0-9_-]+)(?=/|$)")
+PROFILE_NAME = re.compile(r"^[A-Za-z0-9_-]+$")
+
+MAX_ENGINES = int(os.environ.get("SOLOWEALTH_MAX_ENGINES", "4"))
+ENGINE_IDLE_SECONDS = float(os.environ.get("SOLOWEALTH_ENGINE_IDLE_SECONDS", "600"))
+# Server processes sharing the ledgers (uvicorn workers)
+WORKERS = int(os.environ.get("SOLOWEALTH_WORKERS", "1"))
+
+# Applied to every new connection: WAL lets readers run alongside the writer,
+# NORMAL sync is durable against app crashes (a power cut may lose the last
+# commits, never corrupt the file), and busy_timeout waits out short locks.
+PRAGMAS = (
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA busy_timeout=5000",
+    "PRAGMA cache_size=-16000",
+    "PRAGMA temp_store=MEMORY",
+)
+
+
+class ProfileNotFound(Exception):
+    pass
+
+
+def _resolve(path: str, base: str) -> str:
+    return os.path.abspath(os.path.join(base, os.path.expanduser(path)))
+
+
+def load_profiles() -> tuple:
+    """Read (default profile name, {name: database path}) from the config file and environment.
+
+    solowealth.json: {"default_profile": "personal",
+                      "profiles": {"personal": "finance.db", "household": "D:/household.db"}}
+    SOLOWEALTH_DB overrides the default profile's path and
+    SOLOWEALTH_PROFILES ("name=path;name=path") adds or overrides profiles.
+    """
+    default, profiles = "default", {}
+    if os.path.exists(CONFIG_FILE):
+        with open(CONFIG_FILE, "r", encoding="utf-8") as f:
+            config = json.load(f)
+        base = os.path.dirname(os.path.abspath(CONFIG_FILE))
+        default = config.get("default_profile", default)
+        for name, value in config.get("profiles", {}).items():
+            path = value["path"] if isinstance(value, dict) else value
+            profiles[name] = _resolve(path, base)
+    for item in filter(None, os.environ.get("SOLOWEALTH_PROFILES", "").split(";")):
+        name, _, path = item.partition("=")
+        profiles[name.strip()] = _resolve(path.strip(), os.getcwd())
+    if os.environ.get("SOLOWEALTH_DB"):
+        profiles[default] = _resolve(os.environ["SOLOWEALTH_DB"], os.getcwd())
+    profiles.setdefault(default, _resolve("finance.db", APP_DIR))
+    for name in profiles:
+        if not PROFILE_NAME.match(name):
+            raise ValueError(f"Invalid profile name '{name}'")
+    return default, profiles
+
+
+def create_profile_engine(path: str) -> Engine:
+    engine = create_engine(f"sqlite:///{path}", connect_args={"check_same_thread": False})
+
+    @event.listens_for(engine, "connect")
+    def _tune(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for pragma in PRAGMAS:
+            cursor.execute(pragma)
+        cursor.close()
+
+    return engine
+
+
+def create_read_only_engine(path: str) -> Engine:
+    """Engine that can never write to the ledger (mode=ro), for background workers"""
+    engine = create_engine(f"sqlite:///file:{path}?mode=ro&uri=true", connect_args={"check_same_thread": False})
+
+    @event.listens_for(engine, "connect")
+    def _tune(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for pragma in PRAGMAS[2:]:
+            cursor.execute(pragma)
+        cursor.close()
+
+    return engine
+
+
+def database_path(engine: Engine) -> str:
+    """Filesystem path of an engine's database, also for read-only file: URIs"""
+    database = engine.url.database
+    if database.startswith("file:"):
+        database = database[len("file:"):]
+    return os.path.abspath(database)
+
+
+class EnginePool:
+    """Lazily created engines, one per profile, kept in LRU order.
+
+    An engine is disposed when it has been idle for ENGINE_IDLE_SECONDS or
+    when more than MAX_ENGINES are open; the default profile is never
+    evicted. `on_create` callbacks run once per new engine (schema, seed),
+    holding up only requests for that profile, and `on_dispose` callbacks
+    once per engine just before it is disposed.
+    """
+
+    def __init__(self, default: str, profiles: Dict[str, str],
+                 max_engines: int = MAX_ENGINES, idle_seconds: float = ENGINE_IDLE_SECONDS):
+        self.default = default
+        self.profiles = profiles
+        self.max_engines = max_engines
+        self.idle_seconds = idle_seconds
+        self.on_create: List[Callable[[Engine], None]] = []
+        self.on_dispose: List[Callable[[Engine], None]] = []
+        self._engines: "OrderedDict[str, Engine]" = OrderedDict()
+        self._last_used: Dict[str, float] = {}
+        self._lock = threading.Lock()
+        # Per profile: one thread creates its engine while requests for the others go on
+        self._creating: Dict[str, threading.Lock] = {}
+
+    def engine(self, name: str = None) -> Engine:
+        name = name or self.default
+        if name not in self.profiles:
+            raise ProfileNotFound(f"Profile '{name}' not found")
+        with self._lock:
+            engine = self._engines.get(name)
+            if engine is not None:
+                evicted = self._touch(name)
+            else:
+                creating = self._creating.setdefault(name, threading.Lock())
+        if engine is None:
+            engine, evicted = self._create(name, creating)
+        # Outside the lock: callbacks may wait on work queued for the engine
+        for old in evicted:
+            self._dispose(old)
+        return engine
+
+    def _create(self, name: str, creating: threading.Lock):
+        """Create a profile's engine and run the on_create callbacks (migrations
+        can take minutes) without the pool lock; a failed engine is disposed.
+        """
+        with creating:
+            with self._lock:
+                engine = self._engines.get(name)
+                if engine is not None:
+                    # Created by another request while this one waited
+                    return engine, self._touch(name)
+            engine = create_profile_engine(self.profiles[name])
+            try:
+                for callback in self.on_create:
+                    callback(engine)
+            except BaseException:
+                engine.dispose()
+                raise
+            with self._lock:
+                self._engines[name] = engine
+                return engine, self._touch(name)
+
+    def _touch(self, name: str) -> List[Engine]:
+        """Mark an engine just used; returns the engines evicted. Caller holds the lock."""
+        now = time.monotonic()
+        self._engines.move_to_end(name)
+        self._last_used[name] = now
+        return self._evict(now)
+
+    def _evict(self, now: float) -> List[Engine]:
+        evicted = []
+        for name in list(self._engines):
+            if name == self.default:
+                continue
+            idle = now - self._last_used[name] > self.idle_seconds
+            if idle or len(self._engines) > self.max_engines:
+                evicted.append(self._engines.pop(name))
+                del self._last_used[name]
+        return evicted
+
+    def _dispose(self, engine: Engine) -> None:
+        for callback in self.on_dispose:
+            callback(engine)
+        engine.dispose()
+
+    def open_engines(self) -> List[Engine]:
+        with self._lock:
+            return list(self._engines.values())
+
+    def dispose(self) -> None:
+        with self._lock:
+            for engine in self._engines.values():
+                engine.dispose()
+            self._engines.clear()
+            self._last_used.clear()
+
+
+class ProfileMiddleware:
+    """Picks the profile from a /p/<name>/ path prefix or the profile header.
+
+    The prefix is stripped before routing, so /p/household/api/expenses is
+    served by the normal /api/expenses route against the household ledger.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "http":
+            profile = None
+            match = PROFILE_PREFIX.match(scope["path"])
+            if match:
+                profile = match.group(1)
+                scope = dict(scope, path=scope["path"][match.end():] or "/")
+            else:
+                header = PROFILE_HEADER.lower().encode()
+                for key, value in scope.get("headers", []):
+                    if key == header:
+                        profile = value.decode()
+                        break
+            scope["state"] = dict(scope.get("state") or {}, profile=profile)
+        await self.app(scope, receive, send)
+
+
+DEFAULT_PROFILE, PROFILES = load_profiles()
+engine_pool = EnginePool(DEFAULT_PROFILE, PROFILES)
@@ -0,0 +1,88 @@
+# SoloWealth - Personal Finance Tracker
+# registry.py - In-process lookup of categories and config values
+
+import bisect
+import calendar
+from datetime import date
+from typing import Dict, List, NamedTuple, Optional, Tuple
+
+from sqlalchemy.orm import Session
+
+import trackers
+from models import CategoryDB, ConfigDB, ConfigHistoryDB
+
+DEFAULTS = {"monthly_salary": 100000.0, "base_investments": 200000.0}
+WATCHED = (CategoryDB, ConfigDB, ConfigHistoryDB)
+
+
+class Category(NamedTuple):
+    id: int
+    name: str
+    icon: Optional[str]
+    is_fixed: bool
+    default_amount: float
+
+
+class Registry(trackers.Tracker):
+    """Categories and config values of a ledger, so handlers validate and
+    resolve names without a query per row.
+
+    Config values are effective-dated: `value_at()` finds the value in
+    force on a day by binary search over each key's history. Commits that
+    touch categories or config mark the registry stale and the next
+    `get()` reloads it; these tables hold a handful of rows.
+    """
+
+    tables = ("categories", "config", "config_history")
+
+    def load(self, db: Session) -> None:
+        self.categories: Dict[int, Category] = {
+            row.id: Category(row.id, row.name, row.icon, bool(row.is_fixed), row.default_amount or 0.0)
+            for row in db.query(CategoryDB).order_by(CategoryDB.id).all()
+        }
+        self.category_ids: Dict[str, int] = {c.name: c.id for c in self.categories.values()}
+        self.config: Dict[str, float] = dict(db.query(ConfigDB.key, ConfigDB.value).all())
+        self.history: Dict[str, Tuple[List[date], List[float]]] = {}
+        rows = db.query(ConfigHistoryDB.key, ConfigHistoryDB.effective_from, ConfigHistoryDB.value) \
+            .order_by(ConfigHistoryDB.key, ConfigHistoryDB.effective_from).all()
+        for key, effective_from, value in rows:
+            days, values = self.history.setdefault(key, ([], []))
+            days.append(effective_from)
+            values.append(value)
+
+    def category(self, category_id: int) -> Optional[Category]:
+        return self.categories.get(category_id)
+
+    def category_name(self, category_id: int) -> Optional[str]:
+        category = self.categories.get(category_id)
+        return category.name if category else None
+
+    def category_names(self) -> Dict[int, str]:
+        return {c.id: c.name for c in self.categories.values()}
+
+    def fixed_categories(self) -> List[Category]:
+        return [c for c in self.categories.values() if c.is_fixed and c.default_amount > 0]
+
+    def value(self, key: str) -> Optional[float]:
+        """Value in force today"""
+        return self.value_at(key, date.today())
+
+    def value_at(self, key: str, day: date) -> Optional[float]:
+        history = self.history.get(key)
+        if history is None:
+            return self.config.get(key, DEFAULTS.get(key))
+        days, values = history
+        # Before the first entry, its value is the best there is
+        return values[max(bisect.bisect_right(days, day) - 1, 0)]
+
+    def salary_for(self, year: int, month: int) -> float:
+        """Monthly salary in force at the end of the month"""
+        return self.value_at("monthly_salary", date(year, month, calendar.monthrange(year, month)[1]))
+
+
+trackers.register("registry", Registry)
+trackers.invalidate_on("registry", *WATCHED)
+
+
+def get(db: Session) -> Registry:
+    return trackers.get("registry", db)
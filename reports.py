@@ -0,0 +1,117 @@
+# SoloWealth - Personal Finance Tracker
+# reports.py - Monthly reports and CSV export, shared by endpoints and background jobs
+
+import csv
+from calendar import month_name
+from datetime import date
+from typing import Callable, Dict, List, Optional, Tuple
+
+import numpy as np
+from sqlalchemy import select
+from sqlalchemy.orm import Session
+
+import archive
+import columnar
+import registry
+import trackers
+from models import MonthlyReport, status_for_savings_rate
+
+EXPORT_HEADER = ['ID', 'Date', 'Amount', 'Category', 'Is Fixed', 'Notes', 'Created At']
+
+
+def month_totals(columns: columnar.ExpenseColumns) -> Dict[int, Dict[int, float]]:
+    """{month: {category_id: total}} of a year's expense columns"""
+    _, days, amounts, cats = columns
+    months = days.astype("datetime64[D]").astype("datetime64[M]").astype(int) % 12 + 1
+    keys, inverse = np.unique(np.stack([months, cats], axis=1).reshape(-1, 2), axis=0, return_inverse=True)
+    sums = np.bincount(inverse.ravel(), weights=amounts, minlength=len(keys))
+    totals: Dict[int, Dict[int, float]] = {}
+    for (month, category_id), amount in zip(keys.tolist(), sums.tolist()):
+        totals.setdefault(month, {})[category_id] = amount
+    return totals
+
+
+class ReportCache(trackers.Tracker):
+    """Per-month category totals, computed once per year and kept until an
+    expense in that month changes.
+
+    Totals hold no salary or category names, so config and category edits
+    never invalidate them; those are applied when a report is built.
+    """
+
+    def load(self, db: Session) -> None:
+        self._months: Dict[Tuple[int, int], Dict[int, float]] = {}
+        # Bumped by every applied change, so totals computed across one are not kept
+        self._changes = 0
+
+    def apply(self, old, new) -> None:
+        self._changes += 1
+        for row in (old, new):
+            if row is not None:
+                self._months.pop((row.date.year, row.date.month), None)
+
+    def totals(self, db: Session, year: int) -> Dict[int, Dict[int, float]]:
+        with trackers.lock:
+            cached = {month: self._months.get((year, month)) for month in range(1, 13)}
+            changes = self._changes
+        if any(totals is None for totals in cached.values()):
+            # Computed without trackers.lock, since the column read may rebuild the store
+            computed = month_totals(columnar.expenses(db, date(year, 1, 1), date(year, 12, 31)))
+            cached = {month: computed.get(month, {}) for month in range(1, 13)}
+            with trackers.lock:
+                if self._changes == changes:
+                    self._months.update({(year, month): totals for month, totals in cached.items()})
+        return {month: totals for month, totals in cached.items() if totals}
+
+
+trackers.register("reports", ReportCache)
+
+
+def monthly_reports(db: Session, year: int,
+                    load: Optional[Callable[..., columnar.ExpenseColumns]] = None) -> List[MonthlyReport]:
+    """A year's monthly reports, each against the salary in force that month.
+
+    `load` bypasses the report cache (background workers pass `columnar.sql_expenses`).
+    """
+    lookup = registry.get(db)
+    if load is None:
+        by_month = trackers.get("reports", db).totals(db, year)
+    else:
+        by_month = month_totals(load(db, date(year, 1, 1), date(year, 12, 31)))
+    names = lookup.category_names()
+    reports = []
+    for month in sorted(by_month):
+        expenses_by_cat = {}
+        for category_id, amount in by_month[month].items():
+            cat_name = names.get(category_id) or "Unknown"
+            expenses_by_cat[cat_name] = expenses_by_cat.get(cat_name, 0) + amount
+        salary = lookup.salary_for(year, month)
+        total = sum(expenses_by_cat.values())
+        savings = salary - total
+        savings_rate = (savings / salary) * 100 if salary > 0 else 0
+        status = status_for_savings_rate(savings_rate)
+        reports.append(MonthlyReport(
+            year=year, month=month, month_name=month_name[month],
+            salary=salary, total_expenses=total, savings=savings,
+            savings_rate=round(savings_rate, 2), status=status, expenses_by_category=expenses_by_cat
+        ))
+    return reports
+
+
+def write_export(db: Session, path: str, cancelled: Callable[[], bool] = lambda: False) -> int:
+    """Write every expense to a CSV file; returns the number of rows written"""
+    source = archive.expense_source(db)
+    names = registry.get(db).category_names()
+    expenses = db.execute(select(source).order_by(source.c.id))
+    count = 0
+    with open(path, 'w', newline='', encoding='utf-8') as f:
+        writer = csv.writer(f)
+        writer.writerow(EXPORT_HEADER)
+        for exp in expenses:
+            writer.writerow([exp.id, exp.date.isoformat(), exp.amount,
+                names.get(exp.category_id) or "Unknown",
+                exp.is_fixed, exp.notes or "", exp.created_at.isoformat()])
+            count += 1
+            if count % 10000 == 0 and cancelled():
+                break
+    return count
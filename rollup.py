@@ -0,0 +1,74 @@
+# SoloWealth - Personal Finance Tracker
+# rollup.py - Daily per-category expense rollup and range breakdowns
+
+from collections import defaultdict
+from datetime import date
+from typing import List, Optional
+
+from sqlalchemy import Date, event, func, select, text, type_coerce
+from sqlalchemy.orm import Session
+
+import registry
+import trackers
+from models import BreakdownEntry, BreakdownGroup, ExpenseDailyRollupDB
+
+R = ExpenseDailyRollupDB
+
+UPSERT = text(
+    "INSERT INTO expense_daily_rollup (date, category_id, total, count) VALUES (:date, :category_id, :total, :count) "
+    "ON CONFLICT (date, category_id) DO UPDATE SET total = total + excluded.total, count = count + excluded.count"
+)
+PRUNE = text("DELETE FROM expense_daily_rollup WHERE date = :date AND category_id = :category_id AND count <= 0")
+
+# First day of the bucket a rollup date falls in (weeks start on Monday)
+PERIODS = {
+    BreakdownGroup.DAY: R.date,
+    BreakdownGroup.WEEK: type_coerce(func.date(R.date, "weekday 0", "-6 days"), Date),
+    BreakdownGroup.MONTH: type_coerce(func.date(R.date, "start of month"), Date),
+}
+
+
+def breakdown(db: Session, start: Optional[date], end: Optional[date],
+              group: BreakdownGroup = BreakdownGroup.DAY, category_id: Optional[int] = None) -> List[BreakdownEntry]:
+    period = PERIODS.get(group)
+    columns = [R.category_id, func.sum(R.total), func.sum(R.count)]
+    query = select(period, *columns) if period is not None else select(*columns)
+    if start:
+        query = query.where(R.date >= start)
+    if end:
+        query = query.where(R.date <= end)
+    if category_id:
+        query = query.where(R.category_id == category_id)
+    keys = [period, R.category_id] if period is not None else [R.category_id]
+    rows = db.execute(query.group_by(*keys).order_by(*keys).having(func.sum(R.count) > 0)).all()
+    names = registry.get(db).category_names()
+    return [
+        BreakdownEntry(period=row[0] if period is not None else None, category_id=row[-3],
+                       category_name=names.get(row[-3]), total=round(row[-2], 2), count=row[-1])
+        for row in rows
+    ]
+
+
+# Archive moves keep the rollup valid (it covers the full history), so only
+# ORM expense writes touch it, within the transaction that made them.
+@event.listens_for(Session, "after_flush")
+def _update_rollup(session, flush_context):
+    deltas = defaultdict(lambda: [0.0, 0])
+    for old, new in trackers.flushed_changes(session):
+        if old is not None:
+            delta = deltas[(old.date, old.category_id)]
+            delta[0] -= old.amount
+            delta[1] -= 1
+        if new is not None:
+            delta = deltas[(new.date, new.category_id)]
+            delta[0] += new.amount
+            delta[1] += 1
+    changed = [
+        {"date": day.isoformat(), "category_id": category_id, "total": total, "count": count}
+        for (day, category_id), (total, count) in deltas.items() if count or total
+    ]
+    if changed:
+        session.execute(UPSERT, changed)
+        emptied = [{"date": c["date"], "category_id": c["category_id"]} for c in changed if c["count"] < 0]
+        if emptied:
+            session.execute(PRUNE, emptied)
@@ -0,0 +1,273 @@
+# SoloWealth - Personal Finance Tracker
+# rules.py - Category rules compiled into one matcher for auto-categorizing expenses
+
+import re
+from collections import deque
+from datetime import date, datetime
+from itertools import chain
+from typing import Dict, Iterable, List, NamedTuple, Optional, Tuple
+
+from sqlalchemy import select
+from sqlalchemy.orm import Session
+
+import trackers
+from models import CategoryDB, CategoryRuleDB, ExpenseDB, RecategorizeResult, RuleMatch
+
+# Expenses read, classified and committed per transaction by recategorize()
+CHUNK = 1000
+WATCHED = (CategoryDB, CategoryRuleDB)
+# Backreferences mean something else once a pattern is embedded in the
+# combined prefilter, so such rules are always tried on their own
+BACKREFERENCE = re.compile(r"\\[1-9]|\(\?P=")
+# Shortest literal worth indexing a regex rule under
+MIN_LITERAL = 3
+
+
+class RuleError(Exception):
+    pass
+
+
+class Rule(NamedTuple):
+    id: int
+    category_id: int
+    match_type: str
+    pattern: str
+    min_amount: Optional[float]
+    max_amount: Optional[float]
+    priority: int
+
+    @property
+    def rank(self) -> Tuple[int, int]:
+        """Sort key: highest priority first, then the oldest rule"""
+        return (-self.priority, self.id)
+
+    def accepts(self, amount: float) -> bool:
+        return (self.min_amount is None or amount >= self.min_amount) and \
+            (self.max_amount is None or amount <= self.max_amount)
+
+
+def validate(match_type: RuleMatch, pattern: str, min_amount: Optional[float], max_amount: Optional[float]) -> None:
+    if match_type == RuleMatch.REGEX:
+        try:
+            re.compile(pattern)
+        except re.error as e:
+            raise RuleError(f"Invalid regular expression: {e}")
+    if min_amount is not None and max_amount is not None and min_amount > max_amount:
+        raise RuleError("min_amount must not be above max_amount")
+    if not pattern and min_amount is None and max_amount is None:
+        raise RuleError("A rule needs a pattern or an amount range")
+
+
+def required_literal(pattern: str) -> str:
+    """Longest run of plain ASCII letters, digits and spaces that every match
+    of a regex contains, or "" when that is not certain.
+
+    Only the top level of the pattern is read: groups and character classes
+    are skipped, and a character made optional by a quantifier ends a run.
+    """
+    if "|" in pattern or "(?" in pattern:
+        return ""
+    runs, run, depth, i = [], "", 0, 0
+    while i < len(pattern):
+        ch = pattern[i]
+        if depth == 0 and ch.isascii() and (ch.isalnum() or ch == " "):
+            run += ch
+            i += 1
+            continue
+        if ch in "?*{" and run:
+            run = run[:-1]
+        runs.append(run)
+        run = ""
+        if ch == "\\":
+            i += 1
+            if pattern[i:i + 1].isalnum() and pattern[i] not in "bBdDsSwWAZ":
+                return ""  # \x41, \u00e9, \1 and friends stand for other characters
+        elif ch == "{":
+            i = pattern.find("}", i)
+            if i < 0:
+                return ""
+        elif ch == "[":
+            # First character of a class may be a literal ']'
+            i = pattern.find("]", i + 2 if pattern[i + 1:i + 2] in ("]", "^") else i + 1)
+            if i < 0:
+                return ""
+        elif ch == "(":
+            depth += 1
+        elif ch == ")":
+            depth -= 1
+        i += 1
+    runs.append(run)
+    literal = max(runs, key=len).strip()
+    return literal if len(literal) >= MIN_LITERAL else ""
+
+
+class Automaton:
+    """Aho-Corasick automaton over the substring rules.
+
+    One pass over the notes finds every keyword that occurs in them, at a
+    cost set by the length of the notes, not by the number of keywords.
+    """
+
+    def __init__(self, keywords: Iterable[Tuple[str, int]]):
+        self.goto: List[Dict[str, int]] = [{}]
+        self.output: List[List[int]] = [[]]
+        for keyword, value in keywords:
+            state = 0
+            for ch in keyword:
+                following = self.goto[state].get(ch)
+                if following is None:
+                    following = self.goto[state][ch] = len(self.goto)
+                    self.goto.append({})
+                    self.output.append([])
+                state = following
+            self.output[state].append(value)
+        # Breadth-first, so every state's fallback is finished before its children need it
+        self.fail = [0] * len(self.goto)
+        pending = deque(self.goto[0].values())
+        while pending:
+            state = pending.popleft()
+            for ch, following in self.goto[state].items():
+                pending.append(following)
+                if state:
+                    fallback = self.fail[state]
+                    while fallback and ch not in self.goto[fallback]:
+                        fallback = self.fail[fallback]
+                    self.fail[following] = self.goto[fallback].get(ch, 0)
+                self.output[following].extend(self.output[self.fail[following]])
+
+    def find(self, text: str) -> List[int]:
+        goto, fail, output = self.goto, self.fail, self.output
+        state, found = 0, []
+        for ch in text:
+            while state and ch not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(ch, 0)
+            if output[state]:
+                found.extend(output[state])
+        return found
+
+
+class RuleSet(trackers.Tracker):
+    """The category rules of a ledger, compiled for `classify()`.
+
+    Substring rules share one Aho-Corasick automaton, and so do regex
+    rules through a literal every match must contain, so classifying an
+    expense costs about the same however many rules exist: only regexes
+    whose literal occurs in the notes are run. Regexes without such a
+    literal share one combined pattern that rules them all out in a
+    single search.
+    Commits that touch rules or categories mark the set stale and the
+    next `get()` recompiles it.
+    """
+
+    tables = ("categories", "category_rules")
+
+    def load(self, db: Session) -> None:
+        rows = db.query(CategoryRuleDB).join(CategoryDB, CategoryDB.id == CategoryRuleDB.category_id).all()
+        self.rules: List[Rule] = sorted(
+            (Rule(row.id, row.category_id, row.match_type, row.pattern or "", row.min_amount, row.max_amount,
+                  row.priority or 0) for row in rows),
+            key=lambda rule: rule.rank)
+        self.always = [i for i, rule in enumerate(self.rules) if not rule.pattern]
+        keywords: List[Tuple[str, int]] = []
+        # Compiled regex rules, by position; those without a literal are also in `regexes`
+        self.compiled: Dict[int, "re.Pattern"] = {}
+        self.regexes: List[Tuple[int, "re.Pattern"]] = []
+        combined, alone = [], False
+        for i, rule in enumerate(self.rules):
+            if not rule.pattern:
+                continue
+            if rule.match_type != RuleMatch.REGEX:
+                keywords.append((rule.pattern.casefold(), i))
+                continue
+            try:
+                self.compiled[i] = re.compile(rule.pattern, re.IGNORECASE)
+            except re.error:
+                continue  # written by a peer or by hand; never matches
+            literal = required_literal(rule.pattern)
+            if literal:
+                keywords.append((literal.casefold(), i))
+                continue
+            self.regexes.append((i, self.compiled[i]))
+            alone = alone or bool(BACKREFERENCE.search(rule.pattern))
+            combined.append(f"(?:{rule.pattern})")
+        self.automaton = Automaton(keywords) if keywords else None
+        self.prefilter = None
+        if combined and not alone:
+            try:
+                self.prefilter = re.compile("|".join(combined), re.IGNORECASE)
+            except re.error:
+                pass  # e.g. a named group used by two rules; check each rule instead
+
+    def match(self, notes: Optional[str], amount: float) -> Optional[Rule]:
+        """The highest-ranked rule that matches, if any"""
+        notes = notes or ""
+        best: Optional[int] = None
+        for i in chain(self.automaton.find(notes.casefold()) if self.automaton else (), self.always):
+            if (best is None or i < best) and self.rules[i].accepts(amount) and \
+                    (i not in self.compiled or self.compiled[i].search(notes)):
+                best = i
+        if self.regexes and (self.prefilter is None or self.prefilter.search(notes)):
+            for i, pattern in self.regexes:
+                if best is not None and i > best:
+                    break
+                if self.rules[i].accepts(amount) and pattern.search(notes):
+                    best = i
+                    break
+        return self.rules[best] if best is not None else None
+
+    def classify(self, notes: Optional[str], amount: float) -> Optional[int]:
+        rule = self.match(notes, amount)
+        return rule.category_id if rule else None
+
+
+trackers.register("rules", RuleSet)
+trackers.invalidate_on("rules", *WATCHED)
+
+
+def get(db: Session) -> RuleSet:
+    return trackers.get("rules", db)
+
+
+def recategorize(db: Session, from_date: Optional[date] = None, to_date: Optional[date] = None,
+                 dry_run: bool = False) -> RecategorizeResult:
+    """Re-apply the rules to recorded expenses, CHUNK rows per transaction.
+
+    Expenses no rule matches keep their category. Each chunk commits on
+    its own (and is its own undo step), so the write gate is free between
+    chunks and other writes are not held up behind a long history.
+    Archived years are read-only and left alone.
+    """
+    ruleset = get(db)
+    result = RecategorizeResult(scanned=0, matched=0, changed=0, chunks=0)
+    query = select(ExpenseDB.id, ExpenseDB.notes, ExpenseDB.amount, ExpenseDB.category_id)
+    if from_date:
+        query = query.where(ExpenseDB.date >= from_date)
+    if to_date:
+        query = query.where(ExpenseDB.date <= to_date)
+    last_id = 0
+    while True:
+        rows = db.execute(query.where(ExpenseDB.id > last_id).order_by(ExpenseDB.id).limit(CHUNK)).all()
+        db.rollback()  # end the read snapshot before writing
+        if not rows:
+            return result
+        last_id = rows[-1].id
+        result.scanned += len(rows)
+        result.chunks += 1
+        changes = {}
+        for row in rows:
+            category_id = ruleset.classify(row.notes, row.amount)
+            if category_id is None:
+                continue
+            result.matched += 1
+            if category_id != row.category_id:
+                changes[row.id] = category_id
+        result.changed += len(changes)
+        if changes and not dry_run:
+            for expense in db.query(ExpenseDB).filter(ExpenseDB.id.in_(changes)).all():
+                # Recomputed from the row as it is now, in case it was edited meanwhile
+                category_id = ruleset.classify(expense.notes, expense.amount)
+                if category_id is not None and category_id != expense.category_id:
+                    expense.category_id = category_id
+                    expense.updated_at = datetime.utcnow()
+            db.commit()
@@ -0,0 +1,445 @@
+# SoloWealth - Personal Finance Tracker
+# sync.py - Offline-first delta sync between installs (file or HTTP peer)
+
+import gzip
+import json
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+import uuid
+import zlib
+from datetime import date, datetime
+from enum import Enum
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from sqlalchemy import event, inspect, insert, select, text, update
+from sqlalchemy.engine import Connection
+from sqlalchemy.orm import Session
+
+import archive
+import journal
+import trackers
+from models import (
+    BudgetDB, CategoryDB, CategoryRuleDB, ConfigDB, ConfigHistoryDB, DebtDB, ExpenseDB, InvestmentDB,
+    SyncPeerDB, SyncResult, SyncStateDB, SyncStatus, SyncTombstoneDB
+)
+from profiles import PROFILE_HEADER
+
+# Every synced row carries a uuid, the hybrid logical clock (HLC) of its last
+# change and the local sequence number of the transaction that wrote it. A
+# change set holds the rows and tombstones written after a peer's watermark
+# on that sequence; the receiver keeps whichever version has the higher HLC.
+# HLCs are "<wall ms>.<counter>.<node id>", fixed width, so they compare as
+# strings and two installs never produce the same one.
+
+FORMAT = "solowealth-sync"
+FORMAT_VERSION = 1
+NAMESPACE = uuid.UUID("6f1d3b8e-2c47-4e5a-9b0d-8a7c5e4f3d21")
+BASE_HLC = f"{0:013d}.{0:05d}.{'0' * 32}"  # rows that predate sync, identical on every install
+MAX_COUNTER = 99999
+CHUNK = 500
+PEER_TIMEOUT = 60.0
+
+# Parents first: rows are applied in this order, tombstones in reverse
+SYNCED = {model.__tablename__: model for model in (
+    CategoryDB, ConfigDB, ConfigHistoryDB, BudgetDB, CategoryRuleDB, DebtDB, InvestmentDB, ExpenseDB
+)}
+ORDER = {table: position for position, table in enumerate(SYNCED)}
+# Rows with a natural key get a uuid derived from it, so installs that
+# create the same category or setting independently merge instead of clashing
+NATURAL_KEYS = {
+    "categories": ("name",),
+    "config": ("key",),
+    "config_history": ("key", "effective_from"),
+    "budgets": ("category_id", "period"),
+}
+LOCAL_COLUMNS = ("id", "sync_seq")
+
+T = SyncTombstoneDB
+STEP = text("UPDATE sync_state SET seq = seq + 1 WHERE id = 1 RETURNING seq, clock, node_id")
+SET_CLOCK = text("UPDATE sync_state SET clock = :clock WHERE id = 1")
+BURY = text(
+    "INSERT INTO sync_tombstones (uuid, table_name, hlc, sync_seq) VALUES (:uuid, :table_name, :hlc, :sync_seq) "
+    "ON CONFLICT (uuid) DO UPDATE SET table_name = excluded.table_name, hlc = excluded.hlc, "
+    "sync_seq = excluded.sync_seq WHERE excluded.hlc > sync_tombstones.hlc"
+)
+
+
+class SyncError(Exception):
+    pass
+
+
+def _format(wall: int, counter: int, node: str) -> str:
+    return f"{wall:013d}.{counter:05d}.{node}"
+
+
+def tick(last: str, observed: Iterable[str], node: str) -> str:
+    """Next HLC of this node: later than its last one and every HLC it has seen"""
+    wall, counter, _ = max([last, *observed]).split(".")
+    wall, counter = int(wall), int(counter)
+    now = int(time.time() * 1000)
+    if now > wall:
+        return _format(now, 0, node)
+    if counter >= MAX_COUNTER:
+        return _format(wall + 1, 0, node)
+    return _format(wall, counter + 1, node)
+
+
+def natural_uuid(table: str, key: Iterable) -> str:
+    return uuid.uuid5(NAMESPACE, ":".join([table, *map(str, key)])).hex
+
+
+def _key_value(session: Session, column: str, value):
+    if column == "category_id":
+        category = session.get(CategoryDB, value)
+        return category.uuid if category is not None and category.uuid else value
+    if isinstance(value, Enum):
+        return value.value
+    return value.isoformat() if isinstance(value, date) else value
+
+
+def _new_uuid(session: Session, obj) -> str:
+    table = obj.__tablename__
+    if table not in NATURAL_KEYS:
+        return uuid.uuid4().hex
+    return natural_uuid(table, [_key_value(session, column, getattr(obj, column)) for column in NATURAL_KEYS[table]])
+
+
+def _hlcs(obj) -> List[str]:
+    history = inspect(obj).attrs.hlc.history
+    return [hlc for hlc in (obj.hlc, *history.deleted) if hlc]
+
+
+# Capture: stamp every synced write, and bury every synced delete, in the
+# flushing transaction. Rows being applied from a peer keep the peer's HLC.
+@event.listens_for(Session, "before_flush")
+def _stamp(session, flush_context, instances):
+    new = [obj for obj in session.new if obj.__tablename__ in SYNCED]
+    dirty = [obj for obj in session.dirty if obj.__tablename__ in SYNCED and session.is_modified(obj)]
+    deleted = [obj for obj in session.deleted if obj.__tablename__ in SYNCED]
+    buried = session.info.pop("sync_buried", [])
+    if not (new or dirty or deleted or buried):
+        return
+    remote: Dict = session.info.get("sync_remote", {})
+    seq, last, node = session.execute(STEP).one()
+    observed = [hlc for obj in new + dirty + deleted for hlc in _hlcs(obj)]
+    hlc = tick(last, observed + list(remote.values()) + [t["hlc"] for t in buried], node)
+    for obj in sorted((obj for obj in new if not obj.uuid), key=lambda obj: ORDER[obj.__tablename__]):
+        obj.uuid = _new_uuid(session, obj)
+    for obj in new + dirty:
+        obj.hlc = remote.get(obj, hlc)
+        obj.sync_seq = seq
+    tombstones = [dict(uuid=obj.uuid, table_name=obj.__tablename__, hlc=remote.get(obj, hlc), sync_seq=seq)
+                  for obj in deleted if obj.uuid]
+    tombstones += [dict(t, sync_seq=seq) for t in buried]
+    if tombstones:
+        session.execute(BURY, tombstones)
+    session.execute(SET_CLOCK, {"clock": hlc})
+
+
+def initialize(conn: Connection, tables: Iterable[str] = tuple(SYNCED)) -> None:
+    """Give a ledger its sync identity and stamp the rows of `tables` written before sync existed"""
+    if conn.execute(select(SyncStateDB.id)).first() is None:
+        conn.execute(insert(SyncStateDB).values(id=1, node_id=uuid.uuid4().hex, clock=BASE_HLC, seq=1))
+    categories: Dict[int, str] = {}
+    for table in tables:
+        targets = [f"main.{table}"] + (["archive.expenses"] if table == "expenses" else [])
+        for target in targets:
+            rows = conn.execute(text(f"SELECT * FROM {target} WHERE uuid IS NULL")).mappings().all()
+            stamps = []
+            for row in rows:
+                if table in NATURAL_KEYS:
+                    key = [categories.get(row[c], row[c]) if c == "category_id" else row[c]
+                           for c in NATURAL_KEYS[table]]
+                else:
+                    # Copies of one file get the same ids, installs of their own get different ones
+                    key = [row["id"], row["created_at"]]
+                stamps.append({"id": row["id"], "uuid": natural_uuid(table, key), "hlc": BASE_HLC})
+            if stamps:
+                conn.execute(text(f"UPDATE {target} SET uuid = :uuid, hlc = :hlc, sync_seq = 1 WHERE id = :id"), stamps)
+        if table == "categories":
+            categories = dict(conn.execute(text("SELECT id, uuid FROM categories")).all())
+
+
+def status(db: Session) -> SyncStatus:
+    node, seq = db.execute(select(SyncStateDB.node_id, SyncStateDB.seq)).one()
+    peers = db.query(SyncPeerDB).order_by(SyncPeerDB.last_sync_at.desc()).all()
+    return SyncStatus(node_id=node, seq=seq, peers=peers)
+
+
+def new_identity(db: Session) -> str:
+    """Give the ledger a new node id, e.g. after it was restored or copied.
+
+    Peers then treat it as a new install and send it everything again
+    (harmless, applying a change twice is a no-op), and it no longer
+    assumes they have any of its own changes.
+    """
+    node = uuid.uuid4().hex
+    db.execute(update(SyncStateDB).where(SyncStateDB.id == 1).values(node_id=node))
+    db.execute(update(SyncPeerDB).values(acked=0))
+    db.commit()
+    return node
+
+
+def _payload(db: Session, since: Optional[int], peer: Optional[str]) -> dict:
+    # The watermark is read first: rows committed meanwhile are sent again
+    # next time at worst, never skipped
+    node, until = db.execute(select(SyncStateDB.node_id, SyncStateDB.seq)).one()
+    if since is None:
+        known = db.get(SyncPeerDB, peer) if peer else None
+        since = known.acked if known else 0
+    categories = dict(db.execute(select(CategoryDB.id, CategoryDB.uuid)).all())
+    tables = {}
+    for table, model in SYNCED.items():
+        source = archive.expenses_all if model is ExpenseDB else model.__table__
+        columns = [column for column in source.columns if column.name not in LOCAL_COLUMNS]
+        query = select(*columns).where(source.c.sync_seq > since)
+        if peer:
+            # Versions the peer wrote itself: it has them, or newer ones
+            query = query.where(source.c.hlc.not_like(f"%.{peer}"))
+        rows = []
+        for row in db.execute(query):
+            values = row._asdict()
+            if "category_id" in values:
+                values["category_id"] = categories.get(values["category_id"])
+            rows.append([journal.encode(values[column.name]) for column in columns])
+        if rows:
+            tables[table] = {"columns": [column.name for column in columns], "rows": rows}
+    query = select(T.table_name, T.uuid, T.hlc).where(T.sync_seq > since)
+    if peer:
+        query = query.where(T.hlc.not_like(f"%.{peer}"))
+    tombstones = [list(row) for row in db.execute(query)]
+    received = dict(db.execute(select(SyncPeerDB.node_id, SyncPeerDB.received)).all())
+    return {"format": FORMAT, "version": FORMAT_VERSION, "node": node, "since": since, "until": until,
+            "received": received, "rows": tables, "tombstones": tombstones}
+
+
+def changes(db: Session, since: Optional[int] = None, peer: Optional[str] = None) -> Tuple[bytes, int]:
+    """Gzipped change set of everything written after `since` (default: what `peer` acknowledged).
+
+    Returns the data and the sequence number it runs up to.
+    """
+    payload = _payload(db, since, peer)
+    return gzip.compress(json.dumps(payload, separators=(",", ":")).encode()), payload["until"]
+
+
+def _unpack(data: bytes) -> dict:
+    try:
+        payload = json.loads(gzip.decompress(data))
+    except (OSError, EOFError, ValueError, zlib.error):
+        raise SyncError("Not a SoloWealth change set")
+    if not isinstance(payload, dict) or payload.get("format") != FORMAT:
+        raise SyncError("Not a SoloWealth change set")
+    if payload.get("version") != FORMAT_VERSION:
+        raise SyncError(f"Change set version {payload.get('version')} is not supported")
+    return payload
+
+
+def apply(db: Session, data: bytes) -> SyncResult:
+    """Merge a change set into the ledger in one transaction.
+
+    Per row the version with the higher HLC wins, deletions included, so
+    every install ends up with the same data whatever order change sets
+    arrive in. Changes go through the ORM: they are journaled (one undo
+    reverts the whole sync) and trackers and rollups follow.
+    """
+    payload = _unpack(data)
+    node = db.execute(select(SyncStateDB.node_id)).scalar()
+    sender = payload.get("node")
+    if sender == node:
+        raise SyncError("These changes come from this ledger itself, or from a copy of its file; "
+                        "give one of the copies a new identity (POST /api/sync/identity) first")
+    result = SyncResult(peer=str(sender), applied=0, skipped=0, conflicts=[])
+    db.info["sync_remote"] = {}
+    try:
+        _apply_rows(db, payload.get("rows", {}), result)
+        _apply_tombstones(db, payload.get("tombstones", []), result)
+        peer = db.get(SyncPeerDB, sender)
+        if peer is None:
+            peer = SyncPeerDB(node_id=sender, received=0, acked=0)
+            db.add(peer)
+        if payload["since"] <= peer.received:
+            peer.received = max(peer.received, payload["until"])
+        peer.acked = max(peer.acked, payload.get("received", {}).get(node, 0))
+        peer.last_sync_at = datetime.utcnow()
+        db.commit()
+    except (KeyError, TypeError, ValueError, AttributeError) as e:
+        db.rollback()
+        raise SyncError(f"Malformed change set: {e!r}")
+    except Exception:
+        db.rollback()
+        raise
+    finally:
+        db.info.pop("sync_remote", None)
+        db.info.pop("sync_buried", None)
+    return result
+
+
+def _chunks(items: List, size: int = CHUNK):
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+
+def _archived_uuids(db: Session, uuids: List[str]) -> Dict[str, Tuple[int, str]]:
+    """(year, hlc) of the given expenses that sit in an archived year here"""
+    years = trackers.get("archive", db).years
+    if not years:
+        return {}
+    source = archive.expenses_all
+    rows = db.execute(select(source.c.uuid, source.c.date, source.c.hlc).where(source.c.uuid.in_(uuids))).all()
+    return {key: (day.year, hlc or "") for key, day, hlc in rows if day.year in years}
+
+
+def _apply_rows(db: Session, tables: Dict, result: SyncResult) -> None:
+    remote = db.info["sync_remote"]
+    years = trackers.get("archive", db).years
+    for table, model in SYNCED.items():
+        if table not in tables:
+            continue
+        columns = tables[table]["columns"]
+        incoming = [dict(zip(columns, row)) for row in tables[table]["rows"]]
+        categories = dict(db.execute(select(CategoryDB.uuid, CategoryDB.id)).all())
+        for chunk in _chunks(incoming):
+            uuids = [values["uuid"] for values in chunk]
+            local = {obj.uuid: obj for obj in db.query(model).filter(model.uuid.in_(uuids))}
+            buried = dict(db.execute(select(T.uuid, T.hlc).where(T.uuid.in_(uuids))).all())
+            archived = _archived_uuids(db, uuids) if model is ExpenseDB else {}
+            for values in chunk:
+                key, hlc = values.pop("uuid"), values.pop("hlc")
+                obj = local.get(key)
+                current = (obj.hlc or "") if obj is not None else buried.get(key, "")
+                if key in archived:
+                    current = max(current, archived[key][1])
+                if hlc <= current:
+                    result.skipped += 1
+                    continue
+                if "category_id" in values:
+                    category = values["category_id"]
+                    values["category_id"] = categories.get(category)
+                    if values["category_id"] is None:
+                        result.conflicts.append(f"{table} {key}: category {category} is unknown here")
+                        continue
+                fields = journal.decode(model, values)
+                if model is ExpenseDB and (key in archived or fields["date"].year in years):
+                    year = archived[key][0] if key in archived else fields["date"].year
+                    result.conflicts.append(f"{table} {key}: {year} is archived here")
+                    continue
+                clash = _natural_clash(db, table, model, key, fields)
+                if clash:
+                    result.conflicts.append(clash)
+                    continue
+                if obj is None:
+                    obj = model(uuid=key, **fields)
+                    db.add(obj)
+                else:
+                    for name, value in fields.items():
+                        setattr(obj, name, value)
+                obj.hlc = hlc
+                remote[obj] = hlc
+                result.applied += 1
+        db.flush()
+
+
+def _natural_clash(db: Session, table: str, model, key: str, fields: dict) -> Optional[str]:
+    if table not in NATURAL_KEYS:
+        return None
+    criteria = {column: fields[column] for column in NATURAL_KEYS[table]}
+    other = db.query(model).filter_by(**criteria).filter(model.uuid != key).first()
+    if other is None:
+        return None
+    described = ", ".join(f"{column}={value}" for column, value in criteria.items())
+    return f"{table} {key}: another row here already has {described}"
+
+
+def _apply_tombstones(db: Session, tombstones: List, result: SyncResult) -> None:
+    remote = db.info["sync_remote"]
+    by_table: Dict[str, List] = {}
+    for table, key, hlc in tombstones:
+        if table not in SYNCED:
+            # From a newer install; its rows are passed over the same way
+            result.skipped += 1
+            continue
+        by_table.setdefault(table, []).append((key, hlc))
+    for table in reversed(list(SYNCED)):
+        model = SYNCED[table]
+        for chunk in _chunks(by_table.get(table, [])):
+            uuids = [key for key, _ in chunk]
+            local = {obj.uuid: obj for obj in db.query(model).filter(model.uuid.in_(uuids))}
+            buried = dict(db.execute(select(T.uuid, T.hlc).where(T.uuid.in_(uuids))).all())
+            archived = _archived_uuids(db, uuids) if model is ExpenseDB else {}
+            for key, hlc in chunk:
+                obj = local.get(key)
+                if key in archived:
+                    if hlc <= archived[key][1]:
+                        result.skipped += 1
+                        continue
+                    result.conflicts.append(f"{table} {key}: {archived[key][0]} is archived here")
+                elif obj is None:
+                    if hlc <= buried.get(key, ""):
+                        result.skipped += 1
+                        continue
+                    # Never had the row; keep the tombstone so it reaches other peers
+                    db.info.setdefault("sync_buried", []).append(dict(uuid=key, table_name=table, hlc=hlc))
+                    result.applied += 1
+                elif hlc <= (obj.hlc or ""):
+                    result.skipped += 1
+                elif model is CategoryDB and _category_in_use(db, obj.id):
+                    result.conflicts.append(f"{table} {key}: category '{obj.name}' still has expenses here")
+                else:
+                    if model is CategoryDB:
+                        for dependents in (BudgetDB, CategoryRuleDB):
+                            for dependent in db.query(dependents).filter(dependents.category_id == obj.id).all():
+                                db.delete(dependent)
+                    db.delete(obj)
+                    remote[obj] = hlc
+                    result.applied += 1
+        db.flush()
+
+
+def _category_in_use(db: Session, category_id: int) -> bool:
+    history = archive.expenses_all
+    return db.execute(select(history.c.id).where(history.c.category_id == category_id).limit(1)).first() is not None
+
+
+def _request(url: str, profile: Optional[str], data: Optional[bytes] = None) -> bytes:
+    headers = {PROFILE_HEADER: profile} if profile else {}
+    if data is not None:
+        headers["Content-Type"] = "application/gzip"
+    try:
+        with urllib.request.urlopen(urllib.request.Request(url, data=data, headers=headers),
+                                    timeout=PEER_TIMEOUT) as response:
+            return response.read()
+    except urllib.error.HTTPError as e:
+        detail = e.read().decode(errors="replace")
+        try:
+            detail = json.loads(detail).get("detail", detail)
+        except ValueError:
+            pass
+        raise SyncError(f"{url}: {e.code} {detail}")
+    except (urllib.error.URLError, OSError) as e:
+        raise SyncError(f"Cannot reach {url}: {e}")
+
+
+def exchange(db: Session, url: str, profile: Optional[str] = None) -> Tuple[SyncResult, SyncResult]:
+    """Two-way sync with another running install: pull its changes, then push ours"""
+    base = url.rstrip("/")
+    if urllib.parse.urlparse(base).scheme not in ("http", "https"):
+        raise SyncError("Peer URL must start with http:// or https://")
+    node = db.execute(select(SyncStateDB.node_id)).scalar()
+    try:
+        theirs = json.loads(_request(f"{base}/api/sync/status", profile))["node_id"]
+    except (ValueError, KeyError, TypeError):
+        raise SyncError(f"{base} is not a SoloWealth install")
+    if theirs == node:
+        raise SyncError("The peer is this ledger itself, or a copy of its file")
+    known = db.get(SyncPeerDB, theirs)
+    query = urllib.parse.urlencode({"since": known.received if known else 0, "peer": node})
+    pulled = apply(db, _request(f"{base}/api/sync/changes?{query}", profile))
+    data, until = changes(db, peer=theirs)
+    pushed = SyncResult(**json.loads(_request(f"{base}/api/sync/changes", profile, data)))
+    peer = db.get(SyncPeerDB, theirs)
+    peer.url = base
+    peer.acked = max(peer.acked, until)
+    db.commit()
+    return pulled, pushed
@@ -0,0 +1,53 @@
+# SoloWealth - Personal Finance Tracker
+# tests/conftest.py - One throwaway app with two ledgers for the whole test run
+
+import os
+import sys
+import tempfile
+from datetime import date
+
+import pytest
+
+# main reads its profiles and schedules at import, so point them at a scratch folder first
+DATA_DIR = tempfile.mkdtemp(prefix="solowealth-tests-")
+os.environ["SOLOWEALTH_DB"] = os.path.join(DATA_DIR, "finance.db")
+os.environ["SOLOWEALTH_PROFILES"] = "peer=" + os.path.join(DATA_DIR, "peer.db")
+os.environ["SOLOWEALTH_BACKUP_INTERVAL_HOURS"] = "0"
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+PEER = {"X-SoloWealth-Profile": "peer"}
+
+
+@pytest.fixture(scope="session")
+def client():
+    from fastapi.testclient import TestClient
+
+    import main
+    with TestClient(main.app) as client:
+        yield client
+
+
+@pytest.fixture(scope="session")
+def category_id(client):
+    return client.get("/api/categories").json()[0]["id"]
+
+
+@pytest.fixture
+def add_expense(client, category_id):
+    """Post an expense (to the ledger of `headers`) and return it"""
+    def add(amount: float, notes: str, headers: dict = None, day: date = None) -> dict:
+        response = client.post("/api/expenses", headers=headers or {}, json={
+            "date": (day or date.today()).isoformat(), "amount": amount, "category_id": category_id, "notes": notes
+        })
+        assert response.status_code == 200, response.text
+        return response.json()
+    return add
+
+
+@pytest.fixture
+def expense(client):
+    """The expense with `expense_id` as the API lists it now, or None"""
+    def find(expense_id: int, headers: dict = None):
+        return next((e for e in client.get("/api/expenses", headers=headers or {}).json() if e["id"] == expense_id),
+                    None)
+    return find
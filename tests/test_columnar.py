@@ -0,0 +1,29 @@
+# SoloWealth - Personal Finance Tracker
+# tests/test_columnar.py - On-disk generations of the expense column cache
+
+import json
+import os
+
+import columnar
+from profiles import engine_pool
+
+
+def cached_files():
+    """Generations present in the cache folder, and those meta.json names"""
+    folder = columnar.cache_dir(engine_pool.engine())
+    with open(os.path.join(folder, "meta.json"), encoding="utf-8") as f:
+        meta = json.load(f)
+    named = {f"{table}-{meta[table]['generation']}" for table in columnar.LAYOUTS if table in meta}
+    stems = {name.split(".", 1)[0] for name in os.listdir(folder) if name.endswith(".npy")}
+    return stems, named
+
+
+def test_restore_leaves_only_the_new_generation(client, add_expense):
+    saved = client.post("/api/backup", json={"compression": None}).json()
+    add_expense(5, "after the backup")
+    assert client.get("/api/reports/monthly").status_code == 200
+    restored = client.post("/api/restore", json={"name": saved["name"]})
+    assert restored.status_code == 200, restored.text
+    assert client.get("/api/reports/monthly").status_code == 200
+    stems, named = cached_files()
+    assert stems == named
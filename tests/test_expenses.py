@@ -0,0 +1,20 @@
+# SoloWealth - Personal Finance Tracker
+# tests/test_expenses.py - Listing expenses by month and year
+
+from datetime import date
+
+import pytest
+
+
+@pytest.mark.parametrize("params", [
+    {"year": 2024, "month": 13}, {"year": 2024, "month": 0}, {"month": 13}, {"year": 0}, {"year": 10000},
+])
+def test_out_of_range_month_or_year_is_rejected(client, params):
+    assert client.get("/api/expenses", params=params).status_code == 422
+
+
+def test_month_filter(client, add_expense):
+    row = add_expense(3, "december", day=date(2023, 12, 31))
+    ids = [e["id"] for e in client.get("/api/expenses", params={"year": 2023, "month": 12}).json()]
+    assert row["id"] in ids
+    assert row["id"] not in [e["id"] for e in client.get("/api/expenses", params={"year": 2023, "month": 11}).json()]
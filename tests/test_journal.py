@@ -0,0 +1,96 @@
+# SoloWealth - Personal Finance Tracker
+# tests/test_journal.py - Undo and point-in-time reads from the change journal
+
+import time
+from datetime import datetime
+
+from sqlalchemy import text
+
+import journal
+from models import SessionLocal
+from profiles import engine_pool
+
+
+def undo(client) -> dict:
+    response = client.post("/api/undo")
+    assert response.status_code == 200, response.text
+    return response.json()
+
+
+def test_undo_update(client, add_expense, expense):
+    row = add_expense(10, "undo update")
+    client.put(f"/api/expenses/{row['id']}", json={"amount": 20, "notes": "edited"})
+    assert undo(client)["changes"] == 1
+    restored = expense(row["id"])
+    assert (restored["amount"], restored["notes"]) == (10, "undo update")
+
+
+def test_undo_steps_back_through_several_updates(client, add_expense, expense):
+    row = add_expense(10, "undo twice")
+    client.put(f"/api/expenses/{row['id']}", json={"amount": 20})
+    client.put(f"/api/expenses/{row['id']}", json={"amount": 30})
+    undo(client)
+    assert expense(row["id"])["amount"] == 20
+    undo(client)
+    assert expense(row["id"])["amount"] == 10
+
+
+def test_undo_delete(client, add_expense, expense):
+    row = add_expense(42.5, "undo delete")
+    client.delete(f"/api/expenses/{row['id']}")
+    assert expense(row["id"]) is None
+    undo(client)
+    restored = expense(row["id"])
+    assert (restored["amount"], restored["notes"], restored["date"]) == (42.5, "undo delete", row["date"])
+
+
+def test_undo_insert(client, add_expense, expense):
+    row = add_expense(7, "undo insert")
+    undo(client)
+    assert expense(row["id"]) is None
+
+
+def test_undo_refuses_a_row_changed_since(client, add_expense, expense):
+    row = add_expense(5, "changed elsewhere")
+    client.put(f"/api/expenses/{row['id']}", json={"amount": 6})
+    set_amount = text("UPDATE expenses SET amount = :amount WHERE id = :id")
+    with engine_pool.engine().begin() as conn:
+        conn.execute(set_amount, {"amount": 99, "id": row["id"]})  # around the journal
+    refused = client.post("/api/undo")
+    assert refused.status_code == 400 and "changed since" in refused.json()["detail"]
+    with engine_pool.engine().begin() as conn:
+        conn.execute(set_amount, {"amount": 6, "id": row["id"]})
+    undo(client)
+    assert expense(row["id"])["amount"] == 5
+
+
+def test_as_of_across_compaction(client, add_expense):
+    row = add_expense(100, "as of")
+    time.sleep(0.01)
+    after_insert = datetime.utcnow()
+    time.sleep(0.01)
+    client.put(f"/api/expenses/{row['id']}", json={"amount": 200})
+    time.sleep(0.01)
+    after_first_update = datetime.utcnow()
+    time.sleep(0.01)
+    client.put(f"/api/expenses/{row['id']}", json={"amount": 300})
+
+    # Keep only the two updates: the insert and everything before it is compacted away
+    db = SessionLocal(bind=engine_pool.engine())
+    try:
+        assert journal.compact(db, max_rows=2) > 0
+        horizon = journal.horizon(db)
+    finally:
+        db.close()
+    assert horizon is not None and horizon < after_insert
+
+    def amount_at(at: datetime):
+        response = client.get("/api/as-of/expenses", params={"at": at.isoformat()})
+        assert response.status_code == 200, response.text
+        return next(r["amount"] for r in response.json() if r["id"] == row["id"])
+
+    assert amount_at(after_insert) == 100
+    assert amount_at(after_first_update) == 200
+    assert amount_at(datetime.utcnow()) == 300
+    refused = client.get("/api/as-of/expenses", params={"at": horizon.replace(year=horizon.year - 1).isoformat()})
+    assert refused.status_code == 400
@@ -0,0 +1,53 @@
+# SoloWealth - Personal Finance Tracker
+# tests/test_profiles.py - Creating engines in the per-profile pool
+
+import threading
+
+import pytest
+from sqlalchemy.engine import Engine
+
+import profiles
+from profiles import EnginePool
+
+
+def test_slow_setup_of_one_profile_does_not_block_the_others(tmp_path):
+    pool = EnginePool("default", {"default": str(tmp_path / "a.db"), "slow": str(tmp_path / "b.db")})
+    started, finish = threading.Event(), threading.Event()
+
+    def setup(engine):
+        if engine.url.database.endswith("b.db"):
+            started.set()
+            assert finish.wait(5)
+    pool.on_create.append(setup)
+
+    slow = threading.Thread(target=pool.engine, args=("slow",))
+    slow.start()
+    try:
+        assert started.wait(5)
+        pool.engine()  # would wait for "slow" if setup ran under the pool lock
+    finally:
+        finish.set()
+        slow.join()
+    assert len(pool.open_engines()) == 2
+    pool.dispose()
+
+
+def test_failed_setup_disposes_the_engine(tmp_path, monkeypatch):
+    create_profile_engine, created, disposed = profiles.create_profile_engine, [], []
+
+    def create(path):
+        created.append(create_profile_engine(path))
+        return created[-1]
+    monkeypatch.setattr(profiles, "create_profile_engine", create)
+    monkeypatch.setattr(Engine, "dispose", lambda engine, close=True: disposed.append(engine))
+
+    def fail(engine):
+        raise RuntimeError("migration failed")
+    pool = EnginePool("default", {"default": str(tmp_path / "a.db")})
+    pool.on_create.append(fail)
+    with pytest.raises(RuntimeError):
+        pool.engine()
+    assert disposed == created and pool.open_engines() == []
+
+    pool.on_create.remove(fail)
+    assert pool.engine() is created[-1]  # the next request tries again
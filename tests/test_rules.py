@@ -0,0 +1,66 @@
+# SoloWealth - Personal Finance Tracker
+# tests/test_rules.py - Literal factoring and matching of category rules
+
+import re
+
+import pytest
+
+from rules import Automaton, required_literal
+
+
+@pytest.mark.parametrize("pattern, literal", [
+    ("spotify", "spotify"),
+    (r"amazon\.in", "amazon"),
+    # Optional characters end a run, and the one made optional is dropped
+    ("colou?r", "colo"),
+    ("ab?cdefg", "cdefg"),
+    ("ama*zon", "zon"),
+    ("uber ?eats", "uber"),
+    ("net{2,3}flix", "flix"),
+    # Character classes are skipped, including a leading ']' or '^'
+    ("gr[ae]y", ""),
+    ("[abc]def", "def"),
+    ("[]x]yzw", "yzw"),
+    ("[^0-9]+rent", "rent"),
+    # Escapes: classes and anchors split runs, character escapes rule a literal out
+    (r"\bswiggy\b", "swiggy"),
+    (r"\d{3}abcd", "abcd"),
+    (r"\x41mazon", ""),
+    (r"(ab)c\1defg", ""),
+    # Non-ASCII letters (casefolding may change their length) split runs
+    ("éclair", "clair"),
+    # Alternation, inline flags and runs shorter than MIN_LITERAL give nothing
+    ("uber|ola", ""),
+    ("(?i)zomato", ""),
+    ("x+yz", ""),
+])
+def test_required_literal(pattern, literal):
+    assert required_literal(pattern) == literal
+
+
+@pytest.mark.parametrize("pattern, text", [
+    ("colou?r", "Paint color"),
+    ("net{2,3}flix", "netttflix monthly"),
+    (r"\bswiggy\b", "order via swiggy today"),
+    ("[^0-9]+rent", "March rent"),
+])
+def test_required_literal_occurs_in_every_match(pattern, text):
+    match = re.search(pattern, text, re.IGNORECASE)
+    assert match and required_literal(pattern).casefold() in match.group(0).casefold()
+
+
+def test_automaton_finds_overlapping_keywords():
+    automaton = Automaton([("he", 0), ("she", 1), ("his", 2), ("hers", 3)])
+    assert sorted(automaton.find("ushers")) == [0, 1, 3]
+    assert automaton.find("nothing") == []
+
+
+def test_commits_invalidate_the_category_and_rule_caches(client):
+    client.get("/api/rules/classify", params={"amount": 1, "notes": "warm up"})  # both caches loaded
+    category = client.post("/api/categories", json={"name": "Pets"}).json()
+    rule = client.post("/api/rules", json={"category_id": category["id"], "pattern": "kibble", "priority": 100})
+    assert rule.status_code == 200, rule.text  # the new category is known without a restart
+    match = client.get("/api/rules/classify", params={"amount": 20, "notes": "Kibble 5kg"}).json()
+    assert (match["rule_id"], match["category_name"]) == (rule.json()["id"], "Pets")
+    client.delete(f"/api/rules/{rule.json()['id']}")
+    assert client.get("/api/rules/classify", params={"amount": 20, "notes": "Kibble 5kg"}).json()["rule_id"] is None
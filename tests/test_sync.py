@@ -0,0 +1,82 @@
+# SoloWealth - Personal Finance Tracker
+# tests/test_sync.py - Change-set exchange between two installs (the default and "peer" ledgers)
+
+import time
+
+from conftest import PEER
+
+HERE = {}
+
+
+def node_id(client, headers: dict) -> str:
+    return client.get("/api/sync/status", headers=headers).json()["node_id"]
+
+
+def push(client, source: dict, target: dict) -> dict:
+    """Send `source`'s changes that `target` has not seen yet; returns the apply result"""
+    changes = client.get("/api/sync/changes", params={"peer": node_id(client, target)}, headers=source)
+    assert changes.status_code == 200, changes.text
+    result = client.post("/api/sync/changes", content=changes.content,
+                         headers=dict(target, **{"Content-Type": "application/gzip"}))
+    assert result.status_code == 200, result.text
+    return result.json()
+
+
+def exchange(client) -> None:
+    push(client, HERE, PEER)
+    push(client, PEER, HERE)
+
+
+def by_notes(client, notes: str, headers: dict):
+    return next((e for e in client.get("/api/expenses", headers=headers).json() if e["notes"] == notes), None)
+
+
+def edit(client, notes: str, headers: dict, **changes) -> None:
+    row = by_notes(client, notes, headers)
+    response = client.put(f"/api/expenses/{row['id']}", json=changes, headers=headers)
+    assert response.status_code == 200, response.text
+    time.sleep(0.002)  # the next edit gets a later wall clock as well as a later HLC
+
+
+def test_new_expense_reaches_the_peer(client, add_expense):
+    add_expense(12.5, "sync new")
+    exchange(client)
+    assert by_notes(client, "sync new", PEER)["amount"] == 12.5
+
+
+def test_conflicting_edits_keep_the_newer_one(client, add_expense):
+    add_expense(10, "sync conflict")
+    exchange(client)
+    edit(client, "sync conflict", HERE, amount=1)
+    edit(client, "sync conflict", PEER, amount=2)
+    exchange(client)
+    assert by_notes(client, "sync conflict", HERE)["amount"] == 2
+    assert by_notes(client, "sync conflict", PEER)["amount"] == 2
+
+    # And the other way round: the newer edit wins whichever side made it
+    edit(client, "sync conflict", PEER, amount=4)
+    edit(client, "sync conflict", HERE, amount=3)
+    exchange(client)
+    assert by_notes(client, "sync conflict", HERE)["amount"] == 3
+    assert by_notes(client, "sync conflict", PEER)["amount"] == 3
+
+
+def test_delete_propagates(client, add_expense):
+    row = add_expense(20, "sync delete")
+    exchange(client)
+    assert by_notes(client, "sync delete", PEER) is not None
+    client.delete(f"/api/expenses/{row['id']}")
+    exchange(client)
+    assert by_notes(client, "sync delete", PEER) is None
+    assert by_notes(client, "sync delete", HERE) is None
+
+
+def test_later_edit_beats_an_earlier_delete(client, add_expense):
+    row = add_expense(30, "sync delete then edit")
+    exchange(client)
+    client.delete(f"/api/expenses/{row['id']}")
+    time.sleep(0.002)
+    edit(client, "sync delete then edit", PEER, amount=31)
+    exchange(client)
+    assert by_notes(client, "sync delete then edit", HERE)["amount"] == 31
+    assert by_notes(client, "sync delete then edit", PEER)["amount"] == 31
@@ -0,0 +1,48 @@
+# SoloWealth - Personal Finance Tracker
+# tests/test_writer.py - Group commit: batched writes stay separate undo steps
+
+import threading
+import time
+from datetime import datetime
+
+import writer
+from models import ExpenseDB
+from profiles import EnginePool, engine_pool
+
+
+def test_writes_to_one_row_in_a_batch_are_undone_one_at_a_time(client, add_expense, expense):
+    row = add_expense(10, "group commit")
+    committer = writer.GroupCommitter(engine_pool.engine(), linger=0.5)
+
+    def set_amount(amount):
+        def work(session):
+            # As the endpoints do; left to onupdate, the journal would record the new stamp as the old one
+            db_expense = session.get(ExpenseDB, row["id"])
+            db_expense.amount, db_expense.updated_at = amount, datetime.utcnow()
+        return work
+
+    try:
+        first = threading.Thread(target=committer.submit, args=(set_amount(20),))
+        first.start()
+        time.sleep(0.05)  # well inside the linger, so both land in one batch
+        committer.submit(set_amount(30))
+        first.join()
+    finally:
+        committer.stop()
+    assert expense(row["id"])["amount"] == 30
+    assert client.post("/api/undo").json()["changes"] == 1
+    assert expense(row["id"])["amount"] == 20
+    client.post("/api/undo")
+    assert expense(row["id"])["amount"] == 10
+
+
+def test_evicted_engine_stops_its_committer(tmp_path):
+    pool = EnginePool("default", {"default": str(tmp_path / "a.db"), "other": str(tmp_path / "b.db")},
+                      idle_seconds=0)
+    pool.on_dispose.append(writer.stop)
+    engine = pool.engine("other")
+    committer = writer._committers[writer.database_path(engine)] = writer.GroupCommitter(engine)
+    pool.engine()  # "other" has been idle past idle_seconds: evicted
+    assert not committer._thread.is_alive()
+    assert writer.database_path(engine) not in writer._committers
+    pool.dispose()
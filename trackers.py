@@ -0,0 +1,313 @@
+# SoloWealth - Personal Finance Tracker
+# trackers.py - In-memory trackers fed by committed expense changes
+
+import json
+import threading
+from datetime import date
+from itertools import chain
+from typing import Callable, Dict, List, NamedTuple, Optional, Tuple
+
+from sqlalchemy import event, inspect, select, text
+from sqlalchemy.orm import Session
+
+from models import ChangeJournalDB, ExpenseDB
+from profiles import WORKERS
+
+# Other server processes write the same ledgers, so every get() checks
+# data_versions and follows their commits
+SHARED = WORKERS > 1
+
+# One statement, so the counters and the journal high-water mark are read
+# from the same snapshot
+SNAPSHOT = text(
+    "SELECT name, version FROM data_versions "
+    "UNION ALL SELECT 'journal', COALESCE(MAX(id), 0) FROM change_journal"
+)
+
+
+class ExpenseRow(NamedTuple):
+    """Immutable snapshot of an expense as seen by trackers"""
+    id: int
+    date: date
+    amount: float
+    category_id: int
+    notes: Optional[str]
+
+
+class Tracker:
+    """Base class for per-ledger state derived from the expenses table.
+
+    A tracker is created lazily by `get()`, loads itself once from the
+    database and is then kept current by `apply()` calls for every
+    committed insert/update/delete of an ExpenseDB row. `version` is the
+    data_versions counter of the expenses table the tracker reflects (during
+    `apply()`, the version that includes the change being applied); a
+    commit that does not follow on from it (rows changed by bulk SQL or
+    another process) marks the tracker stale and `get()` reloads it.
+
+    Commits made by other server processes are never dispatched here; with
+    several workers `get()` replays them from the change journal instead
+    (`journal_id` is the newest entry the tracker reflects), or reloads
+    when the journal does not account for every version step. `tables`
+    lists the data_versions counters the tracker is derived from. While
+    `rebuilding` is set, commits are not dispatched to the tracker; it
+    replays them from the journal once the rebuild is in place.
+    """
+
+    version: Optional[int] = None
+    journal_id: Optional[int] = None
+    stale: bool = False
+    rebuilding: bool = False
+    tables: Tuple[str, ...] = ("expenses",)
+    seen: Dict[str, int] = {}
+
+    def load(self, db: Session) -> None:
+        pass
+
+    def apply(self, old: Optional[ExpenseRow], new: Optional[ExpenseRow]) -> None:
+        pass
+
+    def flush(self) -> None:
+        """Persist anything worth keeping across restarts (called at shutdown)"""
+        pass
+
+
+# Loads retried when writes the journal cannot replay land during them
+LOAD_ATTEMPTS = 3
+
+_factories: Dict[str, Callable[[], Tracker]] = {}
+_instances: Dict[Tuple[str, str], Tracker] = {}
+# Held while changes are dispatched and while a loaded tracker is put in
+# place, so installing never interleaves with the application of a commit
+lock = threading.RLock()
+# One load at a time per tracker, so concurrent readers wait for it instead of repeating it
+_loading: Dict[Tuple[str, str], threading.Lock] = {}
+
+
+def register(name: str, factory: Callable[[], Tracker]) -> None:
+    _factories[name] = factory
+
+
+def ledger_key(db: Session) -> str:
+    return str(db.get_bind().url)
+
+
+def get(name: str, db: Session) -> Tracker:
+    """Return the tracker `name` for the ledger behind `db`, loading it on first use.
+
+    Loading scans the database, so it runs without `lock`: writers keep
+    dispatching their commits (holding the write gate) meanwhile. The
+    loaded tracker then catches up from the journal on what was committed
+    since its snapshot before it is put in place.
+    """
+    key = (ledger_key(db), name)
+    with lock:
+        tracker = _current(db, key)
+        if tracker is not None:
+            return tracker
+        loading = _loading.setdefault(key, threading.Lock())
+    with loading:
+        for _ in range(LOAD_ATTEMPTS):
+            with lock:
+                tracker = _current(db, key)
+                if tracker is not None:
+                    return tracker  # loaded by the thread this one waited for
+            tracker = _load(name, db)
+            with lock:
+                if _settle(db, tracker):
+                    _instances[key] = tracker
+                    return tracker
+        # Still behind (writes around the journal kept landing): good enough
+        # for this caller, and the next get() loads again
+        return tracker
+
+
+def _current(db: Session, key: Tuple[str, str]) -> Optional[Tracker]:
+    """The installed tracker if it is usable as is; caller holds `lock`"""
+    tracker = _instances.get(key)
+    if tracker is not None and not tracker.stale and not tracker.rebuilding and SHARED:
+        follow(db, tracker)
+    return tracker if tracker is not None and not tracker.stale else None
+
+
+def _load(name: str, db: Session) -> Tracker:
+    tracker = _factories[name]()
+    versions = snapshot(db)
+    tracker.seen = {table: versions.get(table, 0) for table in ("epoch",) + tracker.tables
+                    if table != "expenses"}
+    tracker.version, tracker.journal_id = versions.get("expenses", 0), versions["journal"]
+    tracker.load(db)
+    return tracker
+
+
+def _settle(db: Session, tracker: Tracker) -> bool:
+    """Catch a freshly loaded tracker up with the commits made during its load;
+    False if it must be loaded again. Caller holds `lock`.
+    """
+    versions = snapshot(db)
+    if any(versions.get(table, 0) != version for table, version in tracker.seen.items()):
+        return False
+    return tracker.version >= versions.get("expenses", 0) or catch_up(db, tracker, versions)
+
+
+def expenses_version(db: Session) -> int:
+    return db.execute(text("SELECT version FROM data_versions WHERE name = 'expenses'")).scalar() or 0
+
+
+def snapshot(db: Session) -> Dict[str, int]:
+    """data_versions counters plus 'journal', the newest change_journal id"""
+    return dict(db.execute(SNAPSHOT).all())
+
+
+def follow(db: Session, tracker: Tracker) -> None:
+    """Bring a tracker up to date with commits it was not dispatched; caller holds `lock`"""
+    versions = snapshot(db)
+    if any(versions.get(table, 0) != version for table, version in tracker.seen.items()):
+        tracker.stale = True
+    elif "expenses" in tracker.tables and tracker.version < versions.get("expenses", 0):
+        if not catch_up(db, tracker, versions):
+            tracker.stale = True
+
+
+def catch_up(db: Session, tracker: Tracker, versions: Dict[str, int]) -> bool:
+    """Apply the expense changes journaled since the tracker's version.
+
+    Only valid when every version step has its journal entry; writes that
+    bypass the ORM (archive moves, raw SQL) or compacted history make this
+    return False and the tracker must be rebuilt.
+    """
+    if tracker.journal_id is None:
+        return False
+    J = ChangeJournalDB
+    entries = db.execute(
+        select(J.before, J.after).where(J.table_name == "expenses", J.id > tracker.journal_id,
+                                        J.id <= versions["journal"]).order_by(J.id)
+    ).all()
+    if len(entries) != versions["expenses"] - tracker.version:
+        return False
+    for before, after in entries:
+        # Each entry is one version step; apply() may compare against it
+        tracker.version += 1
+        tracker.apply(_journal_row(before), _journal_row(after))
+    tracker.version, tracker.journal_id = versions["expenses"], versions["journal"]
+    return True
+
+
+def _journal_row(image: Optional[str]) -> Optional[ExpenseRow]:
+    if not image:
+        return None
+    values = json.loads(image)
+    return ExpenseRow(values["id"], date.fromisoformat(values["date"]), values["amount"],
+                      values["category_id"], values["notes"])
+
+
+def invalidate(name: str, db: Session) -> None:
+    """Have the next `get()` of tracker `name` reload it"""
+    with lock:
+        tracker = _instances.get((ledger_key(db), name))
+        if tracker is not None:
+            tracker.stale = True
+
+
+def invalidate_on(name: str, *models) -> None:
+    """Invalidate tracker `name` after every commit that wrote a row of one of `models`"""
+    changed = f"{name}_changed"
+
+    def note_changes(session, flush_context):
+        if any(isinstance(obj, models) for obj in chain(session.new, session.dirty, session.deleted)):
+            session.info[changed] = True
+
+    def invalidate_changed(session):
+        if session.info.pop(changed, False):
+            invalidate(name, session)
+
+    def discard(session, previous_transaction):
+        session.info.pop(changed, None)
+
+    event.listen(Session, "after_flush", note_changes)
+    event.listen(Session, "after_commit", invalidate_changed)
+    event.listen(Session, "after_soft_rollback", discard)
+
+
+def reset(db: Session) -> None:
+    """Drop every tracker of a ledger, e.g. after a bulk rewrite of its data"""
+    ledger = ledger_key(db)
+    with lock:
+        for key in [k for k in _instances if k[0] == ledger]:
+            del _instances[key]
+
+
+def flush_all() -> None:
+    with lock:
+        for tracker in _instances.values():
+            tracker.flush()
+
+
+def _row(obj: ExpenseDB, old: bool = False) -> ExpenseRow:
+    if not old:
+        return ExpenseRow(obj.id, obj.date, obj.amount, obj.category_id, obj.notes)
+    attrs = inspect(obj).attrs
+
+    def previous(field):
+        history = attrs[field].history
+        if history.deleted:
+            return history.deleted[0]
+        return history.unchanged[0] if history.unchanged else getattr(obj, field)
+
+    return ExpenseRow(obj.id, previous("date"), previous("amount"),
+                      previous("category_id"), previous("notes"))
+
+
+def flushed_changes(session: Session) -> List[Tuple[Optional[ExpenseRow], Optional[ExpenseRow]]]:
+    """(old, new) expense rows written by the flush in progress; call from after_flush"""
+    changes = []
+    for obj in session.new:
+        if isinstance(obj, ExpenseDB):
+            changes.append((None, _row(obj)))
+    for obj in session.dirty:
+        if isinstance(obj, ExpenseDB) and session.is_modified(obj):
+            changes.append((_row(obj, old=True), _row(obj)))
+    for obj in session.deleted:
+        if isinstance(obj, ExpenseDB):
+            changes.append((_row(obj, old=True), None))
+    return changes
+
+
+# Change capture: snapshot expense rows at flush time, dispatch after commit
+@event.listens_for(Session, "after_flush")
+def _collect_changes(session, flush_context):
+    changes = session.info.setdefault("expense_changes", [])
+    changes.extend(flushed_changes(session))
+    if changes:
+        # Still inside the write transaction, so this is exactly our version
+        session.info["expense_version"] = expenses_version(session)
+
+
+@event.listens_for(Session, "after_commit")
+def _dispatch_changes(session):
+    changes: List = session.info.pop("expense_changes", None)
+    version = session.info.pop("expense_version", None)
+    # Set by the journal, which records the same changes in this transaction
+    journal_id = session.info.pop("journal_id", None)
+    if not changes:
+        return
+    ledger = ledger_key(session)
+    with lock:
+        trackers = [t for (key, _), t in _instances.items() if key == ledger and not t.rebuilding]
+        for tracker in trackers:
+            if tracker.version is not None and version is not None:
+                if tracker.version >= version:
+                    continue  # reloaded after this commit, already included
+                if tracker.version != version - len(changes):
+                    tracker.stale = True
+                    continue
+                tracker.version, tracker.journal_id = version, journal_id
+            for old, new in changes:
+                tracker.apply(old, new)
+
+
+@event.listens_for(Session, "after_soft_rollback")
+def _discard_changes(session, previous_transaction):
+    session.info.pop("expense_changes", None)
+    session.info.pop("expense_version", None)
+    session.info.pop("journal_id", None)
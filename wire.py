@@ -0,0 +1,117 @@
+# SoloWealth - Personal Finance Tracker
+# wire.py - Compact columnar encodings of list responses, chosen by the Accept header
+
+import json
+from collections.abc import Mapping
+from datetime import date, datetime
+from enum import Enum
+from typing import Dict, Iterable, List, Optional, Type
+
+from fastapi import Response
+from pydantic import BaseModel
+
+try:
+    import msgpack
+except ImportError:  # optional: columnar JSON needs nothing extra
+    msgpack = None
+
+JSON = "application/json"
+COLUMNS = "application/vnd.solowealth.columns+json"
+MSGPACK = "application/msgpack"
+# Media types a client may ask for, by the one they are answered with
+ACCEPTED = {
+    COLUMNS: COLUMNS,
+    MSGPACK: MSGPACK,
+    "application/x-msgpack": MSGPACK,
+    "application/vnd.msgpack": MSGPACK,
+    JSON: JSON,
+    "application/*": JSON,
+    "*/*": JSON,
+}
+
+
+class WireError(Exception):
+    pass
+
+
+def negotiate(accept: Optional[str]) -> Optional[str]:
+    """The compact media type a request's Accept header prefers, or None for plain JSON.
+
+    Media types are ranked by q, then by their order in the header.
+    Plain JSON stays the answer for anything else, including no header.
+    """
+    offers = []
+    for position, item in enumerate((accept or "").split(",")):
+        media_type, *params = [part.strip() for part in item.split(";")]
+        media_type = ACCEPTED.get(media_type.lower())
+        if media_type is None:
+            continue
+        q = 1.0
+        for param in params:
+            name, _, value = param.partition("=")
+            if name.strip().lower() == "q":
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        if q > 0:
+            offers.append((q, -position, media_type))
+    available = [offer for offer in offers if offer[2] != MSGPACK or msgpack is not None]
+    if offers and not available:
+        raise WireError("MessagePack responses require the 'msgpack' package")
+    if not available:
+        return None
+    media_type = max(available)[2]
+    return None if media_type == JSON else media_type
+
+
+def _encode(values: List) -> List:
+    """JSON-ready values of a column, typed by its first non-null value"""
+    sample = next((value for value in values if value is not None), None)
+    if isinstance(sample, (date, datetime)):
+        return [value.isoformat() if value is not None else None for value in values]
+    if isinstance(sample, Enum):
+        return [value.value if value is not None else None for value in values]
+    return values
+
+
+def columns(rows: Iterable, model: Type[BaseModel], categories: Optional[Dict[int, str]] = None) -> dict:
+    """Rows (mappings, ORM objects or models, all of one kind) as {"count", "columns": {field: [values]}}.
+
+    Fields are those of `model`, in its order. A `category_name` field is
+    not repeated per row but sent once as "categories" ({id: name} for the
+    ids present), taken from `categories` or else from the rows themselves.
+    Its ids are strings, as JSON object keys are and msgpack decoders
+    require by default (strict_map_key).
+    """
+    fields: List[str] = list(model.model_fields)
+    rows = list(rows)
+    if rows and isinstance(rows[0], BaseModel):
+        rows = [row.dict() for row in rows]
+    if rows and isinstance(rows[0], Mapping):
+        keys = set(rows[0].keys())
+
+        def column(field: str) -> List:
+            return [row[field] for row in rows] if field in keys else [None] * len(rows)
+    else:
+        def column(field: str) -> List:
+            return [getattr(row, field, None) for row in rows]
+
+    payload = {"count": len(rows)}
+    if "category_id" in fields and "category_name" in fields:
+        fields.remove("category_name")
+        ids = column("category_id")
+        if categories is None:
+            categories = dict(zip(ids, column("category_name")))
+        present = set(ids)
+        payload["categories"] = {str(key): name for key, name in categories.items() if key in present}
+    payload["columns"] = {field: _encode(column(field)) for field in fields}
+    return payload
+
+
+def encode(media_type: str, payload: dict) -> Response:
+    if media_type == MSGPACK:
+        content = msgpack.packb(payload, use_bin_type=True)
+    else:
+        content = json.dumps(payload, separators=(",", ":"), ensure_ascii=False, default=str).encode()
+    return Response(content=content, media_type=media_type, headers={"Vary": "Accept"})
@@ -0,0 +1,336 @@
+# SoloWealth - Personal Finance Tracker
+# writer.py - One writer at a time per ledger, across threads and server processes
+
+import os
+import queue
+import sys
+import threading
+import time
+import uuid
+from concurrent.futures import Future
+from contextlib import contextmanager
+from typing import Callable, Dict, List, Optional, Tuple, TypeVar
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from sqlalchemy.orm import Session
+
+from models import SessionLocal
+from profiles import database_path
+
+# Longest wait for the write gate; past it the write goes ahead and falls
+# back on SQLite's own busy_timeout, so a stuck holder never hangs the app
+WAIT_SECONDS = 30.0
+WRITES = ("INSERT", "UPDATE", "DELETE", "REPLACE", "CREATE", "DROP", "ALTER")
+
+# Group commit: queued writes are committed together once LINGER_SECONDS
+# have passed since the first one or MAX_BATCH are waiting
+GROUP_COMMIT = os.environ.get("SOLOWEALTH_GROUP_COMMIT", "0") == "1"
+LINGER_SECONDS = float(os.environ.get("SOLOWEALTH_GROUP_COMMIT_MS", "2")) / 1000
+MAX_BATCH = int(os.environ.get("SOLOWEALTH_GROUP_COMMIT_ROWS", "256"))
+
+T = TypeVar("T")
+
+if sys.platform == "win32":
+    import msvcrt
+
+    def _try_lock(fd: int) -> bool:
+        os.lseek(fd, 0, os.SEEK_SET)
+        try:
+            msvcrt.locking(fd, msvcrt.LK_NBLCK, 1)
+            return True
+        except OSError:
+            return False
+
+    def _unlock(fd: int) -> None:
+        os.lseek(fd, 0, os.SEEK_SET)
+        msvcrt.locking(fd, msvcrt.LK_UNLCK, 1)
+else:
+    import fcntl
+
+    def _try_lock(fd: int) -> bool:
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            return True
+        except BlockingIOError:
+            return False
+
+    def _unlock(fd: int) -> None:
+        fcntl.flock(fd, fcntl.LOCK_UN)
+
+
+class FileLock:
+    """Exclusive lock on a file, held against every other process (and every
+    other FileLock on the same path). Released automatically if the process dies.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._fd: Optional[int] = None
+
+    def acquire(self, timeout: Optional[float] = None) -> bool:
+        if self._fd is None:
+            self._fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+        deadline = None if timeout is None else time.monotonic() + timeout
+        delay = 0.0005
+        while not _try_lock(self._fd):
+            if deadline is not None and time.monotonic() >= deadline:
+                return False
+            time.sleep(delay)
+            delay = min(delay * 2, 0.02)
+        return True
+
+    def release(self) -> None:
+        _unlock(self._fd)
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc):
+        self.release()
+
+
+def lock_path(engine: Engine, purpose: str) -> str:
+    return os.path.splitext(database_path(engine))[0] + f".{purpose}.lock"
+
+
+class WriteGate:
+    """Admits one write transaction at a time on a ledger: a thread lock
+    within this process, then a file lock against the other server processes.
+
+    Writers queue here in order instead of racing for SQLite's write lock,
+    whose busy handler polls with growing sleeps and gives up with
+    SQLITE_BUSY ("database is locked") once busy_timeout runs out.
+
+    The gate is reentrant: a thread that holds it (say, in an after_commit
+    hook) and writes through another session or `engine.begin()` is let
+    through instead of waiting on itself. A hold may be released from
+    another thread, as a connection can be checked in by whichever thread
+    closes its session.
+    """
+
+    def __init__(self, path: str):
+        self._cond = threading.Condition(threading.Lock())
+        self._owner: Optional[int] = None
+        self._depth = 0
+        self._file = FileLock(path)
+
+    def acquire(self, timeout: float = WAIT_SECONDS) -> bool:
+        deadline = time.monotonic() + timeout
+        me = threading.get_ident()
+        with self._cond:
+            if self._owner == me:
+                self._depth += 1
+                return True
+            if not self._cond.wait_for(lambda: self._owner is None, timeout):
+                return False
+            self._owner, self._depth = me, 1
+        if not self._file.acquire(max(deadline - time.monotonic(), 0)):
+            with self._cond:
+                self._owner, self._depth = None, 0
+                self._cond.notify()
+            return False
+        return True
+
+    def release(self) -> None:
+        with self._cond:
+            self._depth -= 1
+            if self._depth:
+                return
+            self._owner = None
+            self._file.release()
+            self._cond.notify()
+
+    @contextmanager
+    def held(self):
+        """Hold the gate for a block that writes to the file outside the engine (a restore)"""
+        acquired = self.acquire()
+        try:
+            yield
+        finally:
+            if acquired:
+                self.release()
+
+
+_gates: Dict[str, WriteGate] = {}
+_gates_lock = threading.Lock()
+
+
+def gate(engine: Engine) -> WriteGate:
+    """The write gate of an engine's ledger (one per database file in this process)"""
+    path = database_path(engine)
+    with _gates_lock:
+        if path not in _gates:
+            _gates[path] = WriteGate(lock_path(engine, "write"))
+        return _gates[path]
+
+
+def install(engine: Engine) -> None:
+    """Put every write on the engine behind the ledger's gate.
+
+    The gate is taken by the first write statement of a checked-out
+    connection, before SQLite is asked for its write lock, and released
+    when the connection goes back to the pool, i.e. after commit or
+    rollback and after the after_commit hooks (tracker dispatch) ran.
+    Reads never wait for it.
+    """
+    write_gate = gate(engine)
+
+    @event.listens_for(engine, "before_cursor_execute")
+    def _enter(conn, cursor, statement, parameters, context, executemany):
+        if "write_gate" not in conn.info and statement.lstrip()[:7].upper().startswith(WRITES):
+            conn.info["write_gate"] = write_gate.acquire()
+
+    @event.listens_for(engine, "checkin")
+    def _leave(dbapi_connection, connection_record):
+        if connection_record.info.pop("write_gate", False):
+            write_gate.release()
+
+
+class GroupCommitter:
+    """Writer thread of one ledger that commits queued writes in batches.
+
+    Each write is a `work(session)` callable run on the writer's session;
+    a batch is committed once, so the commit (the fsync of the WAL) is paid
+    per batch instead of per request. Each write is flushed on its own
+    under its own journal transaction, so undo reverts one request, not
+    the batch, even when two requests in a batch change the same row. If
+    the batch fails, its writes are redone one transaction each, so a
+    single bad write only fails its own request.
+    """
+
+    def __init__(self, engine: Engine, linger: float = LINGER_SECONDS, max_batch: int = MAX_BATCH):
+        self.engine = engine
+        self.linger = linger
+        self.max_batch = max_batch
+        self._queue: "queue.Queue[Optional[Tuple[Callable, Future]]]" = queue.Queue()
+        self._stopped = False
+        self._stop_lock = threading.Lock()
+        self._thread = threading.Thread(target=self._run, name="group-commit", daemon=True)
+        self._thread.start()
+
+    def submit(self, work: Callable[[Session], T]) -> T:
+        future: Future = Future()
+        with self._stop_lock:
+            stopped = self._stopped
+            if not stopped:
+                self._queue.put((work, future))
+        if stopped:
+            # Raced with stop(): commit it on its own in the caller's thread
+            future.set_running_or_notify_cancel()
+            self._commit_one(work, future)
+        return future.result()
+
+    def stop(self) -> None:
+        """Commit whatever is queued, then end the thread"""
+        with self._stop_lock:
+            self._stopped = True
+            self._queue.put(None)
+        self._thread.join()
+
+    def _run(self) -> None:
+        stopping = False
+        while not stopping:
+            item = self._queue.get()
+            if item is None:
+                return
+            batch = [item]
+            deadline = time.monotonic() + self.linger
+            while len(batch) < self.max_batch:
+                try:
+                    item = self._queue.get(timeout=max(deadline - time.monotonic(), 0))
+                except queue.Empty:
+                    break
+                if item is None:
+                    stopping = True
+                    break
+                batch.append(item)
+            self._commit(batch)
+
+    def _commit(self, batch: List[Tuple[Callable, Future]]) -> None:
+        session = SessionLocal(bind=self.engine)
+        done = []
+        pending = iter(batch)
+        try:
+            for work, future in pending:
+                if not future.set_running_or_notify_cancel():
+                    continue
+                try:
+                    result = work(session)
+                except Exception as e:
+                    # Work checks before it changes the session, so nothing to undo
+                    future.set_exception(e)
+                    continue
+                done.append((work, future, result))
+                session.info["journal_txn"] = uuid.uuid4().hex
+                session.flush()
+            session.commit()
+        except Exception:
+            session.rollback()
+            session.close()
+            for work, future, _ in done:
+                self._commit_one(work, future)
+            # Writes after the one whose flush failed have not run yet
+            for work, future in pending:
+                if future.set_running_or_notify_cancel():
+                    self._commit_one(work, future)
+            return
+        session.close()
+        for _, future, result in done:
+            future.set_result(result)
+
+    def _commit_one(self, work: Callable, future: Future) -> None:
+        session = SessionLocal(bind=self.engine)
+        try:
+            result = work(session)
+            session.commit()
+        except Exception as e:
+            session.rollback()
+            future.set_exception(e)
+        else:
+            future.set_result(result)
+        finally:
+            session.close()
+
+
+_committers: Dict[str, GroupCommitter] = {}
+
+
+def commit(db: Session, work: Callable[[Session], T]) -> T:
+    """Run `work(session)` in a committed transaction and return its result.
+
+    With SOLOWEALTH_GROUP_COMMIT=1 the work runs on the ledger's writer
+    thread and shares a transaction with other queued writes, so it must
+    raise before changing the session, and what it returns is detached
+    (attributes stay loaded, since sessions do not expire on commit).
+    Otherwise it runs on `db` and commits right away.
+    """
+    if not GROUP_COMMIT:
+        result = work(db)
+        db.commit()
+        return result
+    engine = db.get_bind()
+    path = database_path(engine)
+    with _gates_lock:
+        committer = _committers.get(path)
+        if committer is None:
+            committer = _committers[path] = GroupCommitter(engine)
+        committer.engine = engine
+    return committer.submit(work)
+
+
+def stop(engine: Engine) -> None:
+    """End the writer thread of an engine's ledger, if any, once its queue is committed"""
+    with _gates_lock:
+        committer = _committers.pop(database_path(engine), None)
+    if committer is not None:
+        committer.stop()
+
+
+def stop_all() -> None:
+    with _gates_lock:
+        committers = list(_committers.values())
+        _committers.clear()
+    for committer in committers:
+        committer.stop()